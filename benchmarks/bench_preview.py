@@ -0,0 +1,53 @@
+# Preview benchmark: time to build the print path preview of a large GCode file with gcode_path
+#
+#   fast -- chunks sampled with GCodeParser.sample (the default of gcode_path and preview_gcode)
+#   full -- every line parsed (fast = False), on the first part of the file only
+#
+# The file is a synthetic print of layers of short extrusions, with a comment, a travel move and the channel toggled on every layer.
+#
+# usage: python benchmarks/bench_preview.py [file size in MB, 500 by default]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm2py'))
+import numpy as np
+from preview import gcode_path
+
+def layered_file(fid, size, lines = 20000):
+    rng = np.random.default_rng(0)
+    xy = np.cumsum(rng.normal(scale = 0.5, size = [lines, 2]), axis = 0) % 100
+    layer = ''.join('G1 X{:.3f} Y{:.3f} E{:.5f}\n'.format(x, y, 0.01*i) for i, (x, y) in enumerate(xy)).encode()
+    with open(fid, 'wb') as gcode:
+        gcode.write(b'; synthetic layered print\nG90\nG28\n')
+        z = 0
+        while gcode.tell() < size:
+            z += 1
+            gcode.write('; layer {}\nM5\nG0 X0 Y0 Z{:.2f} F6000\nM3\n'.format(z, 0.2*z).encode())
+            gcode.write(layer)
+
+def timed(source, **options):
+    start = time.perf_counter()
+    xyz, channels = gcode_path(source, **options)
+    return time.perf_counter() - start, len(xyz)
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else int(500e6)
+    with tempfile.TemporaryDirectory() as folder:
+        fid = os.path.join(folder, 'large.gcode')
+        layered_file(fid, size)
+        size = os.path.getsize(fid)
+        print('{:.0f} MB of GCode\n'.format(size / 1e6))
+
+        elapsed, points = timed(fid)
+        print('fast  {:6.1f} s  {:6.1f} MB/s  {} points'.format(elapsed, size / 1e6 / elapsed, points))
+
+        part = os.path.join(folder, 'part.gcode')
+        with open(fid, 'rb') as gcode, open(part, 'wb') as head:
+            head.write(gcode.read(min(size, int(20e6))))
+            head.write(b'\n')
+        elapsed, points = timed(part, fast = False)
+        rate = os.path.getsize(part) / 1e6 / elapsed
+        print('full  {:6.1f} s  {:6.1f} MB/s  ({:.0f} MB only), 500 MB in {:.0f} s'.format(elapsed, rate, os.path.getsize(part) / 1e6, 500 / rate))
@@ -0,0 +1,80 @@
+# Transport benchmarks against the simulated M2PCS printer (m2py/simulator.py)
+#
+#   throughput -- commands/sec for each stream mode, with the printer's motion sped up so the host link is the bottleneck
+#   latency    -- round trip time of a single command (send -> 'ok') in blocking mode, p50/p99
+#   resend     -- throughput with checksums while the printer rejects a fraction of the lines with 'Resend:'
+#   starvation -- time the planner runs empty on a short-segment path at real motion speed, and receive buffer overruns
+#
+# usage: python benchmarks/bench_transport.py [number of moves]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm2py'))
+import numpy as np
+import m2py as mp
+from simulator import Simulator
+
+def connect(stream, checksum = False, **sim_kwargs):
+    printer = Simulator(boot = 0, **sim_kwargs)
+    mk = mp.Makergear(printer, 115200, printout = 1, verbose = False, stream = stream, checksum = checksum)
+    mk.coord_sys(coord_sys = 'rel')
+    return printer, mk
+
+def zigzag(mk, moves, timings = None):
+    for i in range(moves):
+        start = time.perf_counter()
+        mk.move(x = 0.5 if i % 2 else -0.5, y = 0.25)
+        if timings is not None:
+            timings.append(time.perf_counter() - start)
+    mk.transport.drain()
+
+def throughput(stream, moves, checksum = False, **sim_kwargs):
+    printer, mk = connect(stream, checksum = checksum, **sim_kwargs)
+    start = time.perf_counter()
+    zigzag(mk, moves)
+    elapsed = time.perf_counter() - start
+    mk.close()
+    return moves / elapsed, printer
+
+def latency(moves):
+    printer, mk = connect('off', speedup = 1000)
+    timings = []
+    zigzag(mk, moves, timings)
+    mk.close()
+    return 1000*np.percentile(timings, 50), 1000*np.percentile(timings, 99)
+
+def starvation(stream, moves):
+    # Checksums on, so lines lost to a receive buffer overrun are sent again instead of stalling the run
+    printer, mk = connect(stream, checksum = True)
+    start = time.perf_counter()
+    zigzag(mk, moves)
+    elapsed = time.perf_counter() - start
+    mk.close()
+    return printer, elapsed
+
+if __name__ == '__main__':
+    moves = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('{} short moves at 115200 baud\n'.format(moves))
+
+    print('Throughput (motion 1000x faster than real)')
+    baseline = None
+    for stream in ('off', 'char', 'ok'):
+        rate = throughput(stream, moves, speedup = 1000)[0]
+        baseline = baseline or rate
+        print('  stream = {:<6} {:8.1f} commands/s  ({:.2f}x)'.format('\'{}\''.format(stream), rate, rate / baseline))
+
+    print('\nLatency of a blocking command')
+    p50, p99 = latency(min(moves, 500))
+    print('  p50 {:.2f} ms, p99 {:.2f} ms'.format(p50, p99))
+
+    print('\nChecksums with 1% of the lines rejected')
+    for stream in ('off', 'char', 'ok'):
+        rate, printer = throughput(stream, moves, checksum = True, speedup = 1000, resend = 0.01, seed = 0)
+        print('  stream = {:<6} {:8.1f} commands/s  ({} resend requests)'.format('\'{}\''.format(stream), rate, printer.resends))
+
+    print('\nPlanner starvation at real speed ({} moves)'.format(min(moves, 200)))
+    for stream in ('off', 'char', 'ok'):
+        printer, elapsed = starvation(stream, min(moves, 200))
+        print('  stream = {:<6} planner empty {:.2f} s of {:.2f} s, {} lines lost to receive buffer overruns'.format('\'{}\''.format(stream), printer.starved, elapsed, printer.overruns))
@@ -0,0 +1,279 @@
+# M2PY -- asyncio transport, the event loop counterpart of transport.Transport
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import time
+import serial
+from transport import BUFSIZE, RX_BUFFER_SIZE, parse_response, number_line, handshake
+
+async def connect_async(com, baud, stream = 'char', window = BUFSIZE - 1, checksum = False, timeout = 1, deadline = 10):
+    """
+    Opens the serial port com (or uses com directly if it is an already opened serial-like object), waits for the printer to be ready (see transport.handshake) without blocking the event loop and returns a started AsyncTransport for it
+    """
+    if isinstance(com, str):
+        handle = serial.Serial(com, baud, timeout = timeout)
+    else: # An already opened serial-like object (e.g. a simulated printer)
+        handle = com
+    transport = AsyncTransport(handle, stream = stream, window = window, checksum = checksum)
+    transport.banner = await transport.loop.run_in_executor(transport.executor, functools.partial(handshake, handle, deadline = deadline))
+    transport.start()
+    if checksum:
+        await transport.reset_line_numbers()
+    return transport
+
+class AsyncTransport:
+    """
+    Sends lines of GCode over an open serial handle from an asyncio event loop. submit queues a line and returns a Future resolved with the printer's 'ok' Response, so any number of printers and other tasks can share one loop. A writer task sends the queued lines in order while keeping at most window lines, and less than rx_buffer bytes, in flight (stream = 'ok'), the unacknowledged bytes below rx_buffer (stream = 'char') or a single line (stream = 'off'), and a reader task parses everything the printer answers. The blocking serial reads run on a thread of the transport's own, so they never stall the loop.
+
+    checksum, history and stall work as in Transport: numbered lines are kept in a ring buffer and sent again on 'Resend:', or when the printer has been silent for stall seconds with lines in flight.
+
+    The blocking serial writes run in order on a second thread, so a slow or stalled port never blocks the loop either.
+    """
+    def __init__(self, handle, stream = 'char', window = BUFSIZE - 1, rx_buffer = RX_BUFFER_SIZE, checksum = False, history = 1024, stall = 10):
+        if stream not in ('off', 'ok', 'char'):
+            raise ValueError('Unknown stream mode {}, use \'off\', \'ok\' or \'char\''.format(stream))
+        self.handle = handle
+        self.stream = stream
+        self.window = max(1, int(window))
+        self.rx_buffer = rx_buffer
+        self.checksum = checksum
+        self.stall = stall
+        self.outgoing = collections.deque() # (command, Future) waiting to be written
+        self.inflight = collections.deque() # (line number, byte length, Future) of the lines still waiting for an 'ok'
+        self.inflight_bytes = 0
+        self.ring = collections.deque(maxlen = max(history, self.window + 1)) # (line number, encoded line) of the most recently sent lines
+        self.line_number = 0                # Line number of the last numbered line sent
+        self.skip_ok = 0                    # 'ok's that answer a 'Resend:' rather than a command
+        self.resend_from = None             # Line number of the last replay
+        self.stale = 0                      # Lines that were already on the wire when the last replay started
+        self.ignored = 0                    # 'Resend:' requests taken for duplicates since the last replay
+        self.fault = None                   # Unrecoverable transport error, set on every pending Future
+        self.last = None                    # Future of the most recently submitted line
+        self.submitted = 0                  # Number of lines submitted so far
+        self.sent = 0                       # Number of lines written so far
+        self.acked = 0                      # Number of lines acknowledged so far
+        self.temperature = None             # Latest temperature report
+        self.errors = []                    # Every 'error' response received
+        self.history = collections.deque(maxlen = 100) # Most recent responses, for debugging
+        self.banner = []                    # Lines received while connecting
+        self.last_response = time.time()    # Time the last line was received
+        self.handlers = []                  # Functions called with every Response, from the event loop
+        self.running = False
+        self.loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'm2py-async-reader')
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'm2py-async-writer')
+        self.wake = asyncio.Event()         # Set whenever the writer may be able to send
+        self.idle = asyncio.Event()         # Set while nothing is queued or in flight
+        self.idle.set()
+        self.tasks = []
+
+    def start(self):
+        """
+        Starts the reader and writer tasks
+        """
+        self.running = True
+        self.tasks = [self.loop.create_task(self._read_loop()), self.loop.create_task(self._write_loop())]
+
+    async def readline(self):
+        """
+        Reads a single raw line from the printer without blocking the event loop
+        """
+        return await self.loop.run_in_executor(self.executor, self.handle.readline)
+
+    async def reset_line_numbers(self):
+        """
+        Sends M110 so that the firmware restarts counting lines from 0
+        """
+        await self.drain()
+        self.line_number = -1
+        self.ring.clear()
+        await self.send('M110')
+
+    def submit(self, cmd):
+        """
+        Queues a single line of GCode (str or pre-encoded bytes, without the newline) and returns a Future resolved with the 'ok' Response once the printer acknowledges it
+        """
+        future = self.loop.create_future()
+        if self.fault is not None:
+            future.set_exception(self.fault)
+            future.exception() # Raised by drain as well, so it need not be awaited
+            return future
+        if not isinstance(cmd, bytes):
+            cmd = str.encode(str(cmd))
+        self.outgoing.append((cmd, future))
+        self.submitted += 1
+        self.last = future
+        self.idle.clear()
+        self.wake.set()
+        return future
+
+    async def send(self, cmd):
+        """
+        Sends a single line of GCode and returns the 'ok' Response once the printer acknowledged it
+        """
+        return await self.submit(cmd)
+
+    def has_room(self, nbytes):
+        """
+        Returns True if a line of nbytes can be sent without overrunning the firmware buffers
+        """
+        if not self.inflight:
+            return True
+        if self.stream == 'off':
+            return False
+        elif self.stream == 'char':
+            return self.inflight_bytes + nbytes < self.rx_buffer
+        # Lines only leave the receive buffer as the firmware parses them, so the 'ok' window is also capped by its size
+        return len(self.inflight) < self.window and self.inflight_bytes + nbytes < self.rx_buffer
+
+    def emergency_stop(self):
+        """
+        Sends M112 immediately, ahead of every queued line (only the lines already handed to the writer thread go first), and fails everything queued or in flight since the halted printer will never acknowledge it. Returns a Future resolved once M112 was written.
+        """
+        written = self._write(b'M112\n')
+        self._fail(serial.SerialException('Emergency stop'))
+        return written
+
+    async def drain(self):
+        """
+        Waits until every line submitted so far has been acknowledged by the printer
+        """
+        await self.idle.wait()
+        if self.fault is not None:
+            raise self.fault
+
+    async def close(self):
+        """
+        Waits for the outstanding acknowledgements, stops the reader and writer tasks and closes the serial handle
+        """
+        try:
+            await self.drain()
+        finally:
+            self.running = False
+            self.wake.set()
+            await asyncio.gather(*self.tasks, return_exceptions = True)
+            await asyncio.gather(self.loop.run_in_executor(self.writer, self.handle.flush), return_exceptions = True) # Lets the pending writes finish
+            self.handle.close()
+            self.executor.shutdown(wait = False)
+            self.writer.shutdown(wait = False)
+            self._fail(serial.SerialException('Serial port closed'))
+
+    async def _write_loop(self):
+        while self.running:
+            await self.wake.wait()
+            self.wake.clear()
+            while self.outgoing and self.fault is None:
+                cmd, future = self.outgoing[0]
+                number = self.line_number + 1 if self.checksum else None
+                line = number_line(cmd, number) if self.checksum else cmd + b'\n'
+                if not self.has_room(len(line)):
+                    break
+                self.outgoing.popleft()
+                if self.checksum:
+                    self.line_number = number
+                    self.ring.append((number, line))
+                self.inflight.append((number, len(line), future))
+                self.inflight_bytes += len(line)
+                self.sent += 1
+                self._write(line)
+
+    def _write(self, line):
+        # Writes run one at a time in submission order; a failed write fails everything queued or in flight
+        written = self.loop.run_in_executor(self.writer, self.handle.write, line)
+        written.add_done_callback(self._written)
+        return written
+
+    def _written(self, written):
+        if not written.cancelled() and written.exception() is not None and self.fault is None:
+            self._fail(written.exception())
+
+    async def _read_loop(self):
+        try:
+            while self.running:
+                read = await self.readline()
+                if read:
+                    self._dispatch(parse_response(read))
+                elif self.checksum and self.inflight and self.inflight[0][0] is not None and (self.ignored or time.time() - self.last_response > self.stall):
+                    # The printer went quiet with lines in flight, either right after requests taken for duplicates or for stall seconds, so those lines were lost
+                    self._replay(self.inflight[0][0])
+                    self.last_response = time.time()
+        except Exception as error:
+            # The port failed (e.g. the USB cable was unplugged): every line queued or in flight fails with the error
+            self._fail(error)
+
+    def _dispatch(self, response):
+        self.history.append(response)
+        self.last_response = time.time()
+        if response.kind == 'ok':
+            if self.skip_ok:
+                self.skip_ok -= 1
+            elif self.inflight:
+                _, nbytes, future = self.inflight.popleft()
+                self.inflight_bytes -= nbytes
+                self.acked += 1
+                if not future.done():
+                    future.set_result(response)
+                if not self.inflight and not self.outgoing:
+                    self.idle.set()
+            self.wake.set()
+        elif response.kind == 'resend':
+            self._resend(response.value)
+            self.wake.set()
+        elif response.kind == 'error':
+            self.errors.append(response)
+            if 'halted' in response.text: # 'Error:Printer halted. kill() called!', nothing will be acknowledged anymore
+                self._fail(serial.SerialException('Printer halted: {}'.format(response.text)))
+        if response.value is not None and response.kind in ('ok', 'temperature'):
+            self.temperature = response.value
+        for handler in self.handlers:
+            handler(response)
+
+    def _resend(self, number):
+        # Every 'Resend:' is followed by an 'ok' that does not acknowledge a command
+        self.skip_ok += 1
+        if not self.checksum:
+            return
+        if number == self.resend_from and self.stale > 0:
+            # Lines written before the replay started are rejected with the same request, the replay already covers them
+            self.stale -= 1
+            self.ignored += 1
+            return
+        self._replay(number)
+
+    def _replay(self, number):
+        if not self.ring or not self.ring[0][0] <= number <= self.line_number + 1:
+            self._fail(serial.SerialException('Printer requested line {} which is no longer in the resend buffer'.format(number)))
+            return
+
+        # Lines from the requested one onwards were rejected or flushed by the firmware, they are sent again with the same Futures
+        futures = {}
+        while self.inflight and self.inflight[-1][0] is not None and self.inflight[-1][0] >= number:
+            lineno, nbytes, future = self.inflight.pop()
+            self.inflight_bytes -= nbytes
+            futures[lineno] = future
+        self.sent = self.acked + len(self.inflight)
+        self.resend_from = number
+        self.stale = self.line_number - number
+        self.ignored = 0
+        for lineno, line in list(self.ring)[number - self.ring[0][0]:]:
+            self.inflight.append((lineno, len(line), futures.get(lineno) or self.loop.create_future()))
+            self.inflight_bytes += len(line)
+            self.sent += 1
+            self._write(line)
+
+    def _fail(self, error):
+        # Nothing queued or in flight will ever be acknowledged
+        self.fault = error
+        for future in [entry[-1] for entry in self.inflight] + [entry[-1] for entry in self.outgoing]:
+            if not future.done():
+                future.set_exception(error)
+                future.exception() # Raised by drain as well, so lines submitted without awaiting them do not warn
+        self.inflight.clear()
+        self.inflight_bytes = 0
+        self.outgoing.clear()
+        self.idle.set()
+        self.wake.set()
@@ -0,0 +1,98 @@
+# M2PY -- Shadow model of the firmware state, used to drop commands that would not change anything
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+class StateCache:
+    """
+    Tracks the firmware state set by the commands sent to the printer: coordinate mode (G90/G91), feedrate, the three channels (M3-M8), motor speed (M9) and channel delay (M50). filter returns None for a command that would leave that state unchanged, so it never reaches the wire; every M3-M9 costs a round trip and a planner drain in the firmware. A feedrate set on its own line (G1 F...) is held back and folded into the next move. Every value starts unknown, so the first command setting it is always sent.
+
+    With strict = True nothing is dropped or folded, every command is sent exactly as written and redundant only counts (and, if verbose, prints) the commands that would have been dropped, for debugging.
+    """
+    def __init__(self, strict = False, verbose = False):
+        self.strict = strict
+        self.verbose = verbose
+        self.redundant = 0                  # Commands that did not change the state
+        self.folded = 0                     # Feedrate lines folded into the next move
+        self.pending = None                 # Feedrate waiting for the next move
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the state (e.g. after the printer was reset or halted)
+        """
+        self.state = {'relative': None, 'feedrate': None, 'channels': [None, None, None], 'motor': None, 'delay': None}
+        self.pending = None
+
+    def filter(self, cmd):
+        """
+        Returns the line to send for the GCode command cmd (str, or bytes for a move from MoveEncoder), or None if it is dropped or held back
+        """
+        if isinstance(cmd, bytes):
+            # A move pre-encoded by MoveEncoder, which never has a feedrate
+            if self.pending is not None:
+                cmd += b' F' + _number(self.pending).encode()
+                self.state['feedrate'] = self.pending
+                self.pending = None
+                self.folded += 1
+            return cmd
+        words = cmd.split()
+        code = words[0] if words else ''
+        if code in ('G90', 'G91') and len(words) == 1:
+            return self._set(cmd, 'relative', code == 'G91')
+        elif code in ('G0', 'G1') and len(words) == 2 and words[1].startswith('F'):
+            feedrate = float(words[1][1:])
+            if self.strict:
+                return self._set(cmd, 'feedrate', feedrate)
+            if feedrate == (self.state['feedrate'] if self.pending is None else self.pending):
+                return self._redundant(cmd)
+            self.pending = None if feedrate == self.state['feedrate'] else feedrate
+            return None
+        elif code in ('G0', 'G1', 'G2', 'G3'):
+            feedrate = [float(word[1:]) for word in words if word.startswith('F')]
+            if feedrate:
+                self.state['feedrate'] = feedrate[-1]
+                self.pending = None
+            elif self.pending is not None:
+                cmd = '{} F{}'.format(cmd, _number(self.pending))
+                self.state['feedrate'] = self.pending
+                self.pending = None
+                self.folded += 1
+            return cmd
+        elif code in ('M3', 'M4', 'M5', 'M6', 'M7', 'M8') and len(words) == 1:
+            channel = (int(code[1:]) - 3) // 2
+            on = int(code[1:]) % 2 == 1
+            if self.state['channels'][channel] == on:
+                return self._redundant(cmd)
+            self.state['channels'][channel] = on
+            return cmd
+        elif code in ('M9', 'M50') and len(words) == 2 and words[1].startswith('S'):
+            return self._set(cmd, 'motor' if code == 'M9' else 'delay', float(words[1][1:]))
+        elif code == 'M112':
+            self.reset()
+        return cmd
+
+    def flush(self):
+        """
+        Returns the held back feedrate as a line of its own (or None), e.g. before closing
+        """
+        if self.pending is None:
+            return None
+        cmd = 'G1 F{}'.format(_number(self.pending))
+        self.state['feedrate'] = self.pending
+        self.pending = None
+        return cmd
+
+    def _set(self, cmd, key, value):
+        if self.state[key] == value:
+            return self._redundant(cmd)
+        self.state[key] = value
+        return cmd
+
+    def _redundant(self, cmd):
+        self.redundant += 1
+        if self.strict:
+            if self.verbose: print('Redundant command: {}'.format(cmd))
+            return cmd
+        return None
+
+def _number(value):
+    return str(int(value)) if value == int(value) else repr(value)
@@ -0,0 +1,262 @@
+# M2PY -- Printer daemon: keeps the serial port (and the printer state) open across scripts
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+#
+# usage: python daemon.py COM3 [baud] [--address m2py://127.0.0.1:8125] [--stream char] [--checksum]
+
+# Importing of necessary dependent modules
+import argparse
+import json
+import socket
+import socketserver
+import threading
+import serial
+from transport import connect, BUFSIZE
+
+DEFAULT_ADDRESS = 'm2py://127.0.0.1:8125'
+
+def parse_address(address):
+    """
+    Returns (host, port) for an address of the form 'm2py://host:port'
+    """
+    host, port = address[len('m2py://'):].rsplit(':', 1)
+    return host, int(port)
+
+class PrinterDaemon:
+    """
+    Owns the serial connection to one printer and plays the commands of client scripts on it, so the board is reset (and homed, heated, ...) only once instead of once per script. Clients connect over localhost TCP at address, normally through a Makergear created with com = 'm2py://host:port'. Every client connection is a session that gets the printer to itself; sessions are served in the order they connect, so scripts can be queued back-to-back. The Makergear state (coordinates, tools, channels, coordinate system) is kept between sessions.
+
+    Lines sent by a client are GCode, except for these requests:
+        @session            waits for the printer and answers 'ok' (first line of a session)
+        @state              answers the stored Makergear state as JSON
+        @state <json>       stores the Makergear state
+        @drain              answers 'ok' once every line was acknowledged, or 'error <message>'
+        @status             answers the daemon status as JSON, without waiting for the printer
+        @query <cmd>        sends cmd and answers the lines the printer reported before its 'ok' as JSON
+        @unacknowledged <json>  sends [cmd, answer, timeout] with Transport.send_unacknowledged and answers the printer's answer as JSON
+        @stop               sends M112 right away, without waiting for the printer
+    """
+    def __init__(self, com, baud, address = DEFAULT_ADDRESS, stream = 'char', window = BUFSIZE - 1, checksum = False, verbose = True):
+        self.com = com
+        self.baud = baud
+        self.stream = stream
+        self.window = window
+        self.checksum = checksum
+        self.verbose = verbose
+        self.state = None                   # Makergear state left by the last session
+        self.error = None                   # Error of the current session, reported on '@drain'
+        self.sessions = 0                   # Sessions served so far
+        self.next_ticket = 0                # Sessions are served in ticket order
+        self.serving = 0
+        self.turn = threading.Condition()
+        if self.verbose: print('Connecting to {}'.format(com))
+        self.transport = connect(com, baud, stream = stream, window = window, checksum = checksum)
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon._handle(self.rfile, self.wfile)
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(parse_address(address), Handler)
+        self.server.daemon_threads = True
+        self.address = 'm2py://{}:{}'.format(*self.server.server_address[:2])
+
+    def serve_forever(self):
+        """
+        Serves clients until shutdown is called (or Ctrl+C)
+        """
+        if self.verbose: print('Serving {} on {}'.format(self.com, self.address))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def start(self):
+        """
+        Serves clients from a background thread and returns immediately
+        """
+        threading.Thread(target = self.serve_forever, name = 'm2py-daemon', daemon = True).start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        self.transport.close()
+        if self.verbose: print('Disconnected from {}'.format(self.com))
+
+    def status(self):
+        return {'com': str(self.com), 'sessions': self.sessions, 'waiting': max(0, self.next_ticket - self.serving - 1), 'sent': self.transport.sent, 'acked': self.transport.acked, 'temperature': self.transport.temperature}
+
+    def _handle(self, rfile, wfile):
+        def reply(text):
+            wfile.write(str.encode(text + '\n'))
+            wfile.flush()
+        first = rfile.readline().strip()
+        if first == b'@status':
+            return reply(json.dumps(self.status()))
+        elif first == b'@stop':
+            self.transport.emergency_stop()
+            return reply('ok')
+        elif first != b'@session':
+            return reply('error expected @session')
+
+        with self.turn:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.serving != ticket:
+                self.turn.wait()
+        try:
+            self.error = None
+            self.sessions += 1
+            if self.transport.fault is not None and isinstance(self.com, str):
+                self._reconnect()
+            reply('ok')
+            for line in rfile:
+                line = line.strip()
+                if line.startswith(b'@'):
+                    self._request(line, reply)
+                elif line and self.error is None:
+                    try:
+                        self.transport.send(line)
+                    except Exception as error:
+                        self.error = error
+            self._drain()
+        except (OSError, ValueError):
+            pass # The client went away
+        finally:
+            with self.turn:
+                self.serving += 1
+                self.turn.notify_all()
+
+    def _request(self, line, reply):
+        request, _, argument = line.decode('ascii', 'replace').partition(' ')
+        if request == '@state':
+            if argument:
+                self.state = json.loads(argument)
+            else:
+                reply(json.dumps(self.state))
+        elif request == '@drain':
+            self._drain()
+            reply('ok' if self.error is None else 'error {}'.format(self.error))
+        elif request == '@status':
+            reply(json.dumps(self.status()))
+        elif request in ('@query', '@unacknowledged'):
+            try:
+                if self.error is not None:
+                    raise self.error
+                if request == '@query':
+                    reply(json.dumps(self.transport.query(argument)))
+                else:
+                    reply(json.dumps(self.transport.send_unacknowledged(*json.loads(argument))))
+            except Exception as error:
+                self.error = self.error or error
+                reply('error {}'.format(error))
+        elif request == '@stop':
+            self.transport.emergency_stop()
+        else:
+            reply('error unknown request {}'.format(request))
+
+    def _reconnect(self):
+        # The printer halted or the connection failed: reopening the port resets the board
+        if self.verbose: print('Reconnecting to {} after: {}'.format(self.com, self.transport.fault))
+        self.transport.running = False
+        self.transport.handle.close()
+        self.transport = connect(self.com, self.baud, stream = self.stream, window = self.window, checksum = self.checksum)
+        self.state = None
+
+    def _drain(self):
+        try:
+            self.transport.drain()
+        except Exception as error:
+            self.error = self.error or error
+
+class DaemonTransport:
+    """
+    Client side of a PrinterDaemon session with the same interface as Transport (send, query, send_unacknowledged, drain, emergency_stop, close), returned by connect for com = 'm2py://host:port'. Lines are streamed to the daemon without waiting; errors are raised by drain and close. state holds the Makergear state left by the previous session, and is stored back on close.
+    """
+    def __init__(self, address = DEFAULT_ADDRESS, timeout = None):
+        self.address = address
+        self.handle = socket.create_connection(parse_address(address), timeout = timeout)
+        self.file = self.handle.makefile('rwb')
+        self.sent = 0
+        self._request('@session') # Waits for the sessions queued before this one
+        self.state = json.loads(self._request('@state'))
+
+    def _request(self, request, answer = True):
+        self.file.write(str.encode(request + '\n'))
+        self.file.flush()
+        if answer:
+            text = self.file.readline().decode('ascii', 'replace').strip()
+            if not text:
+                raise serial.SerialException('Printer daemon at {} closed the connection'.format(self.address))
+            if text.startswith('error'):
+                raise serial.SerialException('Printer daemon: {}'.format(text[len('error '):]))
+            return text
+
+    def send(self, cmd):
+        if not isinstance(cmd, bytes):
+            cmd = str.encode(str(cmd))
+        self.file.write(cmd + b'\n')
+        self.file.flush()
+        self.sent += 1
+
+    def query(self, cmd):
+        """
+        Sends cmd once every earlier line was acknowledged and returns the text of every line the printer answered before its 'ok' (see Transport.query)
+        """
+        self.sent += 1
+        return json.loads(self._request('@query {}'.format(cmd)))
+
+    def send_unacknowledged(self, cmd, answer, timeout = 10):
+        """
+        Sends cmd, which the firmware answers with a line starting with answer instead of 'ok', and returns that line (see Transport.send_unacknowledged)
+        """
+        return json.loads(self._request('@unacknowledged {}'.format(json.dumps([cmd, answer, timeout]))))
+
+    def drain(self):
+        """
+        Waits until the printer acknowledged every line sent so far
+        """
+        self._request('@drain')
+
+    def emergency_stop(self):
+        """
+        Sends M112 through a separate connection, so it overtakes every line still queued in this session
+        """
+        with socket.create_connection(parse_address(self.address)) as stop:
+            stop.sendall(b'@stop\n')
+            stop.recv(16)
+
+    def close(self):
+        """
+        Waits for the outstanding acknowledgements, stores the state and ends the session. The printer stays connected to the daemon.
+        """
+        try:
+            self.drain()
+            if self.state is not None:
+                self._request('@state {}'.format(json.dumps(self.state)), answer = False)
+        finally:
+            self.file.close()
+            self.handle.close()
+
+def daemon_status(address = DEFAULT_ADDRESS):
+    """
+    Returns the status of the daemon at address (sessions served and waiting, lines sent and acknowledged, temperature)
+    """
+    with socket.create_connection(parse_address(address)) as client:
+        client.sendall(b'@status\n')
+        return json.loads(client.makefile('rb').readline())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Keeps a printer connected and plays the commands of m2py scripts using com = \'m2py://host:port\'')
+    parser.add_argument('com')
+    parser.add_argument('baud', nargs = '?', type = int, default = 115200)
+    parser.add_argument('--address', default = DEFAULT_ADDRESS)
+    parser.add_argument('--stream', default = 'char', choices = ['off', 'ok', 'char'])
+    parser.add_argument('--window', type = int, default = BUFSIZE - 1)
+    parser.add_argument('--checksum', action = 'store_true')
+    args = parser.parse_args()
+    PrinterDaemon(args.com, args.baud, address = args.address, stream = args.stream, window = args.window, checksum = args.checksum).serve_forever()
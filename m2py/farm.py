@@ -0,0 +1,139 @@
+# M2PY -- Print farm: several M2PCS units driven concurrently from one event loop
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import asyncio
+import collections
+import time
+from transport import BUFSIZE
+from aio import connect_async
+from job import Job
+
+class FarmPrinter:
+    """
+    Progress of one printer of a Farm. state is 'waiting', 'connecting', 'printing', 'done', 'aborted' or 'failed', and error holds the exception of a failed printer.
+    """
+    def __init__(self, com, job):
+        self.com = com
+        self.job = job
+        self.total = len(job)
+        self.acked = 0
+        self.state = 'waiting'
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.transport = None
+        self.aborted = False
+
+    @property
+    def progress(self):
+        return self.acked / self.total if self.total else 1.0
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+class Farm:
+    """
+    Plays Jobs on several printers at once. printers is a list of (com, job) pairs, com being a port name or an opened serial-like object and job a Job or a GCode file name. Every file is loaded once and the same Job is played on every printer that prints it, so identical specimens are compiled once. Each printer has its own AsyncTransport on a single event loop; a printer that fails (disconnects, halts after an M112, loses lines it cannot resend) is marked failed and stopped while the others keep printing. The progress of every printer and the combined throughput are printed every progress seconds.
+    """
+    def __init__(self, printers, baud = 115200, stream = 'char', window = BUFSIZE - 1, checksum = False, progress = 5, verbose = True):
+        jobs = {}
+        self.printers = []
+        for com, job in printers:
+            if not isinstance(job, Job):
+                if job not in jobs:
+                    jobs[job] = Job.load(job)
+                job = jobs[job]
+            self.printers.append(FarmPrinter(com, job))
+        self.baud = baud
+        self.stream = stream
+        self.window = window
+        self.checksum = checksum
+        self.progress = progress
+        self.verbose = verbose
+        self.started = None
+
+    def run(self):
+        """
+        Runs every printer to completion and returns the list of FarmPrinter
+        """
+        return asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        Coroutine version of run, for use inside a running event loop
+        """
+        self.started = time.time()
+        reporter = asyncio.ensure_future(self._report_loop())
+        try:
+            await asyncio.gather(*[self._play(printer) for printer in self.printers])
+        finally:
+            reporter.cancel()
+        if self.verbose: self.report()
+        return self.printers
+
+    def abort(self, com, emergency = False):
+        """
+        Stops sending to the printer on com. With emergency = True an M112 is sent right away, halting it immediately. The other printers are not affected.
+        """
+        for printer in self.printers:
+            if printer.com == com:
+                printer.aborted = True
+                if emergency and printer.transport is not None:
+                    printer.transport.emergency_stop()
+
+    @property
+    def throughput(self):
+        """
+        Lines acknowledged per second over every printer since the farm started
+        """
+        elapsed = time.time() - self.started if self.started else 0
+        return sum(printer.acked for printer in self.printers) / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        for printer in self.printers:
+            line = '{}: {} {:.1f}% ({}/{} lines, {:.0f} s)'.format(printer.com, printer.state, 100*printer.progress, printer.acked, printer.total, printer.elapsed)
+            if printer.error is not None:
+                line += ' -- {}'.format(printer.error)
+            print(line)
+        print('Farm: {:.1f} lines/s on {} printers'.format(self.throughput, sum(printer.state == 'printing' for printer in self.printers)))
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.progress)
+            if self.verbose: self.report()
+
+    def _acked(self, printer, future):
+        if not future.cancelled() and future.exception() is None:
+            printer.acked += 1
+
+    async def _play(self, printer):
+        try:
+            printer.state = 'connecting'
+            printer.transport = transport = await connect_async(printer.com, self.baud, stream = self.stream, window = self.window, checksum = self.checksum)
+            printer.state = 'printing'
+            printer.started = time.time()
+            pending = collections.deque()
+            for line in printer.job:
+                if printer.aborted:
+                    break
+                future = transport.submit(line)
+                future.add_done_callback(lambda future: self._acked(printer, future))
+                pending.append(future)
+                if len(pending) > 2*transport.window:
+                    await pending.popleft() # Keeps the queue of lines waiting to be written short
+            await transport.close()
+            printer.state = 'aborted' if printer.aborted else 'done'
+        except Exception as error:
+            printer.state = 'aborted' if printer.aborted else 'failed'
+            printer.error = error
+            if printer.transport is not None:
+                try:
+                    await printer.transport.close()
+                except Exception:
+                    pass # The transport already failed with error
+        finally:
+            printer.finished = time.time()
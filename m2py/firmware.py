@@ -0,0 +1,25 @@
+# M2PY -- Settings of the custom M2PCS firmware (Marlin 1.0.2) shared by the transport, the simulator and the timing model
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Serial buffers
+BUFSIZE = 32                                        # Configuration_adv.h -- number of queued commands
+RX_BUFFER_SIZE = 128                                # MarlinSerial.h -- bytes held by the serial receive buffer
+MAX_CMD_SIZE = 96                                   # Longest line the firmware accepts
+
+# Motion settings (Configuration.h, Configuration_adv.h), in the order X, Y, Z, E
+BLOCK_BUFFER_SIZE = 16                              # Planner moves, 16 since SDSUPPORT is enabled
+AXIS_STEPS_PER_UNIT = (88.88, 88.88, 1007.7, 471.5) # steps/mm
+MAX_FEEDRATE = (200, 200, 25, 25)                   # mm/s
+MAX_ACCELERATION = (900, 1000, 30, 2000)            # mm/s^2
+ACCELERATION = 2000                                 # mm/s^2
+RETRACT_ACCELERATION = 3000                         # mm/s^2, used for moves of the E axis alone
+XY_JERK = 4.0                                       # mm/s
+Z_JERK = 0.4                                        # mm/s
+E_JERK = 1.0                                        # mm/s
+MINIMUM_PLANNER_SPEED = 0.05                        # mm/s, exit speed of the last move in the planner
+MIN_SEGMENT_TIME = 20000                            # us, moves are slowed to this when the planner is draining (SLOWDOWN)
+HOMING_FEEDRATE = (50*60, 50*60, 15*60)             # mm/min
+MM_PER_ARC_SEGMENT = 1
+DROP_SEGMENTS = 5                                   # Moves of at most this many steps are joined with the next one
+CH_ON_DELAY_TIME = 50                               # ms waited after a channel is turned on, changed with M50
+DEFAULT_FEEDRATE = 1500.0                           # mm/min
@@ -0,0 +1,362 @@
+# M2PY -- GCode file handling
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import collections
+import math
+import mmap
+import os
+import re
+import numpy as np
+from firmware import AXIS_STEPS_PER_UNIT, DEFAULT_FEEDRATE
+
+# Parameter letters of GCodeArrays.params, in column order
+PARAMS = 'XYZEIJFSP'
+
+COMMENT = re.compile(rb';[^\n]*|\*[^\n]*')         # Comments and checksums
+NUMBER = re.compile(rb'[-+]?(\d+\.?\d*|\.\d+)')
+SPACES = bytes.maketrans(b'\t\r\v\f', b'    ')
+COMMAND = re.compile(rb'(?:[Nn]\s*\d+\s*)?([GgMm])\s*0*(\d+)')  # First command of a line
+XY = re.compile(rb'([XYxy])(\s*)([-+]?(?:\d+\.?\d*|\.\d+))')
+
+def read_gcode(fid, chunk_size = 1 << 20):
+    """
+    Generator yielding the GCode lines of the file fid as bytes, with comments, surrounding whitespace and blank lines removed. The file is read in chunks of chunk_size bytes, so memory use stays constant however large the file is. Every line is yielded as (line, offset), offset being the file position just after the line, for progress reporting.
+    """
+    with open(fid, 'rb') as gcode:
+        offset = 0
+        rest = b''
+        while True:
+            chunk = gcode.read(chunk_size)
+            if not chunk:
+                if not rest:
+                    break
+                chunk = b'\n' # Last line without a newline
+            data = rest + chunk
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            for raw in data[:cut].split(b'\n')[:-1]:
+                offset += len(raw) + 1
+                line = raw.split(b';', 1)[0].strip()
+                if line:
+                    yield line, offset
+
+def translate_gcode(lines, dx = 0, dy = 0):
+    """
+    Generator shifting the (line, offset) pairs of read_gcode by dx and dy in X and Y. The X and Y words of G0 to G3 moves are shifted while the file is in absolute mode (G90), as are those of G92 so that a redefined position stays consistent; relative moves, arc centres (I, J) and G28 homing are left untouched.
+    """
+    offsets = {b'X': dx, b'x': dx, b'Y': dy, b'y': dy}
+    shift = lambda word: word.group(1) + word.group(2) + format_number(float(word.group(3)) + offsets[word.group(1)]).encode()
+    relative = False
+    for line, offset in lines:
+        command = COMMAND.match(line)
+        if command and command.group(1) in b'Gg':
+            code = int(command.group(2))
+            if code in (90, 91):
+                relative = code == 91
+            elif (code <= 3 and not relative) or code == 92:
+                line = line[:command.end()] + XY.sub(shift, line[command.end():])
+        yield line, offset
+
+def format_number(value, decimals = 6):
+    """
+    Formats a coordinate with at most decimals decimals and no trailing zeros
+    """
+    text = '{:.{}f}'.format(value, decimals).rstrip('0').rstrip('.')
+    return '0' if text in ('', '-0') else text
+
+class MoveEncoder:
+    """
+    Encodes G1 moves into pre-encoded bytes lines as short as possible. Coordinates are rounded to the fewest decimals that stay within a tenth of a motor step (AXIS_STEPS_PER_UNIT: 3 decimals for X and Y, 4 for Z) and written without trailing zeros. In relative mode zero axes are left out, and the rounding of each move is carried over to the next one so it never accumulates; in absolute mode the axes that do not change are left out. A move that changes nothing encodes to None. The encoder follows the printer position, so it has to be told about G90/G91 (relative), G92 (set_position), G28 (home) and any other move (forget).
+    """
+    def __init__(self, steps_per_unit = AXIS_STEPS_PER_UNIT[:3]):
+        self.decimals = [max(0, math.ceil(math.log10(5*steps))) for steps in steps_per_unit]
+        self.relative = False
+        self.position = [None, None, None]  # Printer position as last sent, None while unknown
+        self.residue = [0.0, 0.0, 0.0]      # Rounding carried over to the next relative move
+
+    def move(self, x = 0, y = 0, z = 0, code = b'G1'):
+        """
+        Returns the bytes line (without newline) of a move to (x, y, z), or a displacement by (x, y, z) in relative mode, or None if it would not move
+        """
+        words = []
+        for axis, value in enumerate((x, y, z)):
+            if self.relative:
+                value = value + self.residue[axis]
+                rounded = round(value, self.decimals[axis])
+                self.residue[axis] = value - rounded
+                if rounded == 0:
+                    continue
+                if self.position[axis] is not None:
+                    self.position[axis] = round(self.position[axis] + rounded, self.decimals[axis])
+            else:
+                rounded = round(value, self.decimals[axis])
+                if rounded == self.position[axis]:
+                    continue
+                self.position[axis] = rounded
+            words.append(b'XYZ'[axis:axis + 1] + format_number(rounded, self.decimals[axis]).encode())
+        return code + b' ' + b' '.join(words) if words else None
+
+    def set_position(self, x = None, y = None, z = None):
+        """
+        Sets the printer position after a G92 (None leaves an axis as it is)
+        """
+        for axis, value in enumerate((x, y, z)):
+            if value is not None:
+                self.position[axis] = round(value, self.decimals[axis])
+                self.residue[axis] = 0.0
+
+    def home(self, axes = 'X Y Z'):
+        """
+        Sets the homed axes to 0 after a G28
+        """
+        self.set_position(*[0 if axis in axes else None for axis in 'XYZ'])
+
+    def forget(self, axes = 'XYZ'):
+        """
+        Marks the position of axes as unknown, e.g. after a move the encoder did not write
+        """
+        for axis in axes:
+            self.position['XYZ'.index(axis)] = None
+
+class GCodeArrays(collections.namedtuple('GCodeArrays', ['command', 'params', 'position', 'feedrate', 'relative', 'channels'])):
+    """
+    Structured form of n GCode lines, one row per line (blank and comment lines excluded, as in Job.load):
+        command     (n,) bytes array of the command of the line as the firmware reads it, e.g. b'G1' or b'M3' (b'' if none)
+        params      (n, 9) float array of the X, Y, Z, E, I, J, F, S and P words (see PARAMS), NaN where the word is missing
+        position    (n, 4) float array of the absolute X, Y, Z and E position once the line is done
+        feedrate    (n,) float array of the feedrate in mm/min once the line is done
+        relative    (n,) bool array, True where relative coordinates (G91) are in effect once the line is done
+        channels    (n,) uint8 array of the channel status once the line is done, as a bitmask (bit 0 = channel 1, ...)
+    """
+    __slots__ = ()
+
+    def param(self, letter):
+        """
+        Returns the (n,) column of params for the word letter, e.g. gcode.param('X')
+        """
+        return self.params[:, PARAMS.index(letter)]
+
+class GCodeParser:
+    """
+    Vectorized GCode parser. parse turns a bytes buffer of complete lines into GCodeArrays with NumPy, without a Python loop over the lines or words, and keeps the modal state (coordinate mode, position, feedrate and channels) for the next buffer, so a file of any size can be parsed chunk by chunk. Lines are read as the firmware's interpreter does: the first G word is the command, or else the first M or T word, the first occurrence of a word counts, a word without a number reads as 0, and comments, checksums and line numbers are ignored. Letters are read case-insensitively. G0-G3 move (in absolute or relative coordinates), G28 homes the axes given (all if none) to 0, G92 sets the position and M3-M8 switch the channels. The printer starts at the origin in absolute coordinates with all channels off.
+    """
+    def __init__(self, feedrate = DEFAULT_FEEDRATE):
+        self.relative = False
+        self.position = np.zeros(4)
+        self.feedrate = float(feedrate)
+        self.channels = 0
+
+    def parse(self, data):
+        """
+        Returns the GCodeArrays of the lines in the bytes buffer data, and updates the modal state
+        """
+        text = COMMENT.sub(b'', bytes(data).upper().translate(SPACES))
+        buf = np.frombuffer(text, dtype = np.uint8)
+        # Spaces between a letter and its number are dropped (strtod skips them)
+        letter = (buf >= 65) & (buf <= 90)
+        space = buf == 32
+        last = np.where(space, -1, np.arange(len(buf)))
+        np.maximum.accumulate(last, out = last)
+        buf = buf[~(space & (last >= 0) & letter[last])]
+        # Row of every line, dropping the blank ones
+        newline = buf == 10
+        line = np.cumsum(newline) - newline
+        nonblank = np.bincount(line, weights = ~newline & (buf != 32), minlength = int(line[-1]) + 1 if len(line) else 0) > 0
+        rows = np.cumsum(nonblank) - 1
+        n = int(nonblank.sum())
+
+        # One token per word, each starting with its letter, and one b'\n' token per line break
+        letter = (buf >= 65) & (buf <= 90)
+        breaks = np.flatnonzero(letter | newline)
+        tokens = np.array(np.insert(buf, np.concatenate([breaks, np.flatnonzero(newline) + 1]), 32).tobytes().split(b' '))
+        token_line = np.cumsum(tokens == b'\n')
+        chars = tokens.view(np.uint8).reshape(len(tokens), -1)
+        letter = chars[:, 0]
+        word = (letter >= 65) & (letter <= 90)
+        token_row = rows[token_line[word]] if n else np.zeros(0, dtype = np.intp)
+        letter = letter[word]
+        number = np.zeros_like(chars[word])
+        number[:, :-1] = chars[word][:, 1:]
+        values = _numbers(number.view('S{}'.format(max(number.shape[1], 1))).ravel())
+
+        # The first occurrence of each word, with the command as the first G, else M, else T word
+        params = np.full([n, len(PARAMS)], np.nan)
+        for column, name in enumerate(PARAMS):
+            found = np.flatnonzero(letter == ord(name))[::-1]
+            params[token_row[found], column] = values[found]
+        kind = np.zeros(n, dtype = np.uint8)
+        code = np.full(n, -1, dtype = np.int64)
+        for name in 'TMG':
+            found = np.flatnonzero(letter == ord(name))[::-1]
+            kind[token_row[found]] = ord(name)
+            code[token_row[found]] = values[found].astype(np.int64)
+
+        def g(*codes):
+            return (kind == ord('G')) & np.isin(code, codes)
+        def m(*codes):
+            return (kind == ord('M')) & np.isin(code, codes)
+
+        # Modal state after every line
+        move = g(0, 1, 2, 3)
+        relative = fill_forward(g(90, 91), g(91), self.relative)
+        given = ~np.isnan(params[:, :4])
+        homed = g(28)[:, None] & (given | ~np.any(given[:, :3], axis = 1)[:, None])
+        homed[:, 3] = False
+        reset = (move[:, None] & given & ~relative[:, None]) | (g(92)[:, None] & given) | homed
+        values = np.where(homed, 0.0, params[:, :4])
+        delta = np.cumsum(np.where(move[:, None] & given & relative[:, None], params[:, :4], 0.0), axis = 0)
+        position = np.empty([n, 4])
+        for axis in range(4):
+            last = fill_forward(reset[:, axis], np.arange(n), -1)
+            position[:, axis] = np.where(last >= 0, values[last, axis] + delta[:, axis] - delta[last, axis], self.position[axis] + delta[:, axis])
+        f = params[:, PARAMS.index('F')]
+        feedrate = fill_forward(move & (f > 0), f, self.feedrate)
+        channels = np.zeros(n, dtype = np.uint8)
+        for channel in range(3):
+            on = fill_forward(m(3 + 2*channel, 4 + 2*channel), m(3 + 2*channel), bool(self.channels >> channel & 1))
+            channels |= on.astype(np.uint8) << channel
+
+        if n:
+            self.relative = bool(relative[-1])
+            self.position = position[-1].copy()
+            self.feedrate = float(feedrate[-1])
+            self.channels = int(channels[-1])
+        command = np.char.add(kind.view('S1'), np.where(code >= 0, code, 0).astype('S'))
+        command[kind == 0] = b''
+        return GCodeArrays(command, params, position, feedrate, relative, channels)
+
+    def sample(self, data, count):
+        """
+        Returns the GCodeArrays of about count evenly spaced lines of the bytes buffer data, each with the line before it, and of every line other than a G0/G1 move (with the line before it as well), and updates the modal state, like parse but much faster on long buffers. Only those lines and the last G line setting X, Y and Z before each of them are parsed, the lines in between are only scanned for their letters. The position (X, Y and Z) and channels of every line returned are exact, its E position and feedrate are not. Buffers in relative coordinates (G91), and buffers of fewer than 4*count lines, are parsed in full.
+        """
+        text = bytes(data)
+        buf = np.frombuffer(text.upper() + b'   ', dtype = np.uint8) # Padded, so the two characters after any number can be read
+        ends = np.flatnonzero(buf == 10)
+        n = len(ends)
+        if self.relative or n <= 4*count:
+            return self.parse(data)
+
+        # Everything after a ';' or '*' on a line is a comment or a checksum
+        cut = ends.copy()
+        marks = np.flatnonzero((buf == ord(';')) | (buf == ord('*')))
+        np.minimum.at(cut, np.searchsorted(ends, marks), marks)
+        # Position, line and letter of every G, M, T, X, Y and Z word
+        position = np.flatnonzero(((buf >= ord('X')) & (buf <= ord('Z'))) | (buf == ord('G')) | (buf == ord('M')) | (buf == ord('T')))
+        line = np.searchsorted(ends, position)
+        inside = position < cut[line]
+        position, line = position[inside], line[inside]
+        letter = buf[position]
+        def lines(name):
+            # Every line holding the word name, once each
+            found = line[letter == ord(name)]
+            return found[np.r_[True, found[1:] != found[:-1]]] if len(found) else found
+
+        # The number of every G word, skipping spaces and leading zeros as strtod does, tells a G0/G1 move from any other command
+        g, g_line = position[letter == ord('G')], line[letter == ord('G')]
+        digit = g + 1
+        for skipped in ([32, 9], [48]):
+            while True:
+                skip = np.isin(buf[digit], skipped)
+                if not skip.any():
+                    break
+                digit += skip
+        first, second, third = buf[digit], buf[digit + 1], buf[digit + 2]
+        numeric = lambda char: (char >= ord('0')) & (char <= ord('9'))
+        if np.any((first == ord('9')) & (second == ord('1')) & ~numeric(third)):
+            return self.parse(data) # Relative moves need every line
+        other = ((first >= ord('2')) & numeric(first)) | ((first == ord('1')) & (numeric(second) | (second == ord('.'))))
+        special = np.concatenate([g_line[other], line[(letter == ord('M')) | (letter == ord('T'))]])
+
+        anchors = np.unique(np.concatenate([np.linspace(0, n - 1, count).astype(np.intp), special, [n - 1]]))
+        anchors = np.union1d(anchors, anchors[anchors > 0] - 1)
+        moves = np.zeros(n, dtype = bool)
+        moves[g_line] = True
+        selected = [anchors]
+        for axis in 'XYZ':
+            setters = lines(axis)
+            setters = setters[moves[setters]]
+            last = np.searchsorted(setters, anchors, side = 'right') - 1
+            selected.append(setters[last[last >= 0]])
+        selected = np.unique(np.concatenate(selected))
+
+        # The lines setting the position of an anchor only keep the parser state right, they are not returned
+        starts = np.r_[0, ends[:-1] + 1]
+        pieces = [text[start:end + 1] for start, end in zip(starts[selected].tolist(), ends[selected].tolist())]
+        nonblank = cut[selected] - starts[selected] > np.array([len(piece) - len(piece.lstrip()) for piece in pieces])
+        gcode = self.parse(b''.join(pieces))
+        keep = np.isin(selected, anchors)[nonblank]
+        return GCodeArrays(*[field[keep] for field in gcode])
+
+def iter_gcode(source, chunk_size = 1 << 20, feedrate = DEFAULT_FEEDRATE, sample = None):
+    """
+    Generator yielding the GCodeArrays of source chunk by chunk, so memory use stays constant however long it is. source is a GCode file name, a bytes buffer, a Job or any iterable of GCode lines (str or bytes); chunks hold about chunk_size bytes of GCode. With sample = count only about count evenly spaced moves of every chunk, and the other commands, are returned (see GCodeParser.sample).
+    """
+    parser = GCodeParser(feedrate)
+    for data in _chunks(source, chunk_size):
+        yield parser.parse(data) if sample is None else parser.sample(data, sample)
+
+def parse_gcode(source, chunk_size = 1 << 20, feedrate = DEFAULT_FEEDRATE):
+    """
+    Returns the GCodeArrays of every line of source (as for iter_gcode), e.g.
+
+        gcode = parse_gcode('part.gcode')
+        extruding = gcode.position[gcode.channels != 0]
+    """
+    blocks = list(iter_gcode(source, chunk_size, feedrate)) or [GCodeParser(feedrate).parse(b'')]
+    return GCodeArrays(*[np.concatenate(field) for field in zip(*blocks)])
+
+def _chunks(source, chunk_size):
+    """
+    Yields source as bytes buffers of complete lines of about chunk_size bytes
+    """
+    if isinstance(source, str):
+        # The file is memory-mapped, so only the chunk being parsed is read
+        with open(source, 'rb') as gcode:
+            if os.fstat(gcode.fileno()).st_size == 0:
+                return
+            with mmap.mmap(gcode.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                yield from _chunks(data, chunk_size)
+    elif isinstance(source, (bytes, bytearray, mmap.mmap, memoryview)):
+        data = bytes(source) if isinstance(source, memoryview) else source
+        start = 0
+        while start < len(data):
+            cut = data.rfind(b'\n', start, start + chunk_size) + 1
+            if cut <= start:
+                cut = data.find(b'\n', start + chunk_size) + 1 or len(data)
+            chunk = data[start:cut]
+            yield chunk if chunk.endswith(b'\n') else chunk + b'\n'
+            start = cut
+    elif hasattr(source, 'compile'):
+        yield from _chunks(source.compile(), chunk_size)
+    else:
+        lines, size = [], 0
+        for line in source:
+            line = line if isinstance(line, bytes) else str.encode(str(line))
+            lines.append(line)
+            size += len(line) + 1
+            if size >= chunk_size:
+                yield b'\n'.join(lines) + b'\n'
+                lines, size = [], 0
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+def fill_forward(changed, values, initial):
+    """
+    Forward fill: returns for every row the value of the last row where changed is True (at or before it), or initial before the first one
+    """
+    last = np.where(changed, np.arange(len(changed)), -1)
+    np.maximum.accumulate(last, out = last)
+    return np.where(last >= 0, np.asarray(values)[last], initial) if len(last) else np.asarray(values)[:0]
+
+def _numbers(strings):
+    """
+    Converts a bytes array to floats as the firmware's strtod does: an empty or malformed number reads as its longest valid prefix, or 0
+    """
+    values = np.zeros(len(strings))
+    present = strings != b''
+    try:
+        values[present] = strings[present].astype(float)
+    except ValueError:
+        values[present] = [float(match.group()) if match else 0.0 for match in map(NUMBER.match, strings[present])]
+    return values
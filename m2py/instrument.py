@@ -0,0 +1,117 @@
+# M2PY -- Per-command timing of the serial transport: where the print time goes between the host and the firmware
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import collections
+import time
+import numpy as np
+
+# Commands the firmware only acknowledges once its planner is empty (st_synchronize)
+SYNC_COMMANDS = frozenset([b'G4', b'G28', b'M3', b'M4', b'M5', b'M6', b'M7', b'M8', b'M9', b'M400'])
+
+# Result of CommandLog.summary, times in s
+# latency_p50/latency_p99: time from writing a command to its 'ok'; rate: commands acknowledged per second; blocked: time send spent waiting for room or for an 'ok'; sync: time the firmware spent on the synchronizing commands (planner drains and channel delays)
+LogSummary = collections.namedtuple('LogSummary', ['commands', 'acked', 'resent', 'bytes', 'duration', 'rate', 'latency_p50', 'latency_p99', 'blocked', 'sync'])
+
+class CommandLog:
+    """
+    Records the timing of every command going through a Transport, in preallocated arrays used as a ring buffer of the last capacity commands: when the command was handed to send (enqueued), written to the serial port (written) and acknowledged with 'ok' (acked), in s since the log was created, along with its length in bytes, whether it is a synchronizing command (SYNC_COMMANDS) and how often it was resent. Recording a command costs a few array stores, so the log can stay on during production prints; a Transport without a log does no recording at all.
+
+    The firmware acknowledges a synchronizing command only after emptying its planner (and waiting for the channel delay after M3/M5/M7), so the time from the previous 'ok' to its own 'ok' is the time the print spent on it, summed up as sync by summary.
+    """
+    def __init__(self, capacity = 1 << 16):
+        self.capacity = int(capacity)
+        self.enqueued = np.full(self.capacity, np.nan)
+        self.written = np.full(self.capacity, np.nan)
+        self.acked = np.full(self.capacity, np.nan)
+        self.nbytes = np.zeros(self.capacity, dtype = np.int32)
+        self.sync = np.zeros(self.capacity, dtype = bool)
+        self.resent = np.zeros(self.capacity, dtype = np.uint8)
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every recorded command and restarts the clock
+        """
+        self.count = 0                      # Commands recorded so far, the id of the next one
+        self.blocked = 0.0                  # Total time in s send spent waiting for room or for an 'ok'
+        self.start = time.perf_counter()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def enqueue(self, cmd):
+        """
+        Records a command (bytes, without line number) handed to send and returns its id
+        """
+        i = self.count % self.capacity
+        self.enqueued[i] = time.perf_counter() - self.start
+        self.written[i] = np.nan
+        self.acked[i] = np.nan
+        self.nbytes[i] = 0
+        self.sync[i] = cmd.split(b' ', 1)[0] in SYNC_COMMANDS
+        self.resent[i] = 0
+        self.count += 1
+        return self.count - 1
+
+    def write(self, record, nbytes):
+        """
+        Records that the command record was written to the serial port as nbytes bytes
+        """
+        i = record % self.capacity
+        self.written[i] = time.perf_counter() - self.start
+        self.nbytes[i] = nbytes
+
+    def release(self, record):
+        """
+        Records that send returned for the command record, adding the time it spent waiting to blocked
+        """
+        if record >= self.count - self.capacity:
+            self.blocked += time.perf_counter() - self.start - float(self.enqueued[record % self.capacity])
+
+    def ack(self, record):
+        """
+        Records the 'ok' of the command record
+        """
+        if record >= self.count - self.capacity:
+            self.acked[record % self.capacity] = time.perf_counter() - self.start
+
+    def resend(self, record):
+        """
+        Records that the command record was written again after a 'Resend:' or a stall
+        """
+        if record >= self.count - self.capacity:
+            self.resent[record % self.capacity] += 1
+
+    def records(self):
+        """
+        Returns the recorded commands in the order they were sent as a dict of arrays: id, enqueued, written, acked (NaN until acknowledged), bytes, sync and resent
+        """
+        ids = np.arange(self.count - len(self), self.count)
+        i = ids % self.capacity
+        return {'id': ids, 'enqueued': self.enqueued[i], 'written': self.written[i], 'acked': self.acked[i], 'bytes': self.nbytes[i], 'sync': self.sync[i], 'resent': self.resent[i]}
+
+    def summary(self):
+        """
+        Returns a LogSummary of the recorded commands
+        """
+        r = self.records()
+        acked = ~np.isnan(r['acked'])
+        latency = (r['acked'] - r['written'])[acked]
+        duration = float(np.nanmax(r['acked']) - r['enqueued'][0]) if np.any(acked) else 0.0
+        # A synchronizing command starts once the command before it was acknowledged
+        previous = np.r_[np.nan, r['acked'][:-1]]
+        sync = r['sync'] & acked
+        sync_time = r['acked'][sync] - np.fmax(r['written'][sync], previous[sync])
+        return LogSummary(len(r['id']), int(acked.sum()), int(r['resent'].sum()), int(r['bytes'].sum()), duration, float(acked.sum() / duration) if duration > 0 else 0.0,
+                          float(np.percentile(latency, 50)) if len(latency) else np.nan, float(np.percentile(latency, 99)) if len(latency) else np.nan, self.blocked, float(sync_time.sum()))
+
+    def save(self, fid):
+        """
+        Writes the records to fid, as CSV if the name ends with .csv and as a NumPy .npz archive otherwise
+        """
+        r = self.records()
+        if str(fid).endswith('.csv'):
+            np.savetxt(fid, np.column_stack(list(r.values())), delimiter = ',', header = ','.join(r), comments = '', fmt = ['%d', '%.6f', '%.6f', '%.6f', '%d', '%d', '%d'])
+        else:
+            np.savez(fid, **r)
@@ -0,0 +1,184 @@
+# M2PY -- Recorded print jobs: generate a print path once, replay it to the printer or to a file many times
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import array
+import threading
+import time
+from transport import connect, BUFSIZE
+from gcode import read_gcode
+
+class Job:
+    """
+    A compiled print job. A Makergear created with printout = 2 records every command into its job instead of sending it, with the same coordinate, tool offset and channel handling as a live print. The lines are stored pre-encoded in a single bytes buffer (exactly the contents of the equivalent .gcode file), so playing a job back costs no Python formatting or encoding.
+    """
+    def __init__(self, lines = None):
+        self.buffer = bytearray()           # Every line followed by a newline
+        self.ends = array.array('q')        # Offset of the end of each line in buffer
+        for line in lines or []:
+            self.send(line)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __iter__(self):
+        start = 0
+        for end in self.ends:
+            yield bytes(self.buffer[start:end])
+            start = end + 1
+
+    def __getitem__(self, index):
+        start = self.ends[index - 1] + 1 if index > 0 else 0
+        return bytes(self.buffer[start:self.ends[index]])
+
+    # Transport interface used by Makergear while recording
+    def send(self, cmd):
+        """
+        Appends a single line of GCode (str or bytes, without the newline) to the job
+        """
+        if not isinstance(cmd, bytes):
+            cmd = str.encode(str(cmd))
+        self.buffer += cmd
+        self.ends.append(len(self.buffer))
+        self.buffer += b'\n'
+
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def compile(self):
+        """
+        Returns the whole job as a single bytes buffer of newline terminated GCode
+        """
+        return bytes(self.buffer)
+
+    def save(self, fid):
+        """
+        Writes the job to a .gcode file
+        """
+        with open(fid, 'wb') as gcode:
+            gcode.write(self.buffer)
+
+    @classmethod
+    def load(cls, fid):
+        """
+        Reads a job back from a GCode file, dropping comments and blank lines
+        """
+        job = cls()
+        for line, _ in read_gcode(fid):
+            job.send(line)
+        return job
+
+    def play(self, com, baud, stream = 'char', window = BUFSIZE - 1, checksum = False, verbose = True, log = None):
+        """
+        Streams the job to the printer on com (port name or opened serial-like object) and waits until every line is acknowledged. With log = CommandLog() the timing of every line is recorded in it.
+        """
+        if verbose: print('Connecting to {}'.format(com))
+        transport = connect(com, baud, stream = stream, window = window, checksum = checksum, log = log)
+        if verbose: print('Playing {} lines'.format(len(self)))
+        try:
+            Sender(transport, zip(self, range(1, len(self) + 1)), total = len(self), verbose = verbose).run()
+        finally:
+            transport.close()
+        if verbose: print('Job complete!\nSerial port closed')
+
+    def print_from_sd(self, com, baud, name = 'm2py.gco', stream = 'char', window = BUFSIZE - 1, checksum = False, poll = 5, verbose = True):
+        """
+        Uploads the job to the SD card of the printer on com, verifies it and prints it from the card (see sdcard.sd_upload), following the progress until the printer reaches the end of the file. Unlike play, the motion no longer depends on the host once the upload is done.
+        """
+        from sdcard import sd_upload, SDPrint
+        if verbose: print('Connecting to {}'.format(com))
+        transport = connect(com, baud, stream = stream, window = window, checksum = checksum)
+        try:
+            size = sd_upload(transport, self, name = name, verbose = verbose)
+            SDPrint(transport, size = size, poll = poll, verbose = verbose).start().join()
+        finally:
+            transport.close()
+        if verbose: print('Serial port closed')
+
+class Sender:
+    """
+    Streams (line, position) pairs to a Transport, printing the progress and estimated time left every progress seconds. total is the final position (e.g. file size or line count). pause, resume and abort can be called from another thread (e.g. a GUI) while run is sending; pausing only stops feeding new lines, so the moves already queued in the printer still finish.
+    """
+    def __init__(self, transport, lines, total = None, progress = 5, verbose = True):
+        self.transport = transport
+        self.lines = lines
+        self.total = total
+        self.progress = progress
+        self.verbose = verbose
+        self.sent = 0
+        self.position = 0
+        self.aborted = False
+        self.running = threading.Event()
+        self.running.set()
+        self.thread = None
+
+    def pause(self):
+        """
+        Stops sending new lines until resume is called
+        """
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def abort(self, emergency = False):
+        """
+        Stops sending. With emergency = True an M112 is sent right away, halting the printer immediately.
+        """
+        self.aborted = True
+        self.running.set()
+        if emergency:
+            self.transport.emergency_stop()
+
+    def run(self):
+        """
+        Sends every line and waits for the printer to acknowledge them. Returns False if the job was aborted.
+        """
+        start = time.time()
+        report = start + self.progress
+        for line, position in self.lines:
+            if not self.running.is_set():
+                if self.verbose: print('Paused after {} lines'.format(self.sent))
+                self.running.wait()
+            if self.aborted:
+                break
+            self.transport.send(line)
+            self.sent += 1
+            self.position = position
+            if self.verbose and time.time() >= report:
+                self.report(time.time() - start)
+                report = time.time() + self.progress
+        self.transport.drain()
+        if self.verbose and self.aborted: print('Aborted after {} lines'.format(self.sent))
+        return not self.aborted
+
+    def start(self, close = True):
+        """
+        Runs the sender in a background thread (closing the transport at the end if close = True) and returns immediately
+        """
+        def target():
+            try:
+                self.run()
+            finally:
+                if close:
+                    self.transport.close()
+        self.thread = threading.Thread(target = target, name = 'm2py-sender', daemon = True)
+        self.thread.start()
+        return self
+
+    def join(self, timeout = None):
+        """
+        Waits for a sender started with start to finish
+        """
+        self.thread.join(timeout)
+
+    def report(self, elapsed):
+        if self.total:
+            done = min(self.position / self.total, 1)
+            eta = elapsed*(1 - done)/done if done > 0 else 0
+            print('{:.1f}% sent ({} lines), {} left'.format(100*done, self.sent, time.strftime('%H:%M:%S', time.gmtime(eta))))
+        else:
+            print('{} lines sent'.format(self.sent))
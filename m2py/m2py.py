@@ -3,51 +3,120 @@
 # Author: Matthew Sorna [sorna@seas.upenn.edu]
 
 # Importing of necessary dependent modules
+import asyncio
+import functools
 import os
 import serial
-import time
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.patches as mpatches
+from transport import connect, handshake, BUFSIZE
+from cache import StateCache
+from job import Job, Sender
+from gcode import read_gcode, translate_gcode, format_number, MoveEncoder, GCodeParser, parse_gcode, iter_gcode
+from preview import PathRecorder, render_path, gcode_path, preview_gcode
+from timing import estimate_time, drain_report
+from optimize import merge_moves, merge_toggles, path_segments, schedule_tools, segments_job, schedule_path, order_travel
+from aio import connect_async
+from farm import Farm
+from sdcard import sd_upload, SDPrint
+from instrument import CommandLog
 
 # Module Function Definitions
 
 class Makergear:
-    def __init__(self, com, baud, printout = 0, verbose = True):
+    def __init__(self, com, baud, printout = 0, verbose = True, stream = 'off', window = BUFSIZE - 1, checksum = False, deadline = 10, cache = True, log = None):
+        self._init_state(com, baud, printout, verbose, cache)
+
+        if self.printout == 1:
+            if self.verbose: print('Connecting to {}'.format(self.com))
+            self.transport = connect(com, baud, stream = stream, window = window, checksum = checksum, deadline = deadline, log = log)
+            self.handle = self.transport.handle
+            if self.transport.state is not None: # Left by the previous script on a PrinterDaemon
+                self.set_state(self.transport.state)
+        elif self.printout == 0:
+            self.path = PathRecorder()
+        elif self.printout == 2:
+            self.job = Job()
+            self.transport = self.job
+
+    def _init_state(self, com, baud, printout, verbose, cache):
+        # Tracked printer state, shared with AsyncMakergear which connects on its own
         self.com = com
         self.baud = baud
         self.printout = printout
         self.verbose = verbose
-        self.fid = os.path.abspath('path_vis_temp.txt')
         self.channel_status = np.array([0,0,0])
         self.coords = np.array([0,0,0])
         self.current_tool = 1
         self.tool_coords = np.array([[0,0,0],[0,0,0],[0,0,0]])
+        self.current_coord_sys = 'abs'
+        self.cache = StateCache(strict = cache == 'strict', verbose = verbose) if cache else None
+        self.encoder = MoveEncoder()
 
-        if self.printout == 1:
-            self.handle = serial.Serial(com, baud, timeout = 1)
-            time.sleep(2) # Make sure to give it enough time to initialize
-            if self.verbose: print('Connecting to {}'.format(self.com))
-            for _ in range(21): # Reads in all 21 lines of initialization text for the M2
-                self.handle.readline()
-        elif self.printout == 0:
-            self.current_coord_sys = 'abs'
-            self.handle = open(self.fid, "w")
-
-    def close(self, zrange = [0, 203]):
+    def close(self, zrange = [0, 203], output = None):
         """
-        Closes the specified handle. If self.printout = 1, this function will close the necessary serial object. If prinout = 0, this function will close the specified temporary file and plot a visualization of all relevant movement commands. Visualization function will use whatever coordinate system you explicity designate using coord. If coord isn't explicitly called, the coordinate system used by the visualization tool will be absolute.
+        Closes the specified handle. If self.printout = 1, this function will close the necessary serial object. If printout = 2, the final commands are recorded and self.job is complete. If prinout = 0, this function will plot a visualization of all relevant movement commands recorded in self.path, or save it to output (e.g. 'path.png') if given. Visualization function will use whatever coordinate system you explicity designate using coord. If coord isn't explicitly called, the coordinate system used by the visualization tool will be absolute.
         """
         if self.printout == 1:
+            self._flush_cache()
             self.alloff()
             self.rotate(speed = 0)
             if self.verbose: print('Disconnecting from {}'.format(self.com))
-            self.handle.close()
+            self.transport.state = self.get_state()
+            self.transport.close()
+        elif self.printout == 2:
+            self._flush_cache()
+            self.alloff()
+            self.rotate(speed = 0)
         elif self.printout == 0:
-            self.handle.close()
-            self.path_vis(zrange)
-            os.remove(self.fid)
+            self.path_vis(zrange, output = output)
+
+    def get_state(self):
+        """
+        Returns the tracked printer state (coordinates, coordinate system, active tool, tool coordinates, channel status and the firmware state of the command cache) as a dict of plain lists
+        """
+        state = {'coords': np.asarray(self.coords).tolist(), 'coord_sys': self.current_coord_sys, 'tool': self.current_tool, 'tool_coords': np.asarray(self.tool_coords).tolist(), 'channels': np.asarray(self.channel_status).tolist()}
+        if self.cache is not None:
+            state['firmware'] = self.cache.state
+        return state
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state, without sending anything to the printer
+        """
+        self.coords = np.array(state['coords'])
+        self.current_coord_sys = state['coord_sys']
+        self.current_tool = state['tool']
+        self.tool_coords = np.array(state['tool_coords'])
+        self.channel_status = np.array(state['channels'])
+        # The printer position is not known to this process, so the next move is written out in full
+        self.encoder.relative = self.current_coord_sys == 'rel'
+        self.encoder.forget()
+        if self.cache is not None and 'firmware' in state:
+            self.cache.state = state['firmware']
+
+    def _send(self, cmd):
+        """
+        Sends a single line of GCode to the printer through the transport (or records it into self.job with printout = 2). With stream = 'off' this waits for the printer to answer 'ok', otherwise it only waits for room in the firmware's command buffer. Commands that would not change the firmware state are dropped by the cache (see StateCache).
+        """
+        if self.cache is not None:
+            cmd = self.cache.filter(cmd)
+            if cmd is None:
+                return
+        self.transport.send(cmd)
+
+    def _flush_cache(self):
+        """
+        Sends the feedrate held back by the cache, if any
+        """
+        cmd = self.cache.flush() if self.cache is not None else None
+        if cmd is not None:
+            self.transport.send(cmd)
+
+    def _channel_mask(self):
+        """
+        Returns the current channel status as a bitmask (bit 0 = channel 1, bit 1 = channel 2, bit 2 = channel 3)
+        """
+        return int(self.channel_status[0]) | int(self.channel_status[1]) << 1 | int(self.channel_status[2]) << 2
 
     # GCode wrappers
     # G0/G1
@@ -61,136 +130,73 @@ class Makergear:
             elif self.current_coord_sys == 'rel':
                 self.coords = self.coords + np.array([x, y, z])
 
-            if self.printout == 1:
+            if self.printout >= 1:
                 if self.verbose: print('Moving to ({}, {}, {})'.format(x, y, z))
-                self.handle.write(str.encode('G1 X{} Y{} Z{}\n'.format(x, y, z)))
-                read = self.handle.readline()
-                while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
-                while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
+                cmd = self.encoder.move(x, y, z)
+                if cmd is not None:
+                    self._send(cmd)
 
             elif self.printout == 0 and track == 1:
-                self.handle.write('{} {} {} {} {} {}\n'.format(x, y, z, self.channel_status[0], self.channel_status[1], self.channel_status[2]))
+                self.path.append(x, y, z, channels = self._channel_mask(), tool = self.current_tool, rel = self.current_coord_sys == 'rel')
         except:
-            self.handle.write(str.encode('M112\n'))
+            if self.printout != 1:
+                raise
+            self.transport.emergency_stop()
             self.close()
             raise ValueError('Emergency Stop! Turning off channels and disconnecting from {}'.format(self.com))
 
     # G2/G3
-    def arc(self, x = 0, y = 0, i = 0, j = 0, direction = 'ccw'):
-        r = np.sqrt((x - i)**2 + (y - j)**2)
-        start_ang = np.angle(i*-1 + j*-1j)
-        stop_ang = np.angle((x-i)*1 + (y-j)*1j)
-
-        if start_ang < 0:
-            start_ang = start_ang + 2*np.pi
-            if stop_ang > 0:
-                stop_ang = stop_ang + 2*np.pi
-
-        if stop_ang < 0:
-            stop_ang = stop_ang + 2*np.pi
-
-        if direction == 'ccw':
-            if stop_ang > start_ang:
-                dtheta = (stop_ang - start_ang)
-                s = int(np.ceil((r*dtheta)))
-                theta = np.linspace(start_ang, stop_ang, s)
-            elif start_ang > stop_ang:
-                stop_ang = stop_ang + 2*np.pi
-                dtheta = (stop_ang - start_ang)
-                s = int(np.ceil((r*dtheta)))
-                theta = np.linspace(start_ang, stop_ang, s)
-            elif start_ang == stop_ang:
-                stop_ang = stop_ang + 2*np.pi
-                dtheta = (stop_ang - start_ang)
-                s = int(np.ceil((r*dtheta)))
-                theta = np.linspace(start_ang, stop_ang, s)
-
-        elif direction == 'cw':
-            if stop_ang > start_ang:
-                dtheta = 2*np.pi - (stop_ang - start_ang)
-                s = int(np.ceil((r*dtheta)))
-                theta = np.flip(np.linspace(stop_ang, start_ang + 2*np.pi, s), axis = 0)
-            elif start_ang > stop_ang:
-                dtheta = (start_ang - stop_ang)
-                s = int(np.ceil((r*dtheta)))
-                theta = np.flip(np.linspace(stop_ang, start_ang, s), axis = 0)
-            elif start_ang == stop_ang:
-                stop_ang = stop_ang + 2*np.pi
-                dtheta = (stop_ang - start_ang)
-                s = int(np.ceil((r*dtheta)))
-                theta = np.flip(np.linspace(start_ang, stop_ang, s), axis = 0)
-
-        xpts = r*np.cos(theta)
-        ypts = r*np.sin(theta)
-
-        dxpts = np.array([])
-        dypts = np.array([])
-
-        for ii in range(s - 1):
-            dxpts = np.append(dxpts, xpts[ii+1] - xpts[ii])
-            dypts = np.append(dypts, ypts[ii+1] - ypts[ii])
-
+    def arc(self, x = 0, y = 0, i = 0, j = 0, direction = 'ccw', tolerance = None, native = False):
+        """
+        Moves in an arc to the point (x, y) around the center (i, j), both relative to the current position, with direction specified as 'cw' or 'ccw' (default 'ccw'). The arc is split into segments of about 1 mm, or into the fewest segments that stay within tolerance [mm] of the true arc. With native = True a single G2/G3 command is sent and the firmware generates the segments.
+        """
+        pts = arc_points(x, y, i, j, direction = direction, tolerance = tolerance)
+        start = np.array(self.coords, dtype = float)
         if self.current_coord_sys == 'abs':
-            current_coords = self.return_current_coords()
-            dxpts = dxpts + current_coords[0]
-            dypts = dypts + current_coords[1]
-            zpt = current_coords[2]
-            if self.printout == 1:
-                for jj in range(s-1):
-                    old_verbose = self.verbose
-                    self.verbose = False
-                    self.move(x = dxpts[jj], y = dypts[jj], z = zpt)
-                    self.verbose = old_verbose
-                if self.verbose: print('Moving in a {} arc to ({},{}) with center ({},{})'.format(direction, x,y,i,j))
-            elif self.printout == 0:
-                for jj in range(s-1):
-                    self.handle.write('{} {} {} {} {} {}\n'.format(dxpts[jj], dypts[jj], zpt, self.channel_status[0], self.channel_status[1], self.channel_status[2]))
-
+            xpts = (pts[1:, 0] + start[0]).tolist()
+            ypts = (pts[1:, 1] + start[1]).tolist()
+            zpts = [start[2]]*len(xpts)
         elif self.current_coord_sys == 'rel':
-            if self.printout == 1:
-                if self.verbose: print('Moving in a {} arc to ({},{}) with center ({},{})'.format(direction, x,y,i,j))
-                for jj in range(s-1):
-                    old_verbose = self.verbose
-                    self.verbose = False
-                    self.move(x = dxpts[jj], y = dypts[jj], z = 0)
-                    self.verbose = old_verbose
-            elif self.printout == 0:
-                for jj in range(s-1):
-                    self.handle.write('{} {} {} {} {} {}\n'.format(dxpts[jj], dypts[jj], 0, self.channel_status[0], self.channel_status[1], self.channel_status[2]))
+            xpts = np.diff(pts[:, 0]).tolist()
+            ypts = np.diff(pts[:, 1]).tolist()
+            zpts = [0]*len(xpts)
+        self.coords = start + np.array([x, y, 0])
+
+        if self.printout >= 1:
+            if self.verbose: print('Moving in a {} arc to ({},{}) with center ({},{})'.format(direction, x,y,i,j))
+            if native:
+                gcode = 'G2' if direction == 'cw' else 'G3'
+                end = [xpts[-1], ypts[-1]] if self.current_coord_sys == 'abs' else [x, y]
+                self._send('{} X{} Y{} I{} J{}'.format(gcode, end[0], end[1], i, j))
+                self.encoder.forget('XY')
+            else:
+                for cmd in [self.encoder.move(xp, yp, zp) for xp, yp, zp in zip(xpts, ypts, zpts)]:
+                    if cmd is not None:
+                        self._send(cmd)
+        elif self.printout == 0:
+            self.path.extend(np.column_stack([xpts, ypts, zpts]), channels = self._channel_mask(), tool = self.current_tool, rel = self.current_coord_sys == 'rel')
 
     def speed(self, speed = 0):
         """
         Sets the movement speed of the printer to the specified speed in [mm/s] (default 0 mm/sec)
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Setting movement speed to {} mm/s'.format(speed))
-            self.handle.write(str.encode('G1 F{}\n'.format(speed*60)))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
+            self._send('G1 F{}'.format(speed*60))
 
     def rotate(self, speed = 0):
             """
             Sets the rotation speed of the motor to the specified speed [0-127] (default 0)
             """
-            if self.printout == 1:
+            if self.printout >= 1:
                 if self.verbose: print('Setting rotation speed to {}'.format(int(speed)))
-                self.handle.write(str.encode('M9 S{}\n'.format(int(speed))))
-                read = self.handle.readline()
-                while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
+                self._send('M9 S{}'.format(int(speed)))
 
     def ramp(self, start = 0, stop = 0, seconds = 1):
             """
             Sets the rotation speed of the motor to the specified speed [0-127] (default 0 --> 0)
             """
-            if self.printout == 1:
+            if self.printout >= 1:
                 if self.verbose: print('Changing rotation from {} to {} in {} seconds'.format(int(start),int(stop), seconds))
                 diff = stop - start
                 steps = abs(stop - start)
@@ -198,38 +204,22 @@ class Makergear:
                     for i in range(steps):
                         if diff > 0:
                             dt = seconds / steps
-                            self.handle.write(str.encode('M9 S{}\n'.format(int(start + i))))
-                            read = self.handle.readline()
-                            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                                read = self.handle.readline()
-                                time.sleep(0.06)
+                            self._send('M9 S{}'.format(int(start + i)))
                         elif diff < 0:
                             dt = seconds / steps
-                            self.handle.write(str.encode('M9 S{}\n'.format(int(start - i))))
-                            read = self.handle.readline()
-                            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                                read = self.handle.readline()
-                                time.sleep(0.06)
+                            self._send('M9 S{}'.format(int(start - i)))
 
 
-                        self.handle.write(str.encode('G4 S{}\n'.format(dt)))
-                        read = self.handle.readline()
-                        while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                                read = self.handle.readline()
-                                time.sleep(0.06)
+                        self._send('G4 S{}'.format(dt))
 
     # G4
     def wait(self, seconds = 0):
         """
         Waits for the specified amount of time (default 0 seconds)
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Waiting for {} seconds'.format(seconds))
-            self.handle.write(str.encode('G4 S{}\n'.format(seconds)))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
+            self._send('G4 S{}'.format(seconds))
 
     # G28
     def home(self, axes = 'X Y Z'):
@@ -245,13 +235,10 @@ class Makergear:
             elif split_axes[i] == 'Z':
                 self.coords[2] = 0
 
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Homing {} axes'.format(axes))
-            self.handle.write(str.encode('G28 {}\n'.format(axes)))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
+            self._send('G28 {}'.format(axes))
+            self.encoder.home(axes)
 
     # G90/G91
     def coord_sys(self, coord_sys = 'abs'):
@@ -260,22 +247,15 @@ class Makergear:
         """
         self.current_coord_sys = coord_sys
 
-        if self.printout == 1:
+        if self.printout >= 1:
+            self.encoder.relative = self.current_coord_sys == 'rel'
             if self.current_coord_sys == 'abs':
                 if self.verbose: print('Setting to absolute coordinates')
-                self.handle.write(str.encode('G90\n'))
-                read = self.handle.readline()
-                while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
+                self._send('G90')
 
             elif self.current_coord_sys == 'rel':
                 if self.verbose: print('Setting to relative coordinates')
-                self.handle.write(str.encode('G91\n'))
-                read = self.handle.readline()
-                while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
+                self._send('G91')
 
     # G92
     def set_current_coords(self, x = 0, y = 0, z = 0):
@@ -285,13 +265,10 @@ class Makergear:
         old_coords = self.coords
         self.coords = [x, y, z]
 
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Changing current position at ({}, {}, {}) to ({}, {}, {})'.format(old_coords[0], old_coords[1], old_coords[2], x, y, z))
-            self.handle.write(str.encode('G92 X{} Y{} Z{}\n'.format(x, y, z)))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
+            self._send('G92 X{} Y{} Z{}'.format(x, y, z))
+            self.encoder.set_position(x, y, z)
 
     def return_current_coords(self):
         """
@@ -308,111 +285,66 @@ class Makergear:
             self.close()
             raise ValueError('Attempting to set heated bed to temperature above upper limit [100C]')
         
-        if self.printout == 1:
+        if self.printout >= 1:
             if wait == 'off':
-                self.handle.write(str.encode('M140 S{}\n'.format(temp)))
+                self._send('M140 S{}'.format(temp))
                 if self.verbose: print('Setting bed temp to {}C'.format(temp))
             elif wait == 'on':
-                self.handle.write(str.encode('M190 S{}\n'.format(temp)))
+                self._send('M190 S{}'.format(temp))
                 if self.verbose: print('Setting bed temp to {}C and waiting!'.format(temp))
 
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                    read = self.handle.readline()
-                    time.sleep(0.06)
-
     # M2PCS SPECIFIC FUNCTIONS
     def allon(self):
         """
         Turns pneumatic CHANNEL 1, 2, 3 ON
         """
-        if self.prinout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Turning all channels on')
-            self.handle.write(str.encode('M3\n'))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-            self.handle.write(str.encode('M5\n'))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-            self.handle.write(str.encode('M7\n'))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-        elif self.printout == 0:
-            self.channel_status = np.array([1,1,1])
+            self._send('M3')
+            self._send('M5')
+            self._send('M7')
+        self.channel_status = np.array([1,1,1])
 
     def alloff(self):
         """
         Turns pneumatic CHANNEL 1, 2, 3 OFF
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Turning all channels off')
-            self.handle.write(str.encode('M4\n'))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-            self.handle.write(str.encode('M6\n'))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-            self.handle.write(str.encode('M8\n'))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-        elif self.printout == 0:
-            self.channel_status = np.array([0,0,0])
+            self._send('M4')
+            self._send('M6')
+            self._send('M8')
+        self.channel_status = np.array([0,0,0])
 
     # M3/M5/M7
     def on(self, channel):
         """
         Turns pneumatic CHANNEL ON
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Turning on channel {}'.format(channel))
-            schannel = 'M{}\n'.format(channel*2 + 1)
-            self.handle.write(str.encode(schannel))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-        elif self.printout == 0:
-            self.channel_status[channel - 1] = 1
+            schannel = 'M{}'.format(channel*2 + 1)
+            self._send(schannel)
+        self.channel_status[channel - 1] = 1
 
     # M4/M6/M8
     def off(self, channel):
         """
         Turns pneumatic CHANNEL OFF
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Turning off channel {}'.format(channel))
-            schannel = 'M{}\n'.format(channel*2 + 2)
-            self.handle.write(str.encode(schannel))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
-        elif self.printout == 0:
-            self.channel_status[channel - 1] = 0
+            schannel = 'M{}'.format(channel*2 + 2)
+            self._send(schannel)
+        self.channel_status[channel - 1] = 0
 
     def set_channel_delay(self, delay = 50):
         """
         Sets the delay time (in ms) between a channel turning on and the execution of another command. Can be used to fine tune under extrusion effects, depending on ink viscosity.
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             if self.verbose: print('Setting channel delay to {} ms'.format(delay))
-            self.handle.write(str.encode('M50 S{}\n'.format(delay)))
-            read = self.handle.readline()
-            while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                read = self.handle.readline()
-                time.sleep(0.06)
+            self._send('M50 S{}'.format(delay))
 
     def set_tool_coords(self, tool = 1, x = 0, y = 0, z = 0):
         """
@@ -426,7 +358,7 @@ class Makergear:
         """
         This subroutine automatically turns off all channels, and performs a predetermined z translation of z = change_height, and then moves (x,y) = (dx, dy) to allow for change between multiple nozzles. It also automatically lowers back to the z height it was at previously, continuing printing after switching active tools
         """
-        if self.printout == 1:
+        if self.printout >= 1:
             old_tool = self.current_tool
             if self.verbose: print('Changing from tool {} to tool {}'.format(old_tool, change_to))
             self.alloff()
@@ -438,116 +370,147 @@ class Makergear:
             self.current_tool = change_to
             self.coord_sys(coord_sys = old_coord_sys)
             self.set_current_coords(x = old_coords[0], y = old_coords[1], z = old_coords[2])
+        elif self.printout == 0:
+            self.current_tool = change_to
 
-    def path_vis(self, zrange):
+    def sd_print(self, job, name = 'm2py.gco', poll = 5, wait = True):
+        """
+        Uploads job (a Job or a GCode file name) to the SD card of the printer as the file name (8.3), verifies it and prints it from the card, so the motion no longer depends on the host keeping up. Returns the SDPrint following the progress; with wait = True this only returns once the printer reached the end of the file. The position and firmware state are unknown afterwards, so the next absolute move sends every axis.
         """
-        Takes the (x, y, z) coordinates generated from mp.mopen(printout = 0), and plots them into a 3D line graph to check a print path before actually sending commands to the Makergear. Visualization function will use whatever coordinate system you explicity designate using coord. If coord isn't explicitly called, the coordinate system used by the visualization tool will be absolute. When using path_vis, the file directory of the path coordinates needs to be explicity set, unlike when it is implictly called inside mclose.
+        if self.printout == 1:
+            if not isinstance(job, Job):
+                job = Job.load(job)
+            self._flush_cache()
+            size = sd_upload(self.transport, job, name = name, verbose = self.verbose)
+            sd = SDPrint(self.transport, size = size, poll = poll, verbose = self.verbose).start()
+            if wait:
+                sd.join()
+            if self.cache is not None:
+                self.cache.reset()
+            self.encoder.forget()
+            return sd
+
+    def path_vis(self, zrange = [0, 203], budget = 100000, output = None, layer = None, zslice = None, moves = None):
+        """
+        Takes the (x, y, z) coordinates recorded in self.path with printout = 0, and plots them into a 3D line graph to check a print path before actually sending commands to the Makergear. Extrusions are colored by channel and travel moves are dotted. Only the moves ending on the given layer index (or (first, last) range of layers), inside zslice = (zmin, zmax) or inside the move index window moves = (start, stop) are drawn when those are given. Paths with more than budget points are simplified before drawing. If output is a file name (e.g. 'path.png' or 'path.svg') the plot is saved there instead of being shown.
         """
         if self.verbose: print('Generating path visualization')
-        coord_array = np.zeros([1, 3])
-        channel_array = np.zeros([1, 3])
-
-        if self.current_coord_sys == 'abs':
-            with open(self.fid, "r") as data:
-                for line in data:
-                    raw = line.split(' ')
-                    coords = [float(raw[0]), float(raw[1]), float(raw[2])]
-                    channels = [float(raw[3]), float(raw[4]), float(raw[5])]
-                    coord_array = np.append(coord_array, [coords[0], coords[1], coords[2]])
-                    channel_array = np.append(channel_array, [channels[0], channels[1], channels[2]])
-            coord_array.shape = (int(len(coord_array)/3), 3)
-
-        elif self.current_coord_sys == 'rel':
-            old_coords = [0,0,0]
-            with open(self.fid, "r") as data:
-                for line in data:
-                    raw = line.split(' ')
-                    coords = [float(raw[0]), float(raw[1]), float(raw[2])]
-                    channels = [float(raw[3]), float(raw[4]), float(raw[5])]
-                    coord_array = np.append(coord_array, [coords[0] + old_coords[0], coords[1] + old_coords[1], coords[2] + old_coords[2]])
-                    old_coords =  [coords[0] + old_coords[0], coords[1] + old_coords[1], coords[2] + old_coords[2]]
-                    channel_array = np.append(channel_array, [channels[0], channels[1], channels[2]])
-            coord_array.shape = (int(len(coord_array)/3), 3)
-
-        channel_array.shape = (int(len(channel_array)/3), 3)
-        num_moves = channel_array.shape[0]
-
-        ch_split_index = np.array([])
-        for i in range(num_moves-1):
-            if np.array_equal(channel_array[i,:], channel_array[i+1,:]) == False:
-                ch_split_index = np.append(ch_split_index, i+1)
-
-        x_coord = coord_array[:,0]
-        y_coord = coord_array[:,1]
-        z_coord = coord_array[:,2]
-        ch_split_index = ch_split_index.astype(int)
-
-        start_pt = [x_coord[0], y_coord[0], z_coord[0]]
-        end_pt = [x_coord[-1], y_coord[-1], z_coord[-1]]
-
-        x_split = np.split(x_coord, ch_split_index)
-        y_split = np.split(y_coord, ch_split_index)
-        z_split = np.split(z_coord, ch_split_index)
-        ch_split = np.split(channel_array, ch_split_index)
-        num_lines = len(x_split)
-
-        for j in range(num_lines - 1):
-            x_split[j+1] = np.insert(x_split[j+1], 0, x_split[j][-1])
-            y_split[j+1] = np.insert(y_split[j+1], 0, y_split[j][-1])
-            z_split[j+1] = np.insert(z_split[j+1], 0, z_split[j][-1])
-
-        xmin = np.min(x_coord)
-        xmax = np.max(x_coord)
-        ymin = np.min(y_coord)
-        ymax = np.max(y_coord)
-        zmax = np.max(z_coord)
-
-        xymax = (xmax>=ymax)*xmax + (ymax>xmax)*ymax
-        xymin = (xmin<=ymin)*ymin + (ymin<xmin)*ymin
-
-        fig = plt.figure()
-        ax = fig.gca(projection=Axes3D.name)
-
-        ax.set_xlim3d(xymin, xymax)
-        ax.set_ylim3d(xymin, xymax)
-
-        if zrange == 'fit':
-            ax.set_zlim3d(0, zmax)
+        if layer is None and zslice is None and moves is None:
+            xyz, channels = self.path.xyz, self.path.channels
         else:
-            ax.set_zlim3d(zrange[0], zrange[1])
-
-        ax.set_xlabel('X axis [mm]')
-        ax.set_ylabel('Y axis [mm]')
-        ax.set_zlabel('Z axis [mm]')
-
-        for k in range(num_lines):
-
-            if np.array_equal(ch_split[k][0], [0, 0, 0]):
-                cstr = '#484848'
-                linestyle = ':'
-            elif np.array_equal(ch_split[k][0], [1, 0, 0]):
-                cstr = '#0000ff'
-                linestyle = '-'
-            elif np.array_equal(ch_split[k][0], [0, 1, 0]):
-                cstr = '#00ff00'
-                linestyle = '-'
-            elif np.array_equal(ch_split[k][0], [0, 0, 1]):
-                cstr = '#ff0000'
-                linestyle = '-'
-            ax.plot(x_split[k], y_split[k], z_split[k], color = cstr, linewidth = 2, linestyle = linestyle)
-
-        ch1_patch = mpatches.Patch(color='#0000ff', label='Channel 1')
-        ch2_patch = mpatches.Patch(color='#00ff00', label='Channel 2')
-        ch3_patch = mpatches.Patch(color='#ff0000', label='Channel 3')
-        ax.scatter(start_pt[0], start_pt[1], start_pt[2], c='#7E7C66', marker='o')
-        ax.scatter(end_pt[0], end_pt[1], end_pt[2], c='k', marker='o')
-        plt.legend(handles=[ch1_patch, ch2_patch, ch3_patch], loc = 'best')
-        plt.title('M2PCS Print Path Visualization')
-        plt.show()
+            xyz, channels = self.path.select(layer = layer, zslice = zslice, moves = moves)
+        return render_path(xyz, channels, zrange = zrange, budget = budget, output = output)
+
 
+def _acknowledged(method):
+    """
+    Wraps a Makergear command for AsyncMakergear: the commands it generates are queued right away, and the returned Future resolves once the printer acknowledged the last of them
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        submitted = self.transport.submitted
+        method(self, *args, **kwargs)
+        if self.transport.submitted > submitted:
+            return self.transport.last
+        done = self.transport.loop.create_future()
+        done.set_result(None)
+        return done
+    return wrapper
+
+class AsyncMakergear(Makergear):
+    """
+    Makergear for asyncio, with the same command surface. Create it with await AsyncMakergear.connect(com, baud). Every command (move, arc, on, off, rotate, home, set_bed_temp, ...) queues its GCode immediately, in call order, and returns a Future that resolves when the printer acknowledges it, so awaiting each command waits for the printer while commands issued without awaiting are streamed with up to window lines in flight. Coordinates and tool offsets are tracked exactly as in Makergear.
+    """
+    def __init__(self, transport, verbose = True, cache = True):
+        self._init_state(transport.handle, None, 1, verbose, cache)
+        self.transport = transport
+        self.handle = transport.handle
+
+    @classmethod
+    async def connect(cls, com, baud, verbose = True, stream = 'char', window = BUFSIZE - 1, checksum = False, deadline = 10, cache = True):
+        """
+        Connects to the printer on com (port name or opened serial-like object) without blocking the event loop and returns the AsyncMakergear
+        """
+        if verbose: print('Connecting to {}'.format(com))
+        transport = await connect_async(com, baud, stream = stream, window = window, checksum = checksum, deadline = deadline)
+        mk = cls(transport, verbose = verbose, cache = cache)
+        mk.com, mk.baud = com, baud
+        return mk
+
+    def _send(self, cmd):
+        if self.cache is not None:
+            cmd = self.cache.filter(cmd)
+            if cmd is None:
+                return
+        self.transport.submit(cmd)
+
+    def close(self):
+        """
+        Turns every channel and the motor off, waits for the printer to acknowledge everything and closes the serial port. Returns an awaitable.
+        """
+        if self.cache is not None and self.cache.pending is not None:
+            self.transport.submit(self.cache.flush())
+        self.alloff()
+        self.rotate(speed = 0)
+        if self.verbose: print('Disconnecting from {}'.format(self.com))
+        return asyncio.ensure_future(self.transport.close())
+
+    async def drain(self):
+        """
+        Waits until every command issued so far has been acknowledged
+        """
+        await self.transport.drain()
+
+    move = _acknowledged(Makergear.move)
+    arc = _acknowledged(Makergear.arc)
+    speed = _acknowledged(Makergear.speed)
+    rotate = _acknowledged(Makergear.rotate)
+    ramp = _acknowledged(Makergear.ramp)
+    wait = _acknowledged(Makergear.wait)
+    home = _acknowledged(Makergear.home)
+    coord_sys = _acknowledged(Makergear.coord_sys)
+    set_current_coords = _acknowledged(Makergear.set_current_coords)
+    set_bed_temp = _acknowledged(Makergear.set_bed_temp)
+    allon = _acknowledged(Makergear.allon)
+    alloff = _acknowledged(Makergear.alloff)
+    on = _acknowledged(Makergear.on)
+    off = _acknowledged(Makergear.off)
+    set_channel_delay = _acknowledged(Makergear.set_channel_delay)
+    change_tool = _acknowledged(Makergear.change_tool)
+
+
+def arc_points(x = 0, y = 0, i = 0, j = 0, direction = 'ccw', tolerance = None):
+    """
+    Returns an (n, 2) array of points along the arc from (0, 0) to (x, y) around the center (i, j), direction 'cw' or 'ccw'. Without a tolerance the arc is split into segments of about 1 mm, otherwise into the fewest segments whose chord error stays below tolerance [mm], and at least one segment per half turn. A full circle is drawn when the end point equals the start point.
+    """
+    r = np.hypot(x - i, y - j)
+    start_ang = np.arctan2(-j, -i)
+    sweep = np.mod(np.arctan2(y - j, x - i) - start_ang, 2*np.pi)
+    if direction == 'ccw':
+        sweep = sweep if sweep > 0 else 2*np.pi
+    elif direction == 'cw':
+        sweep = sweep - 2*np.pi if sweep > 0 else -2*np.pi
+    else:
+        raise ValueError('Unknown arc direction {}, use \'cw\' or \'ccw\''.format(direction))
+
+    if tolerance is None:
+        segments = int(np.ceil(r*abs(sweep))) - 1
+    elif tolerance >= r:
+        # Any chord is within tolerance, a half turn is the longest arc a single segment can stand for
+        segments = int(np.ceil(abs(sweep) / np.pi - 1e-9))
+    else:
+        segments = int(np.ceil(abs(sweep) / (2*np.arccos(1 - tolerance/r))))
+    theta = start_ang + np.linspace(0, sweep, max(segments, 1) + 1)
+
+    pts = np.empty([len(theta), 2])
+    pts[:, 0] = i + r*np.cos(theta)
+    pts[:, 1] = j + r*np.sin(theta)
+    pts[0] = [0, 0]
+    pts[-1] = [x, y]
+    return pts
 
 #Additional functions outside of the M2 CLASS
-def prompt(com, baud):
+def prompt(com, baud, deadline = 10):
     """
     Allows for quick, native GCode serial communication with the M2, provided that the proper com port and baud rate are selected, and match what is found in system settings. To exit the command prompt environment, just type exit in the IPython console.
     """
@@ -555,11 +518,10 @@ def prompt(com, baud):
     cmd = ''
     #Create and define serial port parameters
     handle = serial.Serial(com, baud, timeout = 0)
-    time.sleep(2) # Make sure to give it enough time to initialize
+    handshake(handle, deadline = deadline) # Returns as soon as the printer is ready
     print("Enter a GCode command. To exit, type \'exit\'")
     handle.write(str.encode('M17\n'))
-    x = y = z = 0
-    xval = yval = zval = 0
+    parser = GCodeParser() # Follows the position through G90/G91, G92 and G28
     while escape == 0:
         cmd = input('>> ')
         if cmd == 'exit':
@@ -568,48 +530,27 @@ def prompt(com, baud):
             escape = 1
         else:
             handle.write(str.encode('{}\n'.format(cmd)))
-            if cmd =='G28':
-                x = y = z = 0
-                xval = yval = zval = 0
-            cmd_split = cmd.split(' ')
-            for a in cmd_split:
-                xchar = a.split('X')
-                ychar = a.split('Y')
-                zchar = a.split('Z')
-                if xchar[0] == '' and len(xchar) > 1 and xchar[1] != '':
-                    xval = float(xchar[1])
-                    x = x + xval
-                if ychar[0] == '' and len(ychar) > 1 and ychar[1] != '':
-                    yval = float(ychar[1])
-                    y = y + yval
-                if zchar[0] == '' and len(zchar) > 1 and zchar[1] != '':
-                    zval = float(zchar[1])
-                    z = z + zval
-            print('Currently at ({}, {}, {})'.format(x, y, z))
-
-def file_read(fid, com, baud, dx, dy):
+            parser.parse(str.encode('{}\n'.format(cmd)))
+            print('Currently at ({}, {}, {})'.format(*[format_number(value) for value in parser.position[:3]]))
+
+def file_read(fid, com, baud, dx = 0, dy = 0, stream = 'char', window = BUFSIZE - 1, checksum = False, progress = 5, background = False, verbose = True, deadline = 10, log = None):
     """
-    Reads in a text file of GCode line by line, and waits for the M2 to acknowledge that it received the command before sending another, maintaining print accuracy.
+    Streams a text file of GCode to the M2, keeping up to window commands in flight (see Makergear for the stream and checksum modes). The file is read in chunks with comments and blank lines removed, so files of any size use constant memory, and the progress with an estimated time left is printed every progress seconds. Every line, M commands included, is acknowledged by the printer before the print is considered complete. With background = True the print runs in a separate thread and the Sender is returned, whose pause, resume and abort methods control the print. With log = CommandLog() the timing of every line is recorded in it. The absolute X and Y coordinates of the file are shifted by dx and dy (see translate_gcode). A print stopped with Ctrl+C is aborted and reported as such.
     """
-    #Create and define serial port parameters
-    handle = serial.Serial(com, baud, timeout = 100)
-    time.sleep(2) # Make sure to give it enough time to initialize
-
-    print('Serial port initialized')
-    for _ in range(21): # Reads in all 21 lines of initalization text for the M2
-        handle.readline()
-    print('Beginning print')
-    with open(fid, "r") as gcode:
-        for line in gcode:
-            split_line = line.split(';') # chops off comments
-            if split_line[0] != '':      # makes sure it's not a comment-only line of GCode
-                handle.write(str.encode('{}\n'.format(split_line[0]))) #Reads in text file (GCode) line by line and sends commands to M2
-                print(split_line[0])
-                read = handle.readline()
-                if split_line[0][0] != 'M':
-                    while read[0:2] != b'ok': #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
-                        read = handle.readline()
-
-    time.sleep(2)
-    print('Print complete!\nSerial port closed')
-    handle.close() #Closes serial port
\ No newline at end of file
+    transport = connect(com, baud, stream = stream, window = window, checksum = checksum, deadline = deadline, log = log)
+    if verbose: print('Serial port initialized')
+    lines = read_gcode(fid)
+    if dx or dy:
+        lines = translate_gcode(lines, dx, dy)
+    sender = Sender(transport, lines, total = os.path.getsize(fid), progress = progress, verbose = verbose)
+    if verbose: print('Beginning print')
+    if background:
+        return sender.start()
+    try:
+        complete = sender.run()
+    except KeyboardInterrupt:
+        sender.abort()
+        complete = False
+    finally:
+        transport.close() #Closes serial port
+    if verbose: print('{}\nSerial port closed'.format('Print complete!' if complete else 'Print aborted'))
@@ -0,0 +1,493 @@
+# M2PY -- Optimization passes over recorded print jobs
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import math
+import re
+from collections import namedtuple
+import numpy as np
+from job import Job
+from gcode import format_number
+from timing import estimate_time, drain_report, DEFAULT_FEEDRATE
+
+WORD = re.compile(rb'([A-Z])\s*(-?\d*\.?\d*)')
+
+def _words(line):
+    """
+    Returns the words of a GCode line as a dict of letter: float, or None if a letter is repeated or a value is missing. The axes of a G28 may be given without a value (G28 X Y Z, as Makergear.home sends it), they read as None.
+    """
+    words = {}
+    for letter, value in WORD.findall(line.split(b';')[0].upper()):
+        letter = letter.decode()
+        if letter in words:
+            return None
+        words[letter] = None if value in (b'', b'-', b'.', b'-.') else float(value)
+    if any(value is None and not (letter in 'XYZ' and words.get('G') == 28) for letter, value in words.items()):
+        return None
+    return words
+
+def _is_move(words):
+    """
+    Returns True if words are those of a plain G0/G1 move, with nothing but X, Y, Z and F words
+    """
+    return words is not None and words.get('G') in (0, 1) and set(words) <= set('GXYZF') and bool(set(words) & set('XYZ'))
+
+def _track(words, position, relative):
+    """
+    Returns the position and coordinate mode (relative = True after G91) once the line with words was executed
+    """
+    if not words or 'G' not in words:
+        return position, relative
+    g = int(words['G'])
+    position = list(position)
+    if g in (90, 91):
+        relative = g == 91
+    elif g == 92:
+        for i, axis in enumerate('XYZ'):
+            if axis in words:
+                position[i] = words[axis]
+    elif g == 28:
+        # Homes the axes given (all if none) to 0, as GCodeParser does
+        for i, axis in enumerate('XYZ'):
+            if axis in words or not set(words) & set('XYZ'):
+                position[i] = 0.0
+    elif g in (0, 1, 2, 3):
+        for i, axis in enumerate('XYZ'):
+            if axis in words:
+                position[i] = words[axis] + (position[i] if relative else 0)
+    return position, relative
+
+def merge_moves(job, tolerance = 1e-3):
+    """
+    Returns an optimized copy of job and a dict of statistics. Consecutive G0/G1 moves in the same direction are merged into a single move, and moves shorter than tolerance [mm] are dropped. In relative mode the displacement of dropped moves is carried over to the next move written, so the printer never ends up more than tolerance away from where the job would have taken it. Only moves that directly follow each other are merged, so channel, tool, motor and feedrate changes (which are separate commands) are never moved. Every point of a merged move lies within 2*tolerance of the new, longer move.
+    """
+    optimized = Job()
+    stats = {'before': len(job), 'merged': 0, 'dropped': 0}
+    position = [0.0, 0.0, 0.0]  # Printer position after the lines written so far
+    intended = [0.0, 0.0, 0.0]  # Position the original job would have reached, ahead of position by the dropped relative moves
+    relative = False
+    run = None  # Moves being merged: [G word, start, end, unit direction, feedrate, axes, first line (None if rewritten), count]
+
+    def flush():
+        if run is None:
+            return
+        g, start, end, _, feed, axes, line, count = run
+        if count == 1 and line is not None:
+            optimized.send(line)
+            return
+        values = [b - a for a, b in zip(start, end)] if relative else end
+        words = ['G{}'.format(g)] + ['{}{}'.format(axis, format_number(values[i])) for i, axis in enumerate('XYZ') if axis in axes]
+        if feed is not None:
+            words.append('F{}'.format(format_number(feed)))
+        optimized.send(' '.join(words))
+        stats['merged'] += count - 1
+
+    for line in job:
+        words = _words(line)
+        if not _is_move(words):
+            # Anything but a plain move ends the run
+            flush()
+            run = None
+            optimized.send(line)
+            moved, relative = _track(words, position, relative)
+            if moved != position or not relative:
+                intended = moved
+            position = moved
+            continue
+
+        if relative:
+            target = [intended[i] + words.get(axis, 0.0) for i, axis in enumerate('XYZ')]
+        else:
+            target = [words[axis] if axis in words else position[i] for i, axis in enumerate('XYZ')]
+        delta = [b - a for a, b in zip(position, target)]
+        length = math.sqrt(sum(d*d for d in delta))
+        g, feed = int(words['G']), words.get('F')
+        if relative:
+            intended = target
+        if length <= tolerance and feed is None:
+            stats['dropped'] += 1
+            continue
+        carried = relative and any(abs(d - words.get(axis, 0.0)) > 1e-9 for d, axis in zip(delta, 'XYZ'))
+        axes = set(words) & set('XYZ') | ({axis for d, axis in zip(delta, 'XYZ') if d != 0} if carried else set())
+
+        if run is not None and run[0] == g and (feed is None or feed == run[4]) and length > tolerance:
+            # Same direction as the run: the new end point is within tolerance of the run's line, further along it
+            offset = [b - a for a, b in zip(run[1], target)]
+            along = sum(o*u for o, u in zip(offset, run[3]))
+            across = math.sqrt(max(sum(o*o for o in offset) - along*along, 0))
+            if along > sum((e - s)*u for s, e, u in zip(run[1], run[2], run[3])) and across <= tolerance:
+                run[2] = target
+                run[5] |= axes
+                run[7] += 1
+                position = target
+                continue
+        flush()
+        run = [g, position, target, [d / length for d in delta] if length > 0 else [0.0, 0.0, 0.0], feed, axes, None if carried else line, 1]
+        position = target
+    flush()
+    stats['after'] = len(optimized)
+    return optimized, stats
+
+def merge_toggles(job, tolerance = 1e-6, feedrate = DEFAULT_FEEDRATE):
+    """
+    Returns a copy of job with fewer channel commands, and a dict of statistics. Every M3-M8 makes the firmware empty its planner, and M3/M5/M7 then wait for the channel delay, so the channel commands given at one point of the path are replaced by those of the channels whose state actually changes there: toggles that cancel out (M4 then M3), repeated commands and on/off pairs around zero-length extrusions (moves shorter than tolerance [mm], which are dropped with them) disappear, and the remaining ones are sent channels off first. The statistics are the number of channel commands and moves removed, and the drain_report of the job before and after.
+    """
+    optimized = Job()
+    stats = {'toggles': 0, 'moves': 0}
+    channels = [None, None, None]       # Channel states as sent, None while unknown
+    position, relative = [0.0, 0.0, 0.0], False
+    group = []                          # Words of the channel commands and zero-length moves at the current point
+
+    def flush():
+        wanted = list(channels)
+        dropped = [0.0, 0.0, 0.0]
+        for words in group:
+            if 'M' in words:
+                wanted[(int(words['M']) - 3) // 2] = int(words['M']) % 2 == 1
+                stats['toggles'] += 1
+            else:
+                stats['moves'] += 1
+                if relative:
+                    dropped = [d + words.get(axis, 0.0) for d, axis in zip(dropped, 'XYZ')]
+        for on in (False, True):
+            for channel in range(3):
+                if wanted[channel] == on and channels[channel] != on:
+                    optimized.send('M{}'.format(2*channel + 3 + (not on)))
+                    channels[channel] = on
+                    stats['toggles'] -= 1
+        if any(format_number(d) != '0' for d in dropped):
+            # Relative moves below tolerance still add up, so what was dropped is made up in one move
+            optimized.send('G1 X{} Y{} Z{}'.format(*[format_number(d) for d in dropped]))
+            stats['moves'] -= 1
+        group.clear()
+
+    for line in job:
+        words = _words(line)
+        if words is not None and set(words) == {'M'} and 3 <= words['M'] <= 8:
+            group.append(words)
+            continue
+        if group and _is_move(words) and 'F' not in words:
+            target, _ = _track(words, position, relative)
+            if math.dist(target, position) <= tolerance:
+                group.append(words)
+                position = target
+                continue
+        flush()
+        optimized.send(line)
+        position, relative = _track(words, position, relative)
+    flush()
+    for name, source in (('before', job), ('after', optimized)):
+        stats['drain_' + name] = drain_report(source, feedrate = feedrate)
+    return optimized, stats
+
+Segment = namedtuple('Segment', ['tool', 'channels', 'points'])
+
+def path_segments(path, tolerance = 1e-6):
+    """
+    Splits a PathRecorder (the path recorded with printout = 0) into its extruded segments, grouped by layer. Returns a list of layers, each a list of Segment with the tool, the channel bitmask and the (m, 3) array of points of a run of consecutive moves extruding with the same tool and channels. Travel moves are dropped. A layer is a run of consecutive segments starting at the same z height, so the layers stay in the order they were printed.
+    """
+    xyz, channels, tool = path.xyz, path.channels, path.tool
+    extruding = channels[1:] != 0
+    changed = np.r_[True, (channels[2:] != channels[1:-1]) | (tool[2:] != tool[1:-1]) | ~extruding[:-1]]
+    moves = np.flatnonzero(extruding) + 1                   # Index of the end point of every extruding move
+    group = np.cumsum(extruding & changed)[moves - 1]
+    last = np.r_[np.flatnonzero(np.diff(group)), len(moves) - 1]
+    starts = moves[np.r_[0, last[:-1] + 1]] if len(moves) else moves
+    ends = moves[last] + 1 if len(moves) else moves
+    layers = []
+    for start, end in zip(starts, ends):
+        segment = Segment(int(tool[start]), int(channels[start]), xyz[start - 1:end].copy())
+        if not layers or abs(segment.points[0, 2] - layers[-1][0].points[0, 2]) > tolerance:
+            layers.append([])
+        layers[-1].append(segment)
+    return layers
+
+def schedule_tools(layers, start_tool = 1, start = (0, 0, 0)):
+    """
+    Reorders the segments of every layer so that each tool prints all of its segments of the layer in one go, starting with the tool that is already active, and orders the segments of each tool by nearest neighbour to shorten the travel between them. Layers keep their order, so a layer is never printed before the layers below it.
+    """
+    scheduled = []
+    tool, position = start_tool, np.asarray(start, dtype = float)
+    for layer in layers:
+        tools = list(dict.fromkeys(segment.tool for segment in layer))
+        if tool in tools:
+            tools.remove(tool)
+            tools.insert(0, tool)
+        ordered = []
+        for tool in tools:
+            remaining = [segment for segment in layer if segment.tool == tool]
+            firsts = np.array([segment.points[0] for segment in remaining])
+            while remaining:
+                nearest = int(np.argmin(np.sum((firsts - position)**2, axis = 1)))
+                segment = remaining.pop(nearest)
+                firsts = np.delete(firsts, nearest, axis = 0)
+                ordered.append(segment)
+                position = segment.points[-1]
+        scheduled.append(ordered)
+    return scheduled
+
+def segments_job(layers, tool_coords, start_tool = 1, start = (0, 0, 0), speed = None, lift = 0, tolerance = 1e-6):
+    """
+    Returns a Job printing the segments of layers in order, in relative coordinates from start. Tool changes are done like Makergear.change_tool (all channels off, then the move between the tool coordinates). Travel moves raise z first when going up and last when going down, hopping up by lift [mm] if lift > 0. Channels stay on between segments of the same tool and channels that join up.
+    """
+    job = Job()
+    job.send('G91')
+    if speed is not None:
+        job.send('G1 F{}'.format(format_number(speed*60)))
+    tool_coords = np.asarray(tool_coords, dtype = float)
+    tool, position, channels = start_tool, np.asarray(start, dtype = float), 0
+
+    def move(delta):
+        if np.any(np.abs(delta) > tolerance):
+            job.send('G1 X{} Y{} Z{}'.format(*[format_number(d) for d in delta]))
+
+    def switch(mask):
+        for channel in range(3):
+            if (channels ^ mask) >> channel & 1:
+                job.send('M{}'.format(2*channel + 3 + (not mask >> channel & 1)))
+        return mask
+
+    for segment in [segment for layer in layers for segment in layer]:
+        delta = segment.points[0] - position
+        joined = segment.tool == tool and segment.channels == channels and not np.any(np.abs(delta) > tolerance)
+        if not joined:
+            channels = switch(0)
+        if segment.tool != tool:
+            for channel in range(3):
+                job.send('M{}'.format(2*channel + 4))
+            move(tool_coords[segment.tool - 1] - tool_coords[tool - 1])
+            tool = segment.tool
+        if not joined:
+            for line in _travel_moves(position, segment.points[0], True, lift, tolerance):
+                job.send(line)
+            channels = switch(segment.channels)
+        for delta in np.diff(segment.points, axis = 0):
+            move(delta)
+        position = segment.points[-1]
+    switch(0)
+    return job
+
+def schedule_path(path, tool_coords, start_tool = 1, speed = None, lift = 0, feedrate = DEFAULT_FEEDRATE):
+    """
+    Reorders a PathRecorder with schedule_tools and returns the Job printing it and a dict of statistics: the number of tool changes and the travel (including the moves between tools, from tool_coords) before and after, and the print time estimated for each order with estimate_time.
+    """
+    layers = path_segments(path)
+    scheduled = schedule_tools(layers, start_tool)
+    stats = {}
+    for name, order in (('before', layers), ('after', scheduled)):
+        job = segments_job(order, tool_coords, start_tool, speed = speed, lift = lift)
+        stats['tool_changes_' + name], stats['travel_' + name] = _travel(order, tool_coords, start_tool)
+        stats['time_' + name] = float(estimate_time(job, feedrate = feedrate).cumulative[-1]) if len(job) else 0.0
+    stats['time_saved'] = stats['time_before'] - stats['time_after']
+    return job, stats
+
+def _travel(layers, tool_coords, tool):
+    # Tool changes and non-extruding travel [mm] of printing layers in order
+    tool_coords = np.asarray(tool_coords, dtype = float)
+    changes, travel, position = 0, 0.0, np.zeros(3)
+    for segment in [segment for layer in layers for segment in layer]:
+        if segment.tool != tool:
+            changes += 1
+            travel += np.linalg.norm(tool_coords[segment.tool - 1] - tool_coords[tool - 1])
+            tool = segment.tool
+        travel += np.linalg.norm(segment.points[0] - position)
+        position = segment.points[-1]
+    return changes, float(travel)
+
+def order_travel(job, lift = 0, passes = 10, neighbourhood = 500, feedrate = DEFAULT_FEEDRATE, tolerance = 1e-6):
+    """
+    Returns a copy of job with its extruded features printed in a shorter travel order, and a dict of statistics. A feature is everything from a channel turning on until every channel is off again; features that are a plain polyline (channels on, moves, channels off) may also be printed backwards. Features are only reordered among those separated by nothing but travel moves (G0/G1 with every channel off) and starting at the same height, so any other command (speed, motor, tool change, coordinate system, dwell) stays between the same features and a layer is never printed before the one below it. Their order is built by nearest neighbour over a grid index of the feature ends and improved by 2-opt over at most passes passes, reversing runs of at most neighbourhood features. The original travel moves are replaced by direct ones, raising z first when going up and last when going down, hopping up by lift [mm] if lift > 0. The statistics are the number of features reordered and reversed, the travel [mm] and the print time estimated with estimate_time before and after.
+    """
+    optimized = Job()
+    stats = {'features': 0, 'reversed': 0, 'travel_before': 0.0, 'travel_after': 0.0}
+    position, relative, run, mask = [0.0, 0.0, 0.0], False, [], 0
+
+    def flush():
+        if run:
+            _reorder(run, optimized, relative, lift, passes, neighbourhood, tolerance, stats)
+            run.clear()
+
+    for line in job:
+        words = _words(line)
+        toggle = words is not None and set(words) == {'M'} and 3 <= words['M'] <= 8
+        if _is_move(words) and 'F' not in words or toggle:
+            if mask == 0 and run and abs(position[2] - run[0][2][2]) > tolerance:
+                # Between features on a new layer: the features of the layer below are reordered on their own
+                flush()
+            run.append((line, words, position))
+            position, relative = _track(words, position, relative)
+            if toggle:
+                channel = (int(words['M']) - 3) // 2
+                mask = mask | 1 << channel if int(words['M']) % 2 else mask & ~(1 << channel)
+        else:
+            flush()
+            optimized.send(line)
+            position, relative = _track(words, position, relative)
+    flush()
+    stats['time_before'] = float(estimate_time(job, feedrate = feedrate).cumulative[-1]) if len(job) else 0.0
+    stats['time_after'] = float(estimate_time(optimized, feedrate = feedrate).cumulative[-1]) if len(optimized) else 0.0
+    stats['time_saved'] = stats['time_before'] - stats['time_after']
+    return optimized, stats
+
+def _reorder(run, optimized, relative, lift, passes, neighbourhood, tolerance, stats):
+    # Splits a run of moves and channel commands into travel moves and features, and writes it back in a shorter order
+    features, travel, mask = [], 0.0, 0
+    for line, words, start in run:
+        end, _ = _track(words, start, relative)
+        if 'M' in words:
+            if mask == 0:
+                features.append({'lines': [], 'points': [start], 'lead': [], 'tail': [], 'reversible': True})
+            feature = features[-1]
+            (feature['tail'] if len(feature['points']) > 1 else feature['lead']).append(line)
+            channel = (int(words['M']) - 3) // 2
+            mask = mask | 1 << channel if int(words['M']) % 2 else mask & ~(1 << channel)
+        elif mask == 0:
+            travel += math.dist(start, end)
+            continue
+        else:
+            feature = features[-1]
+            feature['reversible'] &= not feature['tail']
+            feature['points'].append(end)
+        feature['lines'].append(line)
+    if mask != 0 or len(features) < 2:
+        # A feature continues past the run, or there is nothing to reorder
+        for line, _, _ in run:
+            optimized.send(line)
+        return
+
+    start, end = np.array(run[0][2]), np.array(_track(run[-1][1], run[-1][2], relative)[0])
+    entries = np.array([feature['points'][0] for feature in features])
+    exits = np.array([feature['points'][-1] for feature in features])
+    reversible = np.array([feature['reversible'] for feature in features])
+    order, flipped = _nearest_neighbour(entries, exits, reversible, start)
+    order, flipped = _two_opt(order, flipped, entries, exits, reversible, start, end, passes, neighbourhood)
+
+    position = start
+
+    def emit(lines):
+        # The printer position is followed through the lines written, so rounding never accumulates in relative mode
+        nonlocal position
+        for line in lines:
+            line = line if isinstance(line, bytes) else str.encode(line)
+            optimized.send(line)
+            position = np.array(_track(_words(line), position, relative)[0])
+
+    for index, backwards in zip(order, flipped):
+        feature = features[index]
+        points = np.array(feature['points'])
+        entry = points[-1] if backwards else points[0]
+        travel_lines = _travel_moves(position, entry, relative, lift, tolerance)
+        stats['travel_after'] += float(np.linalg.norm(entry - position)) + 2*lift*bool(travel_lines)
+        emit(travel_lines)
+        if backwards:
+            points = np.round(points[::-1], 6)
+            targets = np.diff(points, axis = 0) if relative else points[1:]
+            emit(feature['lead'] + ['G1 X{} Y{} Z{}'.format(*[format_number(value) for value in target]) for target in targets] + feature['tail'])
+        else:
+            emit(feature['lines'])
+    travel_lines = _travel_moves(position, end, relative, lift, tolerance)
+    stats['travel_after'] += float(np.linalg.norm(end - position)) + 2*lift*bool(travel_lines)
+    emit(travel_lines)
+    stats['travel_before'] += travel
+    stats['features'] += len(features)
+    stats['reversed'] += int(np.sum(flipped))
+
+def _travel_moves(start, end, relative, lift = 0, tolerance = 1e-6):
+    """
+    Returns the GCode lines of a travel move from start to end: z first when going up and last when going down, hopping up by lift [mm] if lift > 0
+    """
+    start, end = np.asarray(start, dtype = float), np.asarray(end, dtype = float)
+    delta = end - start
+    if not np.any(np.abs(delta) > tolerance):
+        return []
+    top = max(start[2], end[2]) + max(lift, 0)
+    waypoints = [start, [start[0], start[1], top], [end[0], end[1], top], end]
+    lines = []
+    for a, b in zip(waypoints[:-1], waypoints[1:]):
+        step = np.asarray(b) - a
+        if np.any(np.abs(step) > tolerance):
+            lines.append('G1 X{} Y{} Z{}'.format(*[format_number(value) for value in (step if relative else b)]))
+    return lines
+
+def _nearest_neighbour(entries, exits, reversible, start):
+    """
+    Returns the features (as indices, and whether each one is printed backwards) in nearest neighbour order from start. The ends of the features are kept in a grid over x and y, stored as one array of point indices sorted by cell. Each step gathers the points of a square of cells around the current position with array operations, doubling the square until the nearest point found is closer than any point outside it.
+    """
+    k = len(entries)
+    points = np.vstack([entries, exits])                   # Point i < k enters feature i forwards, point k + i backwards
+    usable = np.flatnonzero(np.r_[np.ones(k, dtype = bool), reversible])
+    low = points[:, :2].min(axis = 0)
+    cell = max(np.ptp(points[:, :2], axis = 0).max() / math.sqrt(len(points)), 1e-9)
+    cells = np.floor((points[:, :2] - low) / cell).astype(np.int64)
+    size = cells.max(axis = 0) + 1
+
+    def grid(left):
+        # by_cell[bounds[c]:bounds[c + 1]] are the points left in cell c
+        cell_of = cells[left, 0]*size[1] + cells[left, 1]
+        return left[np.argsort(cell_of, kind = 'stable')], np.searchsorted(np.sort(cell_of), np.arange(size[0]*size[1] + 1))
+
+    by_cell, bounds = grid(usable)
+    done = np.zeros(k, dtype = bool)
+    order, flipped, position = [], [], np.asarray(start, dtype = float)
+    for step in range(k):
+        if step and (step & (step - 1)) == 0 and step >= 64:
+            # The points of the features already printed are dropped from the grid now and then
+            by_cell, bounds = grid(by_cell[~done[by_cell % k]])
+        home = np.floor((position[:2] - low) / cell).astype(np.int64)
+        ring = 1
+        while True:
+            lo, hi = np.maximum(home - ring, 0), np.minimum(home + ring, size - 1)
+            covered = np.all(lo == 0) and np.all(hi == size - 1)
+            if np.all(lo <= hi):
+                ids = (np.arange(lo[0], hi[0] + 1)[:, None]*size[1] + np.arange(lo[1], hi[1] + 1)).ravel()
+                first, count = bounds[ids], bounds[ids + 1] - bounds[ids]
+                offsets = np.repeat(first - np.cumsum(count) + count, count) + np.arange(count.sum())
+                candidates = by_cell[offsets]
+                candidates = candidates[~done[candidates % k]]
+            else:
+                candidates = by_cell[:0]
+            if len(candidates):
+                d = np.linalg.norm(points[candidates] - position, axis = 1)
+                best = int(np.argmin(d))
+                # Points outside the square are at least ring cells away from the home cell
+                if d[best] <= ring*cell or covered:
+                    break
+            elif covered:
+                break
+            ring *= 2
+        index = int(candidates[best] % k)
+        backwards = bool(candidates[best] >= k)
+        done[index] = True
+        order.append(index)
+        flipped.append(backwards)
+        position = entries[index] if backwards else exits[index]
+    return np.array(order), np.array(flipped, dtype = bool)
+
+def _two_opt(order, flipped, entries, exits, reversible, start, end, passes, neighbourhood):
+    """
+    Improves an open tour from start to end by reversing runs of consecutive features (each reversed feature is printed backwards) while that shortens the travel
+    """
+    k = len(order)
+    a = np.vstack([np.where(flipped[:, None], exits[order], entries[order]), end])  # Entry point of every feature in tour order, then end
+    b = np.where(flipped[:, None], entries[order], exits[order])                    # Exit point of every feature in tour order
+    stuck = np.r_[0, np.cumsum(~reversible[order])]     # Reversing only reversible features leaves this unchanged
+    for _ in range(passes):
+        improved = False
+        for i in range(k):
+            last = min(k, i + neighbourhood)
+            valid = stuck[i + 1:last + 1] == stuck[i]   # Runs containing a feature that cannot be reversed are skipped
+            if not valid[0]:
+                continue
+            before = b[i - 1] if i > 0 else start
+            gain = np.linalg.norm(before - a[i]) + np.linalg.norm(b[i:last] - a[i + 1:last + 1], axis = 1) - np.linalg.norm(b[i:last] - before, axis = 1) - np.linalg.norm(a[i] - a[i + 1:last + 1], axis = 1)
+            gain[~valid] = 0
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                stop = i + best + 1
+                order[i:stop] = order[i:stop][::-1]
+                flipped[i:stop] = ~flipped[i:stop][::-1]
+                a[i:stop], b[i:stop] = b[i:stop][::-1].copy(), a[i:stop][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order, flipped
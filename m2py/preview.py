@@ -0,0 +1,342 @@
+# M2PY -- Print path preview: in-memory recording of the moves generated with printout = 0, and paths of GCode files
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from gcode import PARAMS, iter_gcode
+
+# Line colors for each channel bitmask; overlapping channels mix their colors
+CHANNEL_COLORS = np.array([
+    [0x48, 0x48, 0x48], # all channels off (travel)
+    [0x00, 0x00, 0xff], # channel 1
+    [0x00, 0xff, 0x00], # channel 2
+    [0x00, 0xff, 0xff], # channels 1 + 2
+    [0xff, 0x00, 0x00], # channel 3
+    [0xff, 0x00, 0xff], # channels 1 + 3
+    [0xff, 0xff, 0x00], # channels 2 + 3
+    [0x00, 0x00, 0x00], # all channels on
+    ]) / 255.
+
+class PathRecorder:
+    """
+    Columnar, growable record of a print path. Every recorded point stores its (x, y, z) position, the channel status as a bitmask (bit 0 = channel 1, bit 1 = channel 2, bit 2 = channel 3) and the active tool. The path starts at the origin with all channels off.
+    """
+    def __init__(self, capacity = 4096):
+        self._xyz = np.zeros([capacity, 3])
+        self._channels = np.zeros(capacity, dtype = np.uint8)
+        self._tool = np.ones(capacity, dtype = np.uint8)
+        self.n = 1
+        self._z_order = None    # Indices of the points sorted by z, rebuilt when the path grows
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def xyz(self):
+        """(n, 3) float64 array of the recorded positions"""
+        return self._xyz[:self.n]
+
+    @property
+    def channels(self):
+        """(n,) uint8 array of channel bitmasks"""
+        return self._channels[:self.n]
+
+    @property
+    def tool(self):
+        """(n,) uint8 array of the active tool at each point"""
+        return self._tool[:self.n]
+
+    def channel_array(self):
+        """
+        Returns the channel bitmasks unpacked into an (n, 3) array of 0/1 channel states
+        """
+        return (self.channels[:, None] >> np.arange(3, dtype = np.uint8)) & 1
+
+    def reserve(self, extra):
+        """
+        Makes room for extra more points, doubling the capacity as needed
+        """
+        needed = self.n + extra
+        if needed <= len(self._xyz):
+            return
+        capacity = max(needed, 2*len(self._xyz))
+        for name in ('_xyz', '_channels', '_tool'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype = old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def extend(self, pts, channels = 0, tool = 1, rel = False):
+        """
+        Appends an (m, 3) array of points. With rel = True the points are displacements that are accumulated from the last recorded position.
+        """
+        pts = np.asarray(pts, dtype = float).reshape(-1, 3)
+        m = len(pts)
+        self.reserve(m)
+        if rel:
+            self._xyz[self.n:self.n + m] = self._xyz[self.n - 1] + np.cumsum(pts, axis = 0)
+        else:
+            self._xyz[self.n:self.n + m] = pts
+        self._channels[self.n:self.n + m] = channels
+        self._tool[self.n:self.n + m] = tool
+        self.n += m
+
+    def append(self, x, y, z, channels = 0, tool = 1, rel = False):
+        """
+        Appends a single point (or displacement when rel = True)
+        """
+        self.extend([x, y, z], channels, tool, rel)
+
+    def z_order(self):
+        """
+        Returns the indices of the recorded points sorted by z (stable, so points of one layer stay in path order)
+        """
+        if self._z_order is None or len(self._z_order) != self.n:
+            self._z_order = np.argsort(self.xyz[:, 2], kind = 'stable')
+        return self._z_order
+
+    def layers(self, tolerance = 1e-6):
+        """
+        Returns the sorted z heights of the layers, i.e. the distinct z values of the points reached while extruding (or of all points if nothing is extruded)
+        """
+        z = self.xyz[:, 2]
+        if np.any(self.channels):
+            z = z[self.channels != 0]
+        z = np.sort(z)
+        return z[np.r_[True, np.diff(z) > tolerance]]
+
+    def select(self, layer = None, zslice = None, moves = None, tolerance = 1e-6):
+        """
+        Returns (xyz, channels) of the moves ending on the selected layer index (or (first, last) range of layer indices), inside zslice = (zmin, zmax) and/or inside the move index window moves = (start, stop). Disconnected pieces of the path are separated by a row of NaN (with channel bitmask 255) so the result can be drawn as a single polyline. A selection without any move returns empty arrays, a layer index out of range raises ValueError.
+        """
+        if layer is not None:
+            levels = self.layers(tolerance)
+            first, last = (layer, layer) if np.isscalar(layer) else (min(layer), max(layer))
+            if not -len(levels) <= first <= last < len(levels):
+                raise ValueError('Layer {} is out of range, the path has {} layers'.format(layer, len(levels)))
+            zslice = (levels[first], levels[last])
+
+        if zslice is None:
+            idx = np.arange(self.n)
+        else:
+            order = self.z_order()
+            z = self.xyz[order, 2]
+            lo = np.searchsorted(z, zslice[0] - tolerance, side = 'left')
+            hi = np.searchsorted(z, zslice[1] + tolerance, side = 'right')
+            idx = np.sort(order[lo:hi])
+        if moves is not None:
+            start, stop = moves
+            idx = idx[(idx >= start) & (idx < stop)]
+        idx = idx[idx > 0]
+        if len(idx) == 0:
+            return np.zeros([0, 3]), np.zeros(0, dtype = np.uint8)
+
+        idx = _with_starts(idx)
+        xyz = self.xyz[idx]
+        channels = self.channels[idx]
+        xyz[idx < 0] = np.nan
+        channels[idx < 0] = 255
+        return xyz, channels
+
+    def save(self, fid):
+        """
+        Writes the recorded path to fid as a NumPy .npz archive with the arrays xyz, channels and tool
+        """
+        np.savez(fid, xyz = self.xyz, channels = self.channels, tool = self.tool)
+
+    @classmethod
+    def load(cls, fid):
+        """
+        Reads a path written by save
+        """
+        data = np.load(fid)
+        path = cls(capacity = max(len(data['xyz']), 1))
+        path.n = len(data['xyz'])
+        path._xyz[:path.n] = data['xyz']
+        path._channels[:path.n] = data['channels']
+        path._tool[:path.n] = data['tool']
+        return path
+
+def _with_starts(idx):
+    """
+    Every selected point is the end of a move, so each run of consecutive indices in idx also needs the point before it. Returns idx with the start of each run added, and -1 between the runs.
+    """
+    starts = np.r_[0, np.flatnonzero(np.diff(idx) > 1) + 1]
+    idx = np.insert(idx, starts, idx[starts] - 1)
+    return np.insert(idx, (starts + np.arange(len(starts)))[1:], -1)
+
+def gcode_path(source, budget = 100000, zslice = None, arc_points = 16, chunk_size = 1 << 20, fast = True):
+    """
+    Returns (xyz, channels) of the print path of a GCode file, bytes buffer, Job or list of GCode lines, as PathRecorder.select does for a recorded path, so it can be drawn with render_path. The GCode is parsed chunk by chunk with iter_gcode (from a memory-mapped file), following G90/G91, G92 (which starts a new piece of the path), G28 and the channels switched by M3-M8, and G2/G3 arcs are drawn with arc_points points. Only the moves ending inside zslice = (zmin, zmax) are kept. Each chunk is reduced with simplify_path to its share of budget as soon as it is parsed, so the path of a file of any size is built in bounded memory. Parsing every line runs at about 5 MB of GCode per second, so with fast = True (and no zslice) the chunks of files holding more than budget moves are sampled instead: only their share of budget evenly spaced moves, and every other command, are parsed (see GCodeParser.sample) and the moves in between are drawn as straight lines. This runs at about 80 MB per second, so a 500 MB file is previewed in about 6 s instead of nearly two minutes (benchmarks/bench_preview.py).
+    """
+    if isinstance(source, str):
+        size = os.path.getsize(source)
+    elif hasattr(source, 'compile'):
+        size = len(source.compile())
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        size = len(source)
+    else:
+        size = None
+    share = max(int(budget*chunk_size / size), 1000) if size else None
+    sample = max(int(budget*chunk_size / size) // 2, 100) if size and fast and zslice is None else None # Every sampled move comes with the one before it
+    last = np.zeros(3), np.uint8(0)
+    # Without zslice the path starts at the origin and every chunk continues it, with zslice every chunk starts with a separator
+    xyz, channels = ([np.zeros([1, 3])], [np.zeros(1, dtype = np.uint8)]) if zslice is None else ([], [])
+    for gcode in iter_gcode(source, chunk_size = chunk_size, sample = sample):
+        points, status = _gcode_points(gcode, last[0], arc_points)
+        points, status = np.vstack([last[0], points]), np.r_[last[1], status].astype(np.uint8)
+        last = points[-1], status[-1]
+        if zslice is not None:
+            idx = np.flatnonzero((points[:, 2] >= zslice[0]) & (points[:, 2] <= zslice[1]))
+            idx = _with_starts(idx[idx > 0]) if np.any(idx > 0) else np.zeros(0, dtype = np.intp)
+            points, status = points[idx], status[idx]
+            points[idx < 0], status[idx < 0] = np.nan, 255
+            points, status = np.vstack([np.full([1, 3], np.nan), points]), np.r_[255, status].astype(np.uint8)
+        if share:
+            points, status = simplify_path(points, status, budget = share)
+        xyz.append(points if zslice is not None else points[1:])
+        channels.append(status if zslice is not None else status[1:])
+    xyz, channels = np.vstack(xyz) if xyz else np.zeros([0, 3]), np.concatenate(channels) if channels else np.zeros(0, dtype = np.uint8)
+    if zslice is not None:
+        # The separators before the first point kept are not needed
+        first = np.flatnonzero(np.isfinite(xyz[:, 0]))
+        first = first[0] if len(first) else len(xyz)
+        xyz, channels = xyz[first:], channels[first:]
+    return xyz, channels
+
+def _gcode_points(gcode, start, arc_points):
+    """
+    Returns the points the head goes through for the moves of gcode (GCodeArrays), starting from start, with the channel status of the move ending at each point. Each G92 adds a row of NaN (channel status 255) followed by the new position.
+    """
+    command = gcode.command
+    rows = np.flatnonzero(np.isin(command, [b'G0', b'G1', b'G2', b'G3', b'G28', b'G92']))
+    before = np.vstack([start, gcode.position[:-1, :3]])[rows]
+    after = gcode.position[rows, :3]
+    arc = np.isin(command[rows], [b'G2', b'G3'])
+    jump = command[rows] == b'G92'
+    counts = np.where(arc, arc_points, np.where(jump, 2, 1))
+    group = np.repeat(np.arange(len(rows)), counts)
+    t = (np.arange(len(group)) - np.repeat(np.cumsum(counts) - counts, counts) + 1) / counts[group]
+    points = after[group].copy()
+    status = gcode.channels[rows][group]
+
+    # Arcs, with a full circle when the end is the start
+    center = before[:, :2] + np.nan_to_num(gcode.params[rows][:, [PARAMS.index('I'), PARAMS.index('J')]])
+    radius = np.hypot(*(before[:, :2] - center).T)
+    a0 = np.arctan2(*(before[:, 1::-1] - center[:, ::-1]).T)
+    sweep = np.arctan2(*(after[:, 1::-1] - center[:, ::-1]).T) - a0
+    clockwise = command[rows] == b'G2'
+    sweep = np.where(clockwise, np.where(sweep >= 0, sweep - 2*np.pi, sweep), np.where(sweep <= 0, sweep + 2*np.pi, sweep))
+    curve = arc[group] & (t < 1)
+    theta = a0[group] + sweep[group]*t
+    points[curve, 0] = (center[group, 0] + radius[group]*np.cos(theta))[curve]
+    points[curve, 1] = (center[group, 1] + radius[group]*np.sin(theta))[curve]
+    points[curve, 2] = (before[group, 2] + (after[group, 2] - before[group, 2])*t)[curve]
+
+    broken = jump[group] & (t < 1)
+    points[broken] = np.nan
+    status[broken] = 255
+    status[jump[group] & (t == 1)] = 0
+    return points, status
+
+def preview_gcode(source, zrange = [0, 203], budget = 100000, output = None, zslice = None, title = 'M2PCS Print Path Visualization', fast = True):
+    """
+    Plots the print path of a GCode file (or bytes buffer, Job or list of GCode lines) like Makergear.path_vis, e.g. to check a file before printing it with file_read. The path is built with gcode_path (sampling large files unless fast = False) and drawn with render_path.
+    """
+    xyz, channels = gcode_path(source, budget = budget, zslice = zslice, fast = fast)
+    return render_path(xyz, channels, zrange = zrange, budget = budget, output = output, title = title)
+
+def simplify_path(xyz, channels, budget = 100000):
+    """
+    Reduces a path to at most about budget points for drawing. Rows of NaN (separating disconnected pieces) are kept. Zero-length segments and points lying on a straight run with the same channel status are always removed. If the path is still above budget, travel moves (all channels off) are replaced by straight lines between extrusions, and as a last resort every k-th point is kept along with every channel change. Returns the reduced (xyz, channels).
+    """
+    xyz = np.asarray(xyz, dtype = float)
+    channels = np.asarray(channels)
+    if len(xyz) < 3:
+        return xyz, channels
+
+    # Segment i runs from point i to point i + 1 and is drawn with channels[i + 1]
+    d = np.diff(xyz, axis = 0)
+    seg_len = np.sqrt(np.einsum('ij,ij->i', d, d))
+    keep = np.ones(len(xyz), dtype = bool)
+    keep[1:-1] = ~(seg_len[:-1] == 0)
+    cross = np.cross(d[:-1], d[1:])
+    straight = (np.sqrt(np.einsum('ij,ij->i', cross, cross)) <= 1e-9*seg_len[:-1]*seg_len[1:]) & (np.einsum('ij,ij->i', d[:-1], d[1:]) > 0)
+    keep[1:-1] &= ~(straight & (channels[1:-1] == channels[2:]))
+    xyz, channels = xyz[keep], channels[keep]
+
+    if len(xyz) > budget:
+        keep = np.ones(len(xyz), dtype = bool)
+        keep[1:-1] = (channels[1:-1] != 0) | (channels[2:] != 0)
+        xyz, channels = xyz[keep], channels[keep]
+
+    if len(xyz) > budget:
+        keep = np.zeros(len(xyz), dtype = bool)
+        keep[::int(np.ceil(len(xyz) / budget))] = True
+        change = np.flatnonzero(channels[1:] != channels[:-1])
+        keep[change] = True
+        keep[change + 1] = True
+        keep[-1] = True
+        xyz, channels = xyz[keep], channels[keep]
+    return xyz, channels
+
+def render_path(xyz, channels, zrange = [0, 203], budget = 100000, output = None, title = 'M2PCS Print Path Visualization'):
+    """
+    Plots a print path as a 3D line graph, with one line collection for the extrusions (colored by channel) and one for the travel moves (dotted). Paths above budget points are simplified first with simplify_path. If output is a file name (e.g. 'path.png' or 'path.svg') the figure is saved there without opening a window, otherwise it is shown. An empty path (e.g. a selection without any move) gives empty axes.
+    """
+    xyz, channels = simplify_path(xyz, channels, budget = budget)
+    segments = np.stack([xyz[:-1], xyz[1:]], axis = 1)
+    seg_channels = channels[1:]
+    drawn = np.all(np.isfinite(segments), axis = (1, 2))
+    segments, seg_channels = segments[drawn], seg_channels[drawn]
+    travel = seg_channels == 0
+
+    if output is None:
+        fig = plt.figure()
+    else:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection = Axes3D.name)
+
+    if np.any(~travel):
+        ax.add_collection3d(Line3DCollection(segments[~travel], colors = CHANNEL_COLORS[seg_channels[~travel] & 7], linewidths = 2, linestyles = '-'))
+    if np.any(travel):
+        ax.add_collection3d(Line3DCollection(segments[travel], colors = [CHANNEL_COLORS[0]], linewidths = 2, linestyles = ':'))
+
+    points = xyz[np.all(np.isfinite(xyz), axis = 1)]
+    if len(points):
+        xymin = min(points[:, 0].min(), points[:, 1].min())
+        xymax = max(points[:, 0].max(), points[:, 1].max())
+        ax.set_xlim3d(xymin, xymax)
+        ax.set_ylim3d(xymin, xymax)
+    if zrange == 'fit':
+        if len(points):
+            ax.set_zlim3d(0, points[:, 2].max())
+    else:
+        ax.set_zlim3d(zrange[0], zrange[1])
+
+    ax.set_xlabel('X axis [mm]')
+    ax.set_ylabel('Y axis [mm]')
+    ax.set_zlabel('Z axis [mm]')
+
+    ch1_patch = mpatches.Patch(color = CHANNEL_COLORS[1], label = 'Channel 1')
+    ch2_patch = mpatches.Patch(color = CHANNEL_COLORS[2], label = 'Channel 2')
+    ch3_patch = mpatches.Patch(color = CHANNEL_COLORS[4], label = 'Channel 3')
+    if len(points):
+        ax.scatter(points[0, 0], points[0, 1], points[0, 2], c = '#7E7C66', marker = 'o')
+        ax.scatter(points[-1, 0], points[-1, 1], points[-1, 2], c = 'k', marker = 'o')
+    ax.legend(handles = [ch1_patch, ch2_patch, ch3_patch], loc = 'best')
+    ax.set_title(title)
+
+    if output is None:
+        plt.show()
+    else:
+        fig.savefig(output)
+    return fig
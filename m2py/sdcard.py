@@ -0,0 +1,119 @@
+# M2PY -- Printing from the printer's SD card: uploading a job with M28/M29 and playing it with M23/M24
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import re
+import threading
+import time
+import serial
+from job import Sender
+
+SD_NAME = re.compile(r'^[a-z0-9_~-]{1,8}(\.[a-z0-9_~-]{1,3})?$')  # 8.3 file names, as the firmware's FAT library expects
+SD_PROGRESS = re.compile(r'SD printing byte (\d+)/(\d+)')
+
+def sd_upload(transport, job, name = 'm2py.gco', timeout = 10, progress = 5, verbose = True):
+    """
+    Writes job to the file name (8.3, e.g. 'part.gco') on the printer's SD card and selects it for printing. transport is a Transport or a DaemonTransport. The lines are streamed with M28/M29 through transport like any other lines, so a streaming transport uploads with a full window of lines in flight. The upload is verified with M23: the file size reported by the firmware must match the job (the firmware writes every line without line number and checksum, ending in '\\r\\n'). Returns the file size. Raises serial.SerialException if the card cannot be read or written, or the file on the card does not match the job.
+    """
+    name = name.lower() # The firmware would take an uppercase G or M in the name for a GCode word
+    if not SD_NAME.match(name):
+        raise ValueError('SD card file names must be 8.3 names (e.g. part.gco), got {}'.format(name))
+    report = transport.query('M21')
+    if any('init fail' in line for line in report):
+        raise serial.SerialException('No SD card: {}'.format(report))
+    report = transport.query('M28 {}'.format(name))
+    if not any(line.startswith('Writing to file') for line in report):
+        raise serial.SerialException('Could not open {} on the SD card: {}'.format(name, report))
+
+    if verbose: print('Uploading {} lines to {}'.format(len(job), name))
+    Sender(transport, zip(job, range(1, len(job) + 1)), total = len(job), progress = progress, verbose = verbose).run()
+
+    # M29 is answered with 'Done saving file.' instead of 'ok'
+    transport.send_unacknowledged('M29', 'Done saving file', timeout = timeout)
+
+    expected = len(job.compile()) + len(job) # Every '\n' is written as '\r\n'
+    report = transport.query('M23 {}'.format(name))
+    size = [int(match.group(1)) for match in map(re.compile(r'Size:\s*(\d+)').search, report) if match]
+    if not size:
+        raise serial.SerialException('Could not open {} on the SD card: {}'.format(name, report))
+    if size[0] != expected:
+        raise serial.SerialException('{} on the SD card has {} bytes instead of {}'.format(name, size[0], expected))
+    if verbose: print('Uploaded and verified {} ({} bytes)'.format(name, size[0]))
+    return size[0]
+
+class SDPrint:
+    """
+    Plays the file selected on the printer's SD card (see sd_upload) and follows its progress. start sends M24, after which the printer reads the file on its own, so the motion no longer depends on the host keeping up. A background thread asks for the progress with M27 (transport.query) every poll seconds; printed and size are the bytes read so far and the file size, and done is set once the printer read the whole file and finished its moves. pause and resume can be called from any thread, and the transport stays usable for other commands meanwhile.
+    """
+    def __init__(self, transport, size = None, poll = 5, verbose = True):
+        self.transport = transport
+        self.size = size
+        self.poll = poll
+        self.verbose = verbose
+        self.printed = 0
+        self.started = None
+        self.paused = False
+        self.done = threading.Event()
+        self.read = threading.Event()       # Set when the printer reports the end of the file
+        self.thread = None
+
+    @property
+    def progress(self):
+        return self.printed / self.size if self.size else 0.0
+
+    def start(self):
+        """
+        Starts printing the selected file and returns immediately
+        """
+        self.started = time.time()
+        self.transport.send('M24')
+        self.thread = threading.Thread(target = self._poll_loop, name = 'm2py-sdcard', daemon = True)
+        self.thread.start()
+        return self
+
+    def pause(self):
+        """
+        Pauses after the commands already read from the file (M25)
+        """
+        self.paused = True
+        self.transport.send('M25')
+
+    def resume(self):
+        self.paused = False
+        self.transport.send('M24')
+
+    def join(self, timeout = None):
+        """
+        Waits until the printer finished the file, and returns True if it did within timeout
+        """
+        finished = self.done.wait(timeout)
+        if finished and self.thread is not None:
+            self.thread.join()
+        return finished
+
+    def report(self):
+        elapsed = time.time() - self.started if self.started else 0
+        eta = elapsed*(1 - self.progress)/self.progress if self.progress > 0 else 0
+        print('{:.1f}% printed from SD ({}/{} bytes), {} left'.format(100*self.progress, self.printed, self.size, time.strftime('%H:%M:%S', time.gmtime(eta))))
+
+    def _status(self, report):
+        for text in report:
+            match = SD_PROGRESS.search(text)
+            if match:
+                self.printed, self.size = int(match.group(1)), int(match.group(2))
+            elif text.startswith('Done printing file') or (text.startswith('Not SD printing') and not self.paused):
+                if self.size:
+                    self.printed = self.size
+                self.read.set()
+
+    def _poll_loop(self):
+        try:
+            while not self.read.wait(self.poll):
+                self._status(self.transport.query('M27'))
+                if self.verbose: self.report()
+            self.transport.query('M400') # The end of the file is reported as soon as it is read, the queued moves are still running
+        except serial.SerialException:
+            pass # The connection failed, so the progress cannot be followed anymore
+        finally:
+            self.done.set()
+            if self.verbose: print('SD print complete' if self.printed == self.size else 'Stopped following the SD print')
@@ -0,0 +1,491 @@
+# M2PY -- Simulated M2PCS printer, a serial-like stand-in for the M2 used for testing and benchmarking without hardware
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import collections
+import math
+import os
+import random
+import re
+import threading
+import time
+from firmware import (BUFSIZE, RX_BUFFER_SIZE, MAX_CMD_SIZE, BLOCK_BUFFER_SIZE, AXIS_STEPS_PER_UNIT, MAX_FEEDRATE, MAX_ACCELERATION, ACCELERATION,
+                      XY_JERK, Z_JERK, HOMING_FEEDRATE, MM_PER_ARC_SEGMENT, DROP_SEGMENTS, CH_ON_DELAY_TIME, DEFAULT_FEEDRATE)
+
+SPLASH_TIME = 1.0                                   # s between the boot banner and the first command being read
+
+BANNER = [
+    'start',
+    'echo: External Reset',
+    'Marlin 1.0.2',
+    'echo: Last Updated: Jan  1 2016 00:00:00 | Author: (MG|Josh, M2E - (SnNRd) v100 02/18/2016)',
+    'Compiled: Jan  1 2016',
+    'echo: Free Memory: 3542  PlannerBufferBytes: 1232',
+    'echo:Steps per unit:',
+    'echo:  M92 X88.88 Y88.88 Z1007.70 E471.50',
+    'echo:Maximum feedrates (mm/s):',
+    'echo:  M203 X200.00 Y200.00 Z25.00 E25.00',
+    'echo:Maximum Acceleration (mm/s2):',
+    'echo:  M201 X900 Y1000 Z30 E2000',
+    'echo:Acceleration: S=acceleration, T=retract acceleration',
+    'echo:  M204 S2000.00 T3000.00',
+    'echo:Advanced variables: S=Min feedrate (mm/s), T=Min travel feedrate (mm/s), B=minimum segment time (ms), X=maximum XY jerk (mm/s),  Z=maximum Z jerk (mm/s),  E=maximum E jerk (mm/s)',
+    'echo:  M205 S0.00 T0.00 B20000 X4.00 Z0.40 E1.00',
+    'echo:Home offset (mm):',
+    'echo:  M206 X0.00 Y0.00 Z0.00',
+    'echo:PID settings:',
+    'echo:   M301 P22.20 I1.08 D114.00',
+    'echo:SD card ok',
+    ]
+
+M115_REPORT = 'FIRMWARE_NAME:Marlin V1.0.2; Sprinter/grbl mashup for gen6 FIRMWARE_URL:https://github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:M2E EXTRUDER_COUNT:1 UUID:00000000-0000-0000-0000-000000000000'
+
+WORD = re.compile(r'([A-Z])\s*(-?\d*\.?\d*)')
+
+def move_time(delta, feedrate):
+    """
+    Returns the time in s the firmware takes for a single move of delta = (dx, dy, dz, de) mm at feedrate mm/min. The move is limited by the maximum feedrate and acceleration of every axis and follows a trapezoidal speed profile which starts and ends at the jerk limited safe speed (the firmware's look-ahead can only make a move faster than this).
+    """
+    dist = math.sqrt(delta[0]**2 + delta[1]**2 + delta[2]**2) or abs(delta[3])
+    if dist == 0 or feedrate <= 0:
+        return 0.0
+    speed = feedrate / 60.
+    accel = ACCELERATION
+    for d, vmax, amax in zip(delta, MAX_FEEDRATE, MAX_ACCELERATION):
+        if d != 0:
+            speed = min(speed, vmax*dist/abs(d))
+            accel = min(accel, amax*dist/abs(d))
+    v0 = min(speed, XY_JERK/2)
+    if delta[2] != 0:
+        v0 = min(v0, Z_JERK/2)
+    ramp = (speed**2 - v0**2) / (2*accel)
+    if 2*ramp >= dist: # Never reaches full speed
+        return 2*(math.sqrt(v0**2 + accel*dist) - v0) / accel
+    return 2*(speed - v0)/accel + (dist - 2*ramp)/speed
+
+class _FromSD(str):
+    """
+    A command read from the SD card, which the firmware does not acknowledge
+    """
+
+class Simulator:
+    """
+    Serial-like stand-in for an M2 running the M2PCS firmware, which can be passed to Makergear, connect, file_read or Job.play instead of a port name (or opened as a pseudo terminal with open_pty). It sends the 21 line boot banner, models the serial transit time at baud, the 128 byte receive buffer, the 32 command queue and the 16 move planner with the motion settings of the firmware, and answers like the firmware does: 'ok' after each command, 'Resend:' after a bad line number or checksum, M105, M114 and M115 reports. G0-G4, G28, G90-G92, M3-M9, M20-M30 (SD card, kept in memory in sd), M50, M110, M112 and M400 are understood. Times spent moving and waiting are divided by speedup.
+
+    latency is the one way USB latency in s, noise the probability that a line sent to the printer has a corrupted byte and resend the probability that a correct numbered line is still rejected with 'Resend:'. With record = True every processed command is kept in commands.
+    """
+    def __init__(self, baud = 115200, latency = 0.001, noise = 0, resend = 0, speedup = 1, boot = 0.5, timeout = 1, record = False, seed = None):
+        self.baudrate = baud
+        self.timeout = timeout
+        self.byte_time = 10.0 / baud
+        self.latency = latency
+        self.noise = noise
+        self.resend = resend
+        self.speedup = speedup
+        self.random = random.Random(seed)
+        self.cond = threading.Condition()
+        self.wire = collections.deque()     # (arrival time, line) travelling host -> printer
+        self.rx = collections.deque()       # Lines in the serial receive buffer
+        self.rx_bytes = 0
+        self.queue = collections.deque()    # Firmware command queue
+        self.out = collections.deque()      # (arrival time, line) travelling printer -> host
+        self.wire_free = 0                  # Time the host -> printer line is free again
+        self.out_free = 0                   # Time the printer -> host line is free again
+        self.planner = collections.deque()  # End times of the moves in the planner
+        self.busy_until = 0                 # Time the firmware finishes the current command
+
+        # Firmware state
+        self.position = [0.0, 0.0, 0.0, 0.0]    # Current position (X, Y, Z, E)
+        self.planned = [0.0, 0.0, 0.0, 0.0]     # Planner position, lags behind when tiny moves are dropped
+        self.relative = False
+        self.feedrate = DEFAULT_FEEDRATE
+        self.channels = [0, 0, 0]
+        self.motor_speed = 0
+        self.ch_on_delay = CH_ON_DELAY_TIME
+        self.last_line = 0
+        self.killed = False
+        self.sd = {}                            # SD card files, name -> list of lines written by M28
+        self.saving = None                      # File being written between M28 and M29
+        self.selected = None                    # File selected with M23
+        self.sd_index = 0                       # Next line of the selected file
+        self.sd_printing = False
+
+        # Statistics
+        self.received = 0                   # Lines received
+        self.processed = 0                  # Commands executed
+        self.resends = 0                    # 'Resend:' requests sent
+        self.overruns = 0                   # Lines lost to a full receive buffer
+        self.starved = 0.0                  # Time the planner ran empty between two moves
+        self.moving_until = None            # End time of the last planned move
+        self.commands = [] if record else None
+
+        start = time.perf_counter()
+        self.booted = start + boot
+        for line in BANNER:
+            self._emit(self.booted, line)
+        self.busy_until = self.booted + SPLASH_TIME
+        self.running = True
+        self.is_open = True
+        self.thread = threading.Thread(target = self._firmware, name = 'm2py-simulator', daemon = True)
+        self.thread.start()
+
+    # Serial interface
+    def write(self, data):
+        with self.cond:
+            now = time.perf_counter()
+            for line in data.splitlines(True):
+                self.wire_free = max(now, self.wire_free) + len(line)*self.byte_time
+                self.wire.append((self.wire_free + self.latency, line))
+            self.cond.notify_all()
+        return len(data)
+
+    def readline(self):
+        deadline = time.perf_counter() + self.timeout
+        with self.cond:
+            while True:
+                now = time.perf_counter()
+                if self.out and self.out[0][0] <= now:
+                    return self.out.popleft()[1]
+                if now >= deadline or not self.running:
+                    return b''
+                wake = self.out[0][0] if self.out else deadline
+                self.cond.wait(min(wake, deadline) - now)
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            now = time.perf_counter()
+            return sum(len(line) for t, line in self.out if t <= now)
+
+    def reset_input_buffer(self):
+        with self.cond:
+            now = time.perf_counter()
+            while self.out and self.out[0][0] <= now:
+                self.out.popleft()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.is_open = False
+            self.cond.notify_all()
+
+    def open_pty(self):
+        """
+        Connects the simulator to a new pseudo terminal and returns its device name (e.g. '/dev/pts/3'), which can be opened like a real port by serial.Serial or any other program. Only available on Unix.
+        """
+        import pty
+        import tty
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        name = os.ttyname(slave)
+
+        def host_to_printer():
+            line = b''
+            while self.running:
+                try:
+                    data = os.read(master, 1024)
+                except OSError:
+                    break
+                line += data
+                if b'\n' in line:
+                    cut = line.rfind(b'\n') + 1
+                    self.write(line[:cut])
+                    line = line[cut:]
+
+        def printer_to_host():
+            while self.running:
+                read = self.readline()
+                if read:
+                    os.write(master, read)
+
+        for target in (host_to_printer, printer_to_host):
+            threading.Thread(target = target, name = 'm2py-simulator-pty', daemon = True).start()
+        self.pty = (master, slave)
+        return name
+
+    # Firmware
+    def _emit(self, t, text):
+        line = str.encode(text + '\n')
+        self.out_free = max(t, self.out_free) + len(line)*self.byte_time
+        self.out.append((self.out_free + self.latency, line))
+
+    def _firmware(self):
+        # Runs every arrival and firmware step in time order up to the present, then sleeps until the next one
+        with self.cond:
+            while self.running:
+                now = time.perf_counter()
+                changed = False
+                while True:
+                    arrival = self.wire[0][0] if self.wire else float('inf')
+                    ready = self.busy_until if not self.killed and (self.queue or self.rx or self.sd_printing) else float('inf')
+                    if min(arrival, ready) > now:
+                        break
+                    if arrival <= ready:
+                        self._receive(self.wire.popleft()[1], arrival)
+                    else:
+                        if len(self.queue) < BUFSIZE - 1:
+                            self._get_command(ready)
+                        if self.queue:
+                            self.busy_until = self._process(self.queue.popleft(), ready)
+                    changed = True
+                if changed:
+                    self.cond.notify_all()
+                wake = min(arrival, ready)
+                self.cond.wait(min(wake - now, 0.05))
+
+    def _receive(self, line, t):
+        # The receive buffer drops whatever does not fit while the firmware is busy
+        if t < self.booted or self.killed:
+            return
+        if self.noise and self.random.random() < self.noise and len(line) > 1:
+            i = self.random.randrange(len(line) - 1)
+            line = line[:i] + bytes([self.random.randrange(32, 127)]) + line[i + 1:]
+        if self.rx_bytes + len(line) > RX_BUFFER_SIZE - 1:
+            self.overruns += 1
+            return
+        self.rx.append(line)
+        self.rx_bytes += len(line)
+        self.busy_until = max(self.busy_until, t)
+
+    def _get_command(self, now):
+        while self.rx and len(self.queue) < BUFSIZE:
+            line = self.rx.popleft()
+            self.rx_bytes -= len(line)
+            cmd = line.decode('ascii', 'replace').split(';')[0].strip()[:MAX_CMD_SIZE - 1]
+            if not cmd:
+                continue
+            self.received += 1
+            if 'N' in cmd:
+                number = re.match(r'-?\d*', cmd[cmd.index('N') + 1:]).group()
+                number = int(number) if number not in ('', '-') else 0
+                if number != self.last_line + 1 and 'M110' not in cmd:
+                    self._request_resend(now, 'Line Number is not Last Line Number+1, Last Line: ')
+                    return
+                if '*' not in cmd:
+                    self._request_resend(now, 'No Checksum with line number, Last Line: ')
+                    return
+                checksum = 0
+                for char in str.encode(cmd[:cmd.index('*')]):
+                    checksum ^= char
+                value = re.match(r'\d*', cmd[cmd.index('*') + 1:]).group()
+                if not value or int(value) != checksum or (self.resend and self.random.random() < self.resend):
+                    self._request_resend(now, 'checksum mismatch, Last Line: ')
+                    return
+                self.last_line = number
+            elif '*' in cmd:
+                self._emit(now, 'Error:No Line Number with checksum, Last Line: {}'.format(self.last_line))
+                continue
+            if cmd == 'M112':
+                self._kill(now)
+                return
+            self.queue.append(cmd)
+
+        # Lines of the file being printed from the SD card fill the rest of the queue, and are not acknowledged
+        while self.sd_printing and not self.rx and len(self.queue) < BUFSIZE:
+            lines = self.sd[self.selected]
+            self.queue.append(_FromSD(lines[self.sd_index].rstrip()))
+            self.sd_index += 1
+            if self.sd_index >= len(lines):
+                self.sd_printing = False
+                self._emit(now, 'Done printing file')
+
+    def _request_resend(self, now, message):
+        # The firmware clears its receive buffer before asking for the line again
+        self.rx.clear()
+        self.rx_bytes = 0
+        self.resends += 1
+        self._emit(now, 'Error:{}{}'.format(message, self.last_line))
+        self._emit(now, 'Resend: {}'.format(self.last_line + 1))
+        self._emit(now, 'ok')
+
+    def _kill(self, now):
+        self.killed = True
+        self.queue.clear()
+        self.planner.clear()
+        self._emit(now, 'Error:Printer halted. kill() called!')
+
+    def _process(self, cmd, t):
+        """
+        Executes a single command starting at time t, and returns the time the firmware is done with it and answers 'ok'
+        """
+        body = re.sub(r'^N-?\d*\s*', '', cmd).split('*')[0].strip() # Words are case sensitive, like in the firmware
+        if self.saving is not None:
+            # Between M28 and M29 commands are written to the file (without line number and checksum) instead of executed
+            if body.startswith('M29'):
+                self.saving = None
+                self._emit(t, 'Done saving file.')
+            else:
+                self.sd[self.saving].append(body + '\r\n')
+                self._emit(t, 'ok')
+            return t
+        self.processed += 1
+        if self.commands is not None:
+            self.commands.append(cmd)
+        words = dict((letter, float(value) if value not in ('', '-', '.', '-.') else 0.0) for letter, value in reversed(WORD.findall(body)))
+
+        if 'G' in words:
+            g = int(words['G'])
+            if g in (0, 1):
+                destination = self._destination(words)
+                t = self._plan(destination, t)
+                self.position = destination
+            elif g in (2, 3):
+                t = self._arc(words, g == 2, t)
+            elif g == 4:
+                t = self._synchronize(t) + (words.get('S', 0)*1000 or words.get('P', 0)) / 1000. / self.speedup
+            elif g == 28:
+                t = self._synchronize(t)
+                axes = [i for i, axis in enumerate('XYZ') if axis in words] or [0, 1, 2]
+                t += sum(abs(self.position[i]) / (HOMING_FEEDRATE[i] / 60.) for i in axes) / self.speedup
+                for i in axes:
+                    self.position[i] = self.planned[i] = 0.0
+            elif g == 90:
+                self.relative = False
+            elif g == 91:
+                self.relative = True
+            elif g == 92:
+                for i, axis in enumerate('XYZE'):
+                    if axis in words:
+                        self.position[i] = self.planned[i] = words[axis]
+        elif 'M' in words:
+            m = int(words['M'])
+            if m in (3, 5, 7): # Channel on
+                t = self._synchronize(t) + self.ch_on_delay / 1000. / self.speedup
+                self.channels[(m - 3) // 2] = 1
+            elif m in (4, 6, 8): # Channel off
+                t = self._synchronize(t)
+                self.channels[(m - 4) // 2] = 0
+            elif m == 9:
+                t = self._synchronize(t)
+                if 'S' in words:
+                    self.motor_speed = int(words['S'])
+            elif m == 50:
+                if 'S' in words:
+                    self.ch_on_delay = int(words['S'])
+            elif m == 105:
+                self._emit(t, 'ok T:0.0 /0.0 B:0.0 /0.0 @:0 B@:0')
+                return t
+            elif m == 112:
+                self._kill(t)
+                return t
+            elif m == 114:
+                self._emit(t, 'X:{:.2f} Y:{:.2f} Z:{:.2f} E:{:.2f} Count X: {:.2f} Y:{:.2f} Z:{:.2f}'.format(*(self.position + self.planned[:3])))
+            elif m == 115:
+                self._emit(t, M115_REPORT)
+            elif m == 400:
+                t = self._synchronize(t)
+            elif 20 <= m <= 30:
+                self._sd_command(m, body.split(None, 1)[1] if len(body.split()) > 1 else '', t)
+        elif 'T' in words:
+            if int(words['T']) >= 1:
+                self._emit(t, 'echo:T{} Invalid extruder'.format(int(words['T'])))
+        else:
+            self._emit(t, 'echo:Unknown command: "{}"'.format(cmd))
+        if not isinstance(cmd, _FromSD):
+            self._emit(t, 'ok')
+        return t
+
+    def _sd_command(self, m, name, t):
+        if m == 20:
+            self._emit(t, 'Begin file list')
+            for filename in self.sd:
+                self._emit(t, filename)
+            self._emit(t, 'End file list')
+        elif m == 21:
+            self._emit(t, 'echo:SD card ok')
+        elif m == 23:
+            if name in self.sd:
+                self.selected, self.sd_index = name, 0
+                self._emit(t, 'File opened: {} Size: {}'.format(name, sum(len(line) for line in self.sd[name])))
+                self._emit(t, 'File selected')
+            else:
+                self._emit(t, 'open failed, File: {}.'.format(name))
+        elif m == 24:
+            self.sd_printing = self.selected is not None and self.sd_index < len(self.sd[self.selected])
+        elif m == 25:
+            self.sd_printing = False
+        elif m == 27:
+            if self.sd_printing:
+                lines = self.sd[self.selected]
+                self._emit(t, 'SD printing byte {}/{}'.format(sum(len(line) for line in lines[:self.sd_index]), sum(len(line) for line in lines)))
+            else:
+                self._emit(t, 'Not SD printing')
+        elif m == 28:
+            self.sd[name] = []
+            self.saving = name
+            self._emit(t, 'Writing to file: {}'.format(name))
+        elif m == 30:
+            if self.sd.pop(name, None) is not None:
+                self._emit(t, 'File deleted')
+            else:
+                self._emit(t, 'Deletion failed, File: {}.'.format(name))
+
+    def _destination(self, words):
+        if words.get('F', 0) > 0:
+            self.feedrate = words['F']
+        destination = list(self.position)
+        for i, axis in enumerate('XYZE'):
+            if axis in words:
+                destination[i] = words[axis] + (self.position[i] if self.relative else 0)
+        return destination
+
+    def _plan(self, destination, t):
+        """
+        Adds the move to destination to the planner, waiting for a free slot if it is full, and returns the time it was queued
+        """
+        delta = [b - a for a, b in zip(self.planned, destination)]
+        if all(abs(d)*steps <= DROP_SEGMENTS for d, steps in zip(delta, AXIS_STEPS_PER_UNIT)):
+            return t
+        while self.planner and self.planner[0] <= t:
+            self.planner.popleft()
+        if len(self.planner) >= BLOCK_BUFFER_SIZE:
+            t = self.planner.popleft()
+        start = self.planner[-1] if self.planner else t
+        if self.moving_until is not None and start > self.moving_until:
+            self.starved += start - self.moving_until
+        end = start + move_time(delta, self.feedrate) / self.speedup
+        self.planner.append(end)
+        self.moving_until = end
+        self.planned = list(destination)
+        return t
+
+    def _synchronize(self, t):
+        """
+        Returns the time every planned move is finished (st_synchronize)
+        """
+        if self.planner:
+            t = max(t, self.planner[-1])
+            self.planner.clear()
+        self.moving_until = None
+        return t
+
+    def _arc(self, words, clockwise, t):
+        # Splits the arc in segments of MM_PER_ARC_SEGMENT like mc_arc
+        start = list(self.position)
+        target = self._destination(words)
+        i, j = words.get('I', 0.0), words.get('J', 0.0)
+        center = (start[0] + i, start[1] + j)
+        radius = math.hypot(i, j)
+        angle = math.atan2(-i*(target[1] - center[1]) + j*(target[0] - center[0]), -i*(target[0] - center[0]) - j*(target[1] - center[1]))
+        if angle < 0:
+            angle += 2*math.pi
+        if clockwise:
+            angle -= 2*math.pi
+        if start[:2] == target[:2] and angle == 0:
+            angle += 2*math.pi
+        travel = math.hypot(angle*radius, abs(target[2] - start[2]))
+        if travel < 0.001:
+            return t
+        segments = max(1, int(math.floor(travel / MM_PER_ARC_SEGMENT)))
+        theta0 = math.atan2(-j, -i)
+        for k in range(1, segments):
+            theta = theta0 + angle*k/segments
+            point = [center[0] + radius*math.cos(theta), center[1] + radius*math.sin(theta)]
+            point += [start[n] + (target[n] - start[n])*k/segments for n in (2, 3)]
+            t = self._plan(point, t)
+        t = self._plan(target, t)
+        self.position = target
+        return t
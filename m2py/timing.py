@@ -0,0 +1,209 @@
+# M2PY -- Print time estimation with the motion planner of the M2PCS firmware
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import collections
+import numpy as np
+from gcode import parse_gcode, fill_forward
+from firmware import (BLOCK_BUFFER_SIZE, AXIS_STEPS_PER_UNIT, MAX_FEEDRATE, MAX_ACCELERATION, ACCELERATION, RETRACT_ACCELERATION,
+                      XY_JERK, Z_JERK, E_JERK, MINIMUM_PLANNER_SPEED, MIN_SEGMENT_TIME, HOMING_FEEDRATE, MM_PER_ARC_SEGMENT, DROP_SEGMENTS,
+                      CH_ON_DELAY_TIME, DEFAULT_FEEDRATE)
+
+SYNC_COMMANDS = [b'M3', b'M4', b'M5', b'M6', b'M7', b'M8', b'M9', b'M400']    # Commands that empty the planner besides G4 and G28
+CHANNEL_ON = [b'M3', b'M5', b'M7']                                              # Commands followed by the channel on delay
+
+# Result of estimate_time: times[i] is the time in s spent on the i-th command, cumulative[i] the time at which it is done
+Estimate = collections.namedtuple('Estimate', ['times', 'cumulative'])
+
+# Result of drain_report: estimated total time, time lost to planner drains and to channel on delays in s, and number of synchronizing channel commands
+DrainReport = collections.namedtuple('DrainReport', ['total', 'drain', 'delay', 'syncs'])
+
+def estimate_time(source, feedrate = DEFAULT_FEEDRATE, ch_on_delay = CH_ON_DELAY_TIME, lookahead = BLOCK_BUFFER_SIZE, synchronize = True):
+    """
+    Estimates how long the printer takes to run every command of source, a GCode file name, a Job or any iterable of GCode lines (str or bytes), and returns an Estimate of per-command and cumulative times in s. Blank and comment lines of a file are skipped, so the arrays line up with the lines of Job.load(source).
+
+    Moves follow the firmware's planner (planner.cpp): feedrate, acceleration and jerk limits per axis, trapezoidal speed profiles whose junction speeds are found by the look-ahead over lookahead moves, the SLOWDOWN of short moves while the planner refills and the drop of moves of at most DROP_SEGMENTS steps. G4 dwells, G28 and the channel commands M3-M9 (and M400) wait for the planner to empty (st_synchronize), and M3/M5/M7 then wait for the channel on delay, which starts at ch_on_delay ms and is changed by M50. With synchronize = False the channel commands do not empty the planner, which shows what the drains cost (see drain_report). The planner is assumed to be kept full by the host, as it is with a streaming transport.
+    """
+    return _estimate(parse_gcode(source, feedrate = feedrate), ch_on_delay, lookahead, synchronize)
+
+def drain_report(source, feedrate = DEFAULT_FEEDRATE, ch_on_delay = CH_ON_DELAY_TIME, lookahead = BLOCK_BUFFER_SIZE):
+    """
+    Returns a DrainReport of how much of the estimated print time of source (as for estimate_time) goes into synchronization: every M3-M9 and M400 empties the planner, so the print decelerates to a stop and loses the look-ahead, and M3/M5/M7 then wait for the channel on delay. drain is the difference between the estimates with and without the planner emptying at these commands.
+    """
+    gcode = parse_gcode(source, feedrate = feedrate)
+    total = _estimate(gcode, ch_on_delay, lookahead, True).cumulative
+    free = _estimate(gcode, ch_on_delay, lookahead, False).cumulative
+    if not len(total):
+        return DrainReport(0.0, 0.0, 0.0, 0)
+    syncs = int(np.isin(gcode.command, SYNC_COMMANDS).sum())
+    delay = float(_channel_delays(gcode, ch_on_delay)[np.isin(gcode.command, CHANNEL_ON)].sum() / 1000.)
+    return DrainReport(float(total[-1]), float(total[-1] - free[-1]), delay, syncs)
+
+def _estimate(gcode, ch_on_delay, lookahead, synchronize):
+    owner, start, delta, feed, times = _parse(gcode, ch_on_delay, synchronize)
+    if len(owner):
+        times += np.bincount(owner, weights = _plan(start, delta, feed, lookahead), minlength = len(times))
+    return Estimate(times, np.cumsum(times))
+
+def _channel_delays(gcode, ch_on_delay):
+    """
+    Returns the channel on delay in ms in effect at every command, as set by M50
+    """
+    s = gcode.param('S')
+    return fill_forward((gcode.command == b'M50') & ~np.isnan(s), np.nan_to_num(s).astype(int), ch_on_delay)
+
+def _parse(gcode, ch_on_delay, synchronize = True):
+    """
+    Runs the commands of gcode (GCodeArrays) through the firmware's GCode interpreter, returning for every move segment the index of the command it belongs to, whether it starts after the planner emptied, its (dx, dy, dz, de) in mm and feedrate in mm/min, and the time in s each command waits outside of moves
+    """
+    n = len(gcode.command)
+    before = np.vstack([np.zeros([1, 4]), gcode.position[:-1]])
+    waits = np.zeros(n)
+    dwell = gcode.command == b'G4'
+    seconds = gcode.param('S')
+    waits[dwell] = np.where(np.nan_to_num(seconds[dwell]) != 0, seconds[dwell], np.nan_to_num(gcode.param('P')[dwell]) / 1000.)
+    home = np.flatnonzero(gcode.command == b'G28')
+    homed = ~np.isnan(gcode.params[home, :3])
+    homed[~np.any(homed, axis = 1)] = True
+    waits[home] = np.sum(homed*np.abs(before[home, :3]) / (np.array(HOMING_FEEDRATE[:3]) / 60.), axis = 1)
+    channel_on = np.isin(gcode.command, CHANNEL_ON)
+    waits[channel_on] = _channel_delays(gcode, ch_on_delay)[channel_on] / 1000.
+
+    # A move starts after the planner emptied if a synchronizing command came since the previous one
+    moves = np.flatnonzero(np.isin(gcode.command, [b'G0', b'G1', b'G2', b'G3']))
+    sync = dwell | (gcode.command == b'G28')
+    if synchronize:
+        sync |= np.isin(gcode.command, SYNC_COMMANDS)
+    last_sync = fill_forward(sync, np.arange(n), -1)[moves]
+    synced = np.r_[True, last_sync[1:] > moves[:-1]] if len(moves) else np.zeros(0, dtype = bool)
+
+    owner, start, delta = [moves], [synced], [gcode.position[moves] - before[moves]]
+    arcs = np.isin(gcode.command[moves], [b'G2', b'G3'])
+    owner[0], start[0], delta[0] = moves[~arcs], synced[~arcs], delta[0][~arcs]
+    for c, first in zip(moves[arcs], synced[arcs]):
+        points = _arc_points(before[c], gcode.position[c], np.nan_to_num(gcode.param('I')[c]), np.nan_to_num(gcode.param('J')[c]), gcode.command[c] == b'G2')
+        owner.append(np.full(len(points), c))
+        start.append(np.r_[first, np.zeros(len(points) - 1, dtype = bool)])
+        delta.append(np.diff(np.vstack([before[c], points]), axis = 0))
+    owner, start, delta = np.concatenate(owner), np.concatenate(start), np.concatenate(delta)
+    order = np.argsort(owner, kind = 'stable')
+    owner = owner[order]
+    return owner, start[order], delta[order].reshape(-1, 4), gcode.feedrate[owner], waits
+
+def _arc_points(position, target, i, j, clockwise):
+    """
+    Returns the end points of the segments the firmware splits a G2/G3 arc into (mc_arc), the last one being target
+    """
+    position, target = np.array(position), np.array(target)
+    center = position[:2] + [i, j]
+    radius = np.hypot(i, j)
+    angle = np.arctan2(-i*(target[1] - center[1]) + j*(target[0] - center[0]), -i*(target[0] - center[0]) - j*(target[1] - center[1]))
+    if angle < 0:
+        angle += 2*np.pi
+    if clockwise:
+        angle -= 2*np.pi
+    if np.all(position[:2] == target[:2]) and angle == 0:
+        angle += 2*np.pi
+    travel = np.hypot(angle*radius, abs(target[2] - position[2]))
+    segments = max(1, int(np.floor(travel / MM_PER_ARC_SEGMENT)))
+    k = np.arange(1, segments + 1)[:, None] / float(segments)
+    theta = np.arctan2(-j, -i) + angle*k[:, 0]
+    points = position + (target - position)*k
+    points[:-1, 0] = center[0] + radius*np.cos(theta[:-1])
+    points[:-1, 1] = center[1] + radius*np.sin(theta[:-1])
+    return points
+
+def _plan(start, delta, feed, lookahead):
+    """
+    Returns the time in s of every move segment, planned like plan_buffer_line and planner_recalculate do
+    """
+    steps = np.abs(delta)*AXIS_STEPS_PER_UNIT
+    step_events = np.round(steps).max(axis = 1)
+    time = np.zeros(len(delta))
+    kept = step_events > DROP_SEGMENTS # Dropped moves take no time (the firmware adds them to the next move)
+    group = np.cumsum(start)[kept]
+    start = np.r_[True, group[1:] != group[:-1]] if len(group) else group.astype(bool)
+    delta, steps, step_events, feed = delta[kept], steps[kept], step_events[kept], feed[kept]
+
+    if not len(delta):
+        return time
+    tiny = (np.round(steps[:, :3]) <= DROP_SEGMENTS).all(axis = 1) # Moves of the E axis alone
+    mm = np.where(tiny, np.abs(delta[:, 3]), np.sqrt((delta[:, :3]**2).sum(axis = 1)))
+    inverse_second = feed / 60. / mm
+
+    # SLOWDOWN: the first moves after the planner emptied are stretched to at least MIN_SEGMENT_TIME
+    index = np.arange(len(mm))
+    queued = index - np.maximum.accumulate(np.where(start, index, 0))
+    segment_time = np.round(1e6 / inverse_second)
+    slow = (queued > 1) & (queued < BLOCK_BUFFER_SIZE*0.5) & (segment_time < MIN_SEGMENT_TIME)
+    inverse_second[slow] = 1e6 / (segment_time[slow] + np.round(2*(MIN_SEGMENT_TIME - segment_time[slow]) / queued[slow]))
+
+    # Nominal speed, limited by the maximum feedrate of every axis
+    velocity = delta*inverse_second[:, None]
+    factor = np.minimum(1, (MAX_FEEDRATE / np.maximum(np.abs(velocity), 1e-12)).min(axis = 1))
+    velocity *= factor[:, None]
+    nominal = mm*inverse_second*factor
+
+    # Acceleration, limited per axis in the order the firmware checks them
+    steps_per_mm = step_events / mm
+    xyz = np.round(steps[:, :3]).max(axis = 1) > 0
+    accel_st = np.ceil(np.where(xyz, ACCELERATION, RETRACT_ACCELERATION)*steps_per_mm)
+    for axis in (0, 1, 3, 2):
+        limit = MAX_ACCELERATION[axis]*AXIS_STEPS_PER_UNIT[axis]
+        accel_st = np.where(xyz & (accel_st*np.round(steps[:, axis]) / step_events > limit), limit, accel_st)
+    accel = accel_st / steps_per_mm
+
+    # Maximum junction speed from the jerk limits, the safe speed when the planner was (nearly) empty
+    safe = np.full(len(mm), XY_JERK/2)
+    safe = np.where(np.abs(velocity[:, 2]) > Z_JERK/2, np.minimum(safe, Z_JERK/2), safe)
+    safe = np.where(np.abs(velocity[:, 3]) > E_JERK/2, np.minimum(safe, E_JERK/2), safe)
+    safe = np.minimum(safe, nominal)
+    jump = np.abs(np.diff(velocity, axis = 0, prepend = np.zeros([1, 4])))
+    jerk = np.hypot(jump[:, 0], jump[:, 1])
+    junction_factor = np.ones(len(mm))
+    for value, limit in ((jerk, XY_JERK), (jump[:, 2], Z_JERK), (jump[:, 3], E_JERK)):
+        junction_factor = np.where(value > limit, np.minimum(junction_factor, limit / np.maximum(value, 1e-12)), junction_factor)
+    junction = np.minimum(np.r_[0, nominal[:-1]], nominal*junction_factor)
+    junction = np.where(queued > 1, junction, safe)
+
+    # Look-ahead on squared speeds: every move has to be able to slow down to MINIMUM_PLANNER_SPEED by the end of the planner (the last of lookahead moves, or the next synchronization), and to accelerate from its entry speed to its exit speed
+    final = MINIMUM_PLANNER_SPEED**2
+    w = 2*accel*mm
+    group = np.cumsum(start)
+    inclusive = np.cumsum(w)
+    before = inclusive - w
+    group_start = before[np.flatnonzero(start)][group - 1]
+    before, inclusive = before - group_start, inclusive - group_start
+    last = np.r_[start[1:], True]
+    cap = junction**2
+    cap = np.where(last, np.minimum(cap, final + w), cap)
+    end = np.minimum(index + max(int(lookahead), 1) - 1, len(mm) - 1)
+    cap = np.where(group[end] == group, np.minimum(cap, final + inclusive[end] - before), cap)
+    entry = _group_accumulate(cap + before, group, reverse = True) - before
+    entry = _group_accumulate(entry - before, group) + before
+    exit = np.where(last, final, np.r_[entry[1:], final])
+
+    time[kept] = _trapezoid_time(mm, nominal, accel, entry, exit)
+    return time
+
+def _group_accumulate(values, group, reverse = False):
+    """
+    Running minimum of values within each group of consecutive equal group numbers, from the end of the group if reverse. Offsetting every group by more than the spread of the values keeps the groups apart in a single np.minimum.accumulate.
+    """
+    if not len(values):
+        return values
+    spread = values.max() - values.min() + 1
+    if reverse:
+        return np.minimum.accumulate((values + group*spread)[::-1])[::-1] - group*spread
+    return np.minimum.accumulate(values - group*spread) + group*spread
+
+def _trapezoid_time(mm, nominal, accel, entry, exit):
+    """
+    Time in s to move mm at up to nominal speed with accel, entering at the squared speed entry and leaving at the squared speed exit
+    """
+    nominal2 = nominal**2
+    accelerate = (nominal2 - entry) / (2*accel)
+    decelerate = (nominal2 - exit) / (2*accel)
+    peak = np.sqrt(np.clip((2*accel*mm + entry + exit) / 2, 0, nominal2))
+    cruise = np.maximum(mm - accelerate - decelerate, 0) / nominal
+    return (2*peak - np.sqrt(entry) - np.sqrt(exit)) / accel + cruise
@@ -0,0 +1,362 @@
+# M2PY -- Serial transport used by the Makergear class to talk to the M2PCS firmware
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+# Importing of necessary dependent modules
+import collections
+import re
+import threading
+import time
+import serial
+from firmware import BUFSIZE, RX_BUFFER_SIZE
+
+# A single line received from the printer, parsed by parse_response
+# kind is one of 'ok', 'resend', 'error', 'temperature', 'echo' or 'other'
+# value holds the requested line number for 'resend' and a dict of temperatures for 'temperature' (and 'ok' lines carrying a temperature report)
+Response = collections.namedtuple('Response', ['kind', 'text', 'value'])
+
+TEMPERATURE = re.compile(r'\b([TB]\d?):\s*(-?\d+\.?\d*)')
+
+def parse_response(read):
+    """
+    Parses a raw line read from the printer into a typed Response
+    """
+    text = read.decode('ascii', 'replace').strip()
+    temps = dict((key, float(val)) for key, val in TEMPERATURE.findall(text)) or None
+    if text.startswith('ok'):
+        return Response('ok', text, temps)
+    elif text.startswith('Resend:') or text.startswith('rs '):
+        return Response('resend', text, int(re.sub(r'[^0-9]', '', text.split(None, 1)[-1]) or 0))
+    elif text.startswith('Error:') or text.startswith('!!'):
+        return Response('error', text, None)
+    elif temps is not None:
+        return Response('temperature', text, temps)
+    elif text.startswith('echo:'):
+        return Response('echo', text, None)
+    return Response('other', text, None)
+
+def number_line(cmd, number):
+    """
+    Returns the encoded line 'N<number> <cmd>*<checksum>', the checksum being the XOR of every byte before the '*'
+    """
+    if not isinstance(cmd, bytes):
+        cmd = str.encode(str(cmd))
+    body = str.encode('N{} '.format(number)) + cmd
+    checksum = 0
+    for byte in body:
+        checksum ^= byte
+    return body + str.encode('*{}\n'.format(checksum))
+
+def handshake(handle, deadline = 10, reset_wait = 2.5):
+    """
+    Waits until the printer on the opened handle is ready and returns every line it sent meanwhile. Nothing may be sent while the bootloader runs after a reset, so the printer is only probed with M115 once the firmware's 'start' line arrived, or after reset_wait seconds without one (the board did not reset). The printer is ready as soon as it answers with its firmware report and 'ok'. Raises serial.SerialException if it does not answer within deadline seconds or the firmware is not Marlin.
+    """
+    timeout = handle.timeout
+    handle.timeout = 0.05
+    try:
+        start = time.time()
+        lines = []
+        probed = False
+        report = None
+        while True:
+            elapsed = time.time() - start
+            if elapsed > deadline:
+                raise serial.SerialException('Printer did not answer within {} s, last lines received: {}'.format(deadline, lines[-3:]))
+            if not probed and ('start' in lines or elapsed > reset_wait):
+                handle.write(b'M115\n')
+                probed = True
+            read = handle.readline()
+            if not read:
+                continue
+            text = read.decode('ascii', 'replace').strip()
+            lines.append(text)
+            if text.startswith('FIRMWARE_NAME'):
+                report = text
+            elif text.startswith('ok') and report is not None:
+                break
+    finally:
+        handle.timeout = timeout
+    if 'Marlin' not in report:
+        raise serial.SerialException('Unexpected firmware: {}'.format(report))
+    return lines
+
+def connect(com, baud, stream = 'off', window = BUFSIZE - 1, checksum = False, timeout = 1, deadline = 10, log = None):
+    """
+    Opens the serial port com (or uses com directly if it is an already opened serial-like object), waits for the printer to be ready (see handshake) and returns a Transport for it. For com = 'm2py://host:port' a session with the PrinterDaemon at that address is opened instead (log, a CommandLog, is then not used).
+    """
+    if isinstance(com, str) and com.startswith('m2py://'): # A printer kept connected by a PrinterDaemon
+        from daemon import DaemonTransport
+        return DaemonTransport(com)
+    elif isinstance(com, str):
+        handle = serial.Serial(com, baud, timeout = timeout)
+    else: # An already opened serial-like object (e.g. a simulated printer)
+        handle = com
+    banner = handshake(handle, deadline = deadline)
+    transport = Transport(handle, stream = stream, window = window, checksum = checksum, log = log)
+    transport.banner = banner
+    return transport
+
+class Transport:
+    """
+    Sends lines of GCode over an open serial handle. A background reader thread parses every line coming back from the printer and wakes up the sender as soon as an 'ok' arrives.
+
+    stream = 'off' sends one line at a time and blocks until the printer answers 'ok' (the original M2PY behaviour).
+    stream = 'ok' keeps up to window commands in flight, counting one free command slot per 'ok' received, and never more unacknowledged bytes than fit in the firmware's serial receive buffer (rx_buffer).
+    stream = 'char' keeps the unacknowledged bytes below the firmware's serial receive buffer (rx_buffer), which is the most conservative streaming mode.
+
+    With checksum = True every line is sent as 'N<line number> <command>*<checksum>', the last history lines are kept in a ring buffer and everything from the requested line onwards is sent again when the firmware answers 'Resend:'. Lines lost without any answer (e.g. to a receive buffer overrun) are sent again once the printer has been silent for stall seconds with lines in flight.
+
+    With log = CommandLog() the enqueue, write and 'ok' times and the length of every line are recorded in it (see instrument.py); without a log nothing is recorded.
+    """
+    def __init__(self, handle, stream = 'off', window = BUFSIZE - 1, rx_buffer = RX_BUFFER_SIZE, checksum = False, history = 1024, stall = 10, log = None):
+        if stream not in ('off', 'ok', 'char'):
+            raise ValueError('Unknown stream mode {}, use \'off\', \'ok\' or \'char\''.format(stream))
+        self.handle = handle
+        self.stream = stream
+        self.window = max(1, int(window))
+        self.rx_buffer = rx_buffer
+        self.checksum = checksum
+        self.stall = stall
+        self.log = log                      # CommandLog recording the timing of every line, or None
+        self.inflight = collections.deque() # (line number, byte length, log record) of the lines still waiting for an 'ok'
+        self.inflight_bytes = 0
+        self.ring = collections.deque(maxlen = max(history, self.window + 1)) # (line number, encoded line, log record) of the most recently sent lines
+        self.line_number = 0                # Line number of the last numbered line sent
+        self.skip_ok = 0                    # 'ok's that answer a 'Resend:' rather than a command
+        self.resend_from = None             # Line number of the last replay
+        self.stale = 0                      # Lines that were already on the wire when the last replay started
+        self.ignored = 0                    # 'Resend:' requests taken for duplicates since the last replay
+        self.fault = None                   # Unrecoverable transport error, raised on the next send
+        self.sent = 0                       # Number of lines written so far
+        self.acked = 0                      # Number of lines acknowledged so far
+        self.temperature = None             # Latest temperature report
+        self.errors = []                    # Every 'error' response received
+        self.history = collections.deque(maxlen = 100) # Most recent responses, for debugging
+        self.banner = []                    # Lines received while connecting
+        self.state = None                   # Makergear state kept across connections (only by a PrinterDaemon)
+        self.last_response = time.time()    # Time the last line was received
+        self.handlers = []                  # Functions called with every Response, from the reader thread
+        self.cond = threading.Condition()
+        self.running = True
+        self.reader = threading.Thread(target = self._read_loop, name = 'm2py-reader', daemon = True)
+        self.reader.start()
+        if self.checksum:
+            self.reset_line_numbers()
+
+    def reset_line_numbers(self):
+        """
+        Sends M110 so that the firmware restarts counting lines from 0
+        """
+        with self.cond:
+            self.line_number = -1
+            self.ring.clear()
+        self.send('M110')
+
+    def send(self, cmd):
+        """
+        Sends a single line of GCode (str or pre-encoded bytes, without the newline). In blocking mode this returns once the printer answered 'ok', in streaming mode it returns as soon as the printer has room for the line.
+        """
+        with self.cond:
+            if not isinstance(cmd, bytes):
+                cmd = str.encode(str(cmd))
+            record = self.log.enqueue(cmd) if self.log is not None else None
+            if self.checksum:
+                number = self.line_number + 1
+                line = number_line(cmd, number)
+            else:
+                number = None
+                line = cmd + b'\n'
+            while not self.has_room(len(line)):
+                self.check_fault()
+                self.cond.wait()
+            self.check_fault()
+            if self.checksum:
+                self.line_number = number
+                self.ring.append((number, line, record))
+            self.inflight.append((number, len(line), record))
+            self.inflight_bytes += len(line)
+            self.sent += 1
+            seq = self.sent
+            if record is not None:
+                self.log.write(record, len(line))
+            self.handle.write(line)
+            if self.stream == 'off':
+                while self.acked < seq: #Waits for printer to send 'ok' command before sending the next command, ensuring print accuracy
+                    self.check_fault()
+                    self.cond.wait()
+            if record is not None:
+                self.log.release(record)
+
+    def query(self, cmd):
+        """
+        Sends cmd once every earlier line was acknowledged, waits for its 'ok' and returns the text of every line the printer answered before it (e.g. the report of M27 or M114)
+        """
+        lines = []
+        def collect(response):
+            if response.kind != 'ok':
+                lines.append(response.text)
+        self.drain()
+        self.handlers.append(collect)
+        try:
+            self.send(cmd)
+            self.drain()
+        finally:
+            self.handlers.remove(collect)
+        return lines
+
+    def send_unacknowledged(self, cmd, answer, timeout = 10):
+        """
+        Sends cmd once every earlier line was acknowledged, for the commands the firmware answers with a line starting with answer instead of 'ok' (e.g. M29 and 'Done saving file'). cmd is written outside of the acknowledgement count, without line number, and the text of the answer is returned. Raises serial.SerialException if it does not arrive within timeout seconds.
+        """
+        if not isinstance(cmd, bytes):
+            cmd = str.encode(str(cmd))
+        answered = []
+        received = threading.Event()
+        def collect(response):
+            if response.text.startswith(answer):
+                answered.append(response.text)
+                received.set()
+        self.drain()
+        self.handlers.append(collect)
+        try:
+            with self.cond:
+                self.check_fault()
+                self.handle.write(cmd + b'\n')
+            if not received.wait(timeout):
+                self.check_fault()
+                raise serial.SerialException('The printer did not answer {} with {}'.format(cmd.decode('ascii', 'replace'), answer))
+        finally:
+            self.handlers.remove(collect)
+        return answered[0]
+
+    def check_fault(self):
+        """
+        Raises the error recorded by the reader thread, if any
+        """
+        if self.fault is not None:
+            raise self.fault
+
+    def has_room(self, nbytes):
+        """
+        Returns True if a line of nbytes can be sent without overrunning the firmware buffers
+        """
+        if not self.inflight:
+            return True
+        if self.stream == 'off':
+            return False
+        elif self.stream == 'char':
+            return self.inflight_bytes + nbytes < self.rx_buffer
+        # Lines only leave the receive buffer as the firmware parses them, so the 'ok' window is also capped by its size
+        return len(self.inflight) < self.window and self.inflight_bytes + nbytes < self.rx_buffer
+
+    def emergency_stop(self):
+        """
+        Sends M112 immediately, ahead of anything waiting for room in the window. The firmware acts on it as soon as it is received.
+        """
+        with self.cond:
+            self.handle.write(b'M112\n')
+            # The printer is halted, so nothing in flight will ever be acknowledged
+            self.inflight.clear()
+            self.inflight_bytes = 0
+            self.cond.notify_all()
+
+    def drain(self):
+        """
+        Waits until every line sent so far has been acknowledged by the printer
+        """
+        with self.cond:
+            while self.inflight:
+                self.check_fault()
+                self.cond.wait()
+            if not self.running:
+                self.check_fault() # The port failed, so even lines written before may not have arrived
+
+    def close(self):
+        """
+        Waits for the outstanding acknowledgements, stops the reader thread and closes the serial handle. The handle is closed even if the connection failed, and the failure is raised.
+        """
+        try:
+            self.drain()
+        finally:
+            self.running = False
+            self.reader.join()
+            self.handle.close()
+
+    def _read_loop(self):
+        try:
+            while self.running:
+                read = self.handle.readline()
+                if read:
+                    self._dispatch(parse_response(read))
+                elif self.checksum:
+                    with self.cond:
+                        # The printer went quiet with lines in flight, either right after requests taken for duplicates or for stall seconds, so those lines were lost
+                        if self.inflight and self.inflight[0][0] is not None and (self.ignored or time.time() - self.last_response > self.stall):
+                            self._replay(self.inflight[0][0])
+                            self.last_response = time.time()
+                            self.cond.notify_all()
+        except Exception as error:
+            # The port failed (e.g. the USB cable was unplugged): nothing will be acknowledged anymore, so every waiting send or drain raises the error
+            with self.cond:
+                self.fault = error
+                self.running = False
+                self.cond.notify_all()
+
+    def _dispatch(self, response):
+        with self.cond:
+            self.history.append(response)
+            self.last_response = time.time()
+            if response.kind == 'ok':
+                if self.skip_ok:
+                    self.skip_ok -= 1
+                elif self.inflight:
+                    _, nbytes, record = self.inflight.popleft()
+                    self.inflight_bytes -= nbytes
+                    self.acked += 1
+                    if record is not None:
+                        self.log.ack(record)
+                self.cond.notify_all()
+            elif response.kind == 'resend':
+                self._resend(response.value)
+                self.cond.notify_all()
+            elif response.kind == 'error':
+                self.errors.append(response)
+                if 'halted' in response.text: # 'Error:Printer halted. kill() called!', nothing will be acknowledged anymore
+                    self.fault = serial.SerialException('Printer halted: {}'.format(response.text))
+                    self.cond.notify_all()
+            if response.value is not None and response.kind in ('ok', 'temperature'):
+                self.temperature = response.value
+        for handler in list(self.handlers):
+            handler(response)
+
+    def _resend(self, number):
+        # Every 'Resend:' is followed by an 'ok' that does not acknowledge a command
+        self.skip_ok += 1
+        if not self.checksum:
+            return
+        if number == self.resend_from and self.stale > 0:
+            # Lines written before the replay started are rejected with the same request, the replay already covers them
+            self.stale -= 1
+            self.ignored += 1
+            return
+        self._replay(number)
+
+    def _replay(self, number):
+        if not self.ring or not self.ring[0][0] <= number <= self.line_number + 1:
+            self.fault = serial.SerialException('Printer requested line {} which is no longer in the resend buffer'.format(number))
+            self.cond.notify_all()
+            return
+
+        # Lines from the requested one onwards were rejected or flushed by the firmware and will never be acknowledged
+        while self.inflight and self.inflight[-1][0] is not None and self.inflight[-1][0] >= number:
+            self.inflight_bytes -= self.inflight.pop()[1]
+        self.sent = self.acked + len(self.inflight)
+        self.resend_from = number
+        self.stale = self.line_number - number
+        self.ignored = 0
+        for lineno, line, record in list(self.ring)[number - self.ring[0][0]:]:
+            self.inflight.append((lineno, len(line), record))
+            self.inflight_bytes += len(line)
+            if record is not None:
+                self.log.resend(record)
+            self.sent += 1
+            self.handle.write(line)
@@ -0,0 +1,7 @@
+# M2PY -- Test configuration: the modules in m2py/ import each other by their flat names
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm2py'))
@@ -0,0 +1,46 @@
+# M2PY -- Simulated printers with faults, shared by the tests
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import time
+import serial
+from simulator import Simulator
+
+class UnpluggedPrinter(Simulator):
+    """
+    Simulated printer whose port fails once unplugged is set (or once it received after lines), like a USB cable being pulled
+    """
+    unplugged = False
+    after = None
+
+    def readline(self):
+        if self.unplugged or (self.after is not None and self.received >= self.after):
+            raise serial.SerialException('device reports readiness to read but returned no data')
+        return Simulator.readline(self)
+
+class SilentPrinter(Simulator):
+    """
+    Simulated printer that never answers, like a board stuck in its bootloader. Everything written to it is kept in written.
+    """
+    def write(self, data):
+        self.written = getattr(self, 'written', b'') + data
+        return Simulator.write(self, data)
+
+    def _emit(self, t, text):
+        pass
+
+class RepetierPrinter(Simulator):
+    """
+    Simulated printer reporting another firmware than Marlin
+    """
+    def _emit(self, t, text):
+        Simulator._emit(self, t, text.replace('Marlin', 'Repetier'))
+
+class SlowPrinter(Simulator):
+    """
+    Simulated printer whose port takes delay seconds for every write, like a congested USB hub
+    """
+    delay = 0
+
+    def write(self, data):
+        time.sleep(self.delay)
+        return Simulator.write(self, data)
@@ -0,0 +1,79 @@
+# M2PY -- Regression tests of the asyncio transport against the simulated printer
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import asyncio
+import gc
+import time
+import pytest
+import serial
+from aio import connect_async
+from printers import UnpluggedPrinter, SlowPrinter
+from m2py import AsyncMakergear
+
+def test_pending_lines_fail_when_the_port_fails():
+    async def run():
+        printer = UnpluggedPrinter(boot = 0)
+        transport = await connect_async(printer, 115200)
+        await transport.send('G1 X1')
+        futures = [transport.submit('G1 X{} Y1'.format(i)) for i in range(50)]
+        printer.unplugged = True
+        done, pending = await asyncio.wait(futures, timeout = 5)
+        assert not pending
+        failed = [future.exception() for future in futures if future.exception() is not None]
+        assert failed and all(isinstance(error, serial.SerialException) for error in failed)
+        with pytest.raises(serial.SerialException):
+            await asyncio.wait_for(transport.drain(), 5)
+        with pytest.raises(serial.SerialException):
+            await transport.send('G1 X0')
+        with pytest.raises(serial.SerialException):
+            await transport.close()
+    asyncio.run(run())
+
+def test_slow_writes_do_not_block_the_event_loop():
+    async def run():
+        printer = SlowPrinter(boot = 0, speedup = 50)
+        transport = await connect_async(printer, 115200)
+        printer.delay = 0.5
+        ticks = []
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.005)
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0)
+        await asyncio.gather(*[transport.submit('G1 X{}'.format(i)) for i in range(4)])
+        ticks.append(time.perf_counter())
+        task.cancel()
+        await transport.close()
+        return max(later - earlier for earlier, later in zip(ticks, ticks[1:]))
+    # Writing on the event loop would stall it for the delays of all the lines in a row, not even one of them may pass without a tick
+    assert asyncio.run(run()) < 0.5
+
+def test_failed_lines_that_were_never_awaited_do_not_warn():
+    async def run():
+        unretrieved = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unretrieved.append(context['message']))
+        printer = UnpluggedPrinter(boot = 0)
+        transport = await connect_async(printer, 115200)
+        for i in range(20):
+            transport.submit('G1 X{}'.format(i))
+        printer.unplugged = True
+        with pytest.raises(serial.SerialException):
+            await asyncio.wait_for(transport.drain(), 5)
+        transport.submit('G1 X0')
+        with pytest.raises(serial.SerialException):
+            await transport.close()
+        gc.collect()
+        return unretrieved
+    assert asyncio.run(run()) == []
+
+def test_async_makergear_tracks_the_state_like_makergear():
+    async def run():
+        mk = await AsyncMakergear.connect(SlowPrinter(boot = 0, speedup = 50), 115200, verbose = False)
+        mk.coord_sys('rel')
+        mk.move(x = 1, y = 2)
+        await mk.move(z = 3)
+        assert mk.printout == 1 and mk.current_coord_sys == 'rel'
+        assert list(mk.coords) == [1, 2, 3]
+        await mk.close()
+    asyncio.run(run())
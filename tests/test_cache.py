@@ -0,0 +1,39 @@
+# M2PY -- Tests of the command cache that keeps redundant commands off the wire
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+from cache import StateCache
+
+def test_repeated_state_changes_are_dropped():
+    cache = StateCache()
+    assert cache.filter('G91') == 'G91'
+    assert cache.filter('G91') is None
+    assert cache.filter('M3') == 'M3'
+    assert cache.filter('M3') is None
+    assert cache.filter('M4') == 'M4'
+    assert cache.filter('M9 S20') == 'M9 S20'
+    assert cache.filter('M9 S20') is None
+    assert cache.redundant == 3
+
+def test_feedrate_is_folded_into_the_next_move():
+    cache = StateCache()
+    assert cache.filter('G1 F600') is None
+    assert cache.filter(b'G1 X1') == b'G1 X1 F600'
+    assert cache.filter('G1 F600') is None
+    assert cache.filter('G1 X2') == 'G1 X2'
+    assert cache.filter('G1 F1200') is None
+    assert cache.flush() == 'G1 F1200'
+    assert cache.flush() is None
+    assert cache.folded == 1
+
+def test_strict_cache_sends_everything():
+    cache = StateCache(strict = True)
+    assert cache.filter('M3') == 'M3'
+    assert cache.filter('M3') == 'M3'
+    assert cache.filter('G1 F600') == 'G1 F600'
+    assert cache.redundant == 1
+
+def test_emergency_stop_forgets_the_state():
+    cache = StateCache()
+    cache.filter('M3')
+    cache.filter('M112')
+    assert cache.filter('M3') == 'M3'
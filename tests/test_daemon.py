@@ -0,0 +1,38 @@
+# M2PY -- Tests of the printer daemon handing the printer state over from one script to the next
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import pytest
+from daemon import PrinterDaemon
+from m2py import Makergear
+from simulator import Simulator
+
+@pytest.fixture
+def daemon():
+    printer = Simulator(boot = 0, speedup = 50, record = True)
+    daemon = PrinterDaemon(printer, 115200, address = 'm2py://127.0.0.1:0', verbose = False).start()
+    yield daemon
+    daemon.shutdown()
+    daemon.close()
+
+def test_state_is_handed_over_between_sessions(daemon):
+    first = Makergear(daemon.address, 115200, printout = 1, verbose = False)
+    first.coord_sys('rel')
+    first.move(x = 1)
+    first.move(x = 1, y = 2)
+    first.close()
+
+    second = Makergear(daemon.address, 115200, printout = 1, verbose = False)
+    state = second.get_state()
+    assert state['coords'] == [2, 2, 0]
+    assert state['coord_sys'] == 'rel'
+    assert state['channels'] == [0, 0, 0]
+    assert state['firmware']['relative'] is True
+    second.coord_sys('rel')  # Already set by the first script, dropped by the cache
+    for i in range(3):
+        second.move(x = 1)
+    second.close()
+
+    printer = daemon.transport.handle
+    assert printer.position[:3] == pytest.approx([5, 2, 0])
+    assert printer.commands.count('G91') == 1
+    assert daemon.sessions == 2
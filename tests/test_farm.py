@@ -0,0 +1,22 @@
+# M2PY -- Regression tests of the print farm against simulated printers
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import serial
+from farm import Farm
+from job import Job
+from simulator import Simulator
+from printers import UnpluggedPrinter
+
+def test_a_disconnected_printer_does_not_stop_the_others():
+    job = Job()
+    job.send('G91')
+    for i in range(100):
+        job.send('G1 X{} Y0.25'.format(0.5 if i % 2 else -0.5))
+    unplugged = UnpluggedPrinter(boot = 0, speedup = 20)
+    unplugged.after = 30
+    printers = [Simulator(boot = 0, speedup = 20), unplugged, Simulator(boot = 0, speedup = 20)]
+    results = Farm([(printer, job) for printer in printers], verbose = False).run()
+    assert [printer.state for printer in results] == ['done', 'failed', 'done']
+    assert isinstance(results[1].error, serial.SerialException)
+    assert results[0].acked == results[2].acked == len(job)
+    assert results[1].acked < len(job)
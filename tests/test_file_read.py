@@ -0,0 +1,44 @@
+# M2PY -- Tests of streaming GCode files: reading them in chunks, shifting them and sending them with file_read
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import pytest
+import m2py
+from gcode import read_gcode, translate_gcode
+from job import Sender
+from simulator import Simulator
+
+GCODE = b'; header\nG90\r\nG1 X10 Y-2.5 F1200 ; move\n\n   \nM3\nG91\nG1 X1 Y1\nG90\nG2 X12 Y0 I1 J0\nG92 X0 Y0\nG28 X0\nG1 Z1'
+
+def test_read_gcode_skips_comments_and_blank_lines_across_chunks(tmp_path):
+    fid = tmp_path / 'part.gcode'
+    fid.write_bytes(GCODE)
+    lines = list(read_gcode(str(fid)))
+    assert [line for line, offset in lines] == [b'G90', b'G1 X10 Y-2.5 F1200', b'M3', b'G91', b'G1 X1 Y1', b'G90', b'G2 X12 Y0 I1 J0', b'G92 X0 Y0', b'G28 X0', b'G1 Z1']
+    assert lines[0][1] == len(b'; header\nG90\r\n')
+    assert lines[-1][1] == len(GCODE) + 1 # The last line has no newline
+    assert list(read_gcode(str(fid), chunk_size = 3)) == lines
+
+def test_translate_gcode_shifts_absolute_coordinates_only():
+    lines = [b'G90', b'G1 X10 Y-2.5 F1200', b'M3', b'G91', b'G1 X1 Y1', b'G90', b'G2 X12 Y0 I1 J0', b'G92 X0 Y0', b'G28 X0', b'G1 Z1']
+    shifted = list(translate_gcode([(line, offset) for offset, line in enumerate(lines)], dx = 5, dy = -1))
+    assert [offset for line, offset in shifted] == list(range(len(lines)))
+    assert [line for line, offset in shifted] == [b'G90', b'G1 X15 Y-3.5 F1200', b'M3', b'G91', b'G1 X1 Y1', b'G90', b'G2 X17 Y-1 I1 J0', b'G92 X5 Y-1', b'G28 X0', b'G1 Z1']
+
+def test_file_read_sends_the_shifted_file(tmp_path, capsys):
+    fid = tmp_path / 'part.gcode'
+    fid.write_bytes(b'G90\nG1 X10 Y5 F6000\nG1 X20\nG91\nG1 Y1\n')
+    printer = Simulator(boot = 0, speedup = 50, record = True)
+    m2py.file_read(str(fid), printer, 115200, dx = 1, dy = 2, progress = 60)
+    assert printer.commands[-5:] == ['G90', 'G1 X11 Y7 F6000', 'G1 X21', 'G91', 'G1 Y1']
+    assert capsys.readouterr().out.endswith('Print complete!\nSerial port closed\n')
+
+def test_file_read_reports_an_interrupted_print(tmp_path, capsys, monkeypatch):
+    fid = tmp_path / 'part.gcode'
+    fid.write_bytes(b'G1 X1\n')
+    def interrupted(self):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(Sender, 'run', interrupted)
+    m2py.file_read(str(fid), Simulator(boot = 0, speedup = 50), 115200)
+    out = capsys.readouterr().out
+    assert out.endswith('Print aborted\nSerial port closed\n')
+    assert 'Print complete!' not in out
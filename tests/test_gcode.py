@@ -0,0 +1,94 @@
+# M2PY -- Tests of the GCode move encoder and the vectorized parser
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import numpy as np
+import pytest
+from gcode import MoveEncoder, GCodeParser, parse_gcode
+
+def test_absolute_moves_leave_out_unchanged_axes():
+    encoder = MoveEncoder()
+    assert encoder.move(1, 2, 0.5) == b'G1 X1 Y2 Z0.5'
+    assert encoder.move(1, 3, 0.5) == b'G1 Y3'
+    assert encoder.move(1, 3, 0.5) is None
+    encoder.forget('X')
+    assert encoder.move(1, 3, 0.5) == b'G1 X1'
+
+def test_relative_rounding_never_accumulates():
+    encoder = MoveEncoder()
+    encoder.relative = True
+    lines = [encoder.move(x = 0.0004) for i in range(1000)]
+    total = sum(float(line.split(b'X')[1]) for line in lines if line is not None)
+    assert total == pytest.approx(0.4, abs = 1e-3)
+    assert lines[0] is None
+
+def test_homing_and_set_position_are_followed():
+    encoder = MoveEncoder()
+    encoder.move(5, 5, 5)
+    encoder.home('X Y')
+    assert encoder.move(0, 0, 5) is None
+    encoder.set_position(z = 1)
+    assert encoder.move(0, 0, 5) == b'G1 Z5'
+
+GCODE = b'''G90
+G1 X10 Y5 F600 ; comment
+M3
+G91
+G1 X1 Y1 Z0.2
+g1 x 1
+M4
+G92 X0
+G1 X2
+G28 Y
+G90
+G1 Z3
+'''
+
+def test_parser_follows_the_modal_state():
+    gcode = parse_gcode(GCODE)
+    assert list(gcode.command) == [b'G90', b'G1', b'M3', b'G91', b'G1', b'G1', b'M4', b'G92', b'G1', b'G28', b'G90', b'G1']
+    assert gcode.position[:, :3].tolist() == [[0, 0, 0], [10, 5, 0], [10, 5, 0], [10, 5, 0], [11, 6, 0.2], [12, 6, 0.2], [12, 6, 0.2],
+                                               [0, 6, 0.2], [2, 6, 0.2], [2, 0, 0.2], [2, 0, 0.2], [2, 0, 3]]
+    assert list(gcode.channels) == [0, 0, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0]
+    assert list(gcode.relative) == [False]*3 + [True]*7 + [False]*2
+    assert np.all(gcode.feedrate[1:] == 600)
+
+@pytest.mark.parametrize('chunk_size', [1, 16, 64])
+def test_parser_state_carries_across_chunks(chunk_size):
+    whole = parse_gcode(GCODE)
+    chunked = parse_gcode(GCODE, chunk_size = chunk_size)
+    assert np.array_equal(whole.params, chunked.params, equal_nan = True)
+    for field in ('command', 'position', 'feedrate', 'relative', 'channels'):
+        assert np.array_equal(getattr(whole, field), getattr(chunked, field))
+
+def test_parser_keeps_the_state_between_buffers():
+    parser = GCodeParser()
+    parser.parse(b'G91\nG1 X1\n')
+    gcode = parser.parse(b'G1 X1\n')
+    assert gcode.position[0, 0] == 2
+
+def sampled_gcode(lines = 3000):
+    rows = ['; sampled', 'G90', 'M3']
+    for i in range(lines):
+        rows.append('G1 X{} Y{} E{}'.format(i % 37, (i * 7) % 23, i))
+        if i % 250 == 0:
+            rows += ['g1 z{} ; layer'.format(i // 250), 'M5', 'G 28 X', 'G92 Y5', 'N7 G0 X3*91', 'G2 X5 Y5 I1 J0', 'M3']
+        if i % 400 == 0:
+            rows += ['', 'G1 Y{}'.format(i % 11), 'G1 E-1']
+    return ('\n'.join(rows) + '\n').encode()
+
+def test_sample_returns_exact_rows_of_the_full_parse():
+    data = sampled_gcode()
+    full_parser, sample_parser = GCodeParser(), GCodeParser()
+    full, sampled = full_parser.parse(data), sample_parser.sample(data, 50)
+    assert 100 <= len(sampled.command) < len(full.command) / 4
+    # Every command other than a G0/G1 move is kept
+    for command in [b'M3', b'M5', b'G28', b'G92', b'G2', b'G90']:
+        assert np.sum(sampled.command == command) == np.sum(full.command == command)
+    rows = {(command, tuple(position), channels) for command, position, channels in zip(full.command, full.position[:, :3].tolist(), full.channels)}
+    assert all((command, tuple(position), channels) in rows for command, position, channels in zip(sampled.command, sampled.position[:, :3].tolist(), sampled.channels))
+    assert sample_parser.position[:3].tolist() == full_parser.position[:3].tolist()
+    assert sample_parser.channels == full_parser.channels
+
+def test_sample_parses_relative_buffers_in_full():
+    data = sampled_gcode().replace(b'G90\n', b'G91\n')
+    assert len(GCodeParser().sample(data, 50).command) == len(GCodeParser().parse(data).command)
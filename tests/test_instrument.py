@@ -0,0 +1,45 @@
+# M2PY -- Tests of the command timing log
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import numpy as np
+import pytest
+from simulator import Simulator
+from transport import connect
+from instrument import CommandLog
+
+def test_ring_buffer_keeps_the_last_commands():
+    log = CommandLog(capacity = 4)
+    records = [log.enqueue('G1 X{}'.format(i).encode()) for i in range(5)] + [log.enqueue(b'M400')]
+    log.ack(records[0]) # Already overwritten
+    log.ack(records[-1])
+    r = log.records()
+    assert len(log) == 4
+    assert r['id'].tolist() == [2, 3, 4, 5]
+    assert r['sync'].tolist() == [False, False, False, True]
+    assert np.isnan(r['acked'][:3]).all() and not np.isnan(r['acked'][3])
+    assert log.summary().commands == 4 and log.summary().acked == 1
+
+def test_every_line_is_recorded_through_the_transport(tmp_path):
+    log = CommandLog()
+    printer = Simulator(boot = 0, speedup = 20, noise = 0.05, seed = 1)
+    transport = connect(printer, 115200, stream = 'char', checksum = True, log = log)
+    for i in range(40):
+        transport.send('G1 X{} F6000'.format(i % 2))
+    transport.send('M400')
+    transport.drain()
+    transport.close()
+    r = log.records()
+    # The M110 resetting the line numbers comes first
+    assert len(log) == 42
+    assert np.all(r['enqueued'] <= r['written']) and np.all(r['written'] <= r['acked'])
+    assert np.all(r['bytes'] > 0)
+    summary = log.summary()
+    assert summary.commands == summary.acked == 42
+    assert summary.resent == printer.resends > 0
+    assert summary.bytes == r['bytes'].sum()
+    assert summary.sync > 0 and summary.latency_p50 <= summary.latency_p99
+    log.save(tmp_path / 'log.csv')
+    table = np.loadtxt(tmp_path / 'log.csv', delimiter = ',', skiprows = 1)
+    assert table[:, 0].tolist() == r['id'].tolist()
+    log.save(tmp_path / 'log.npz')
+    assert np.load(tmp_path / 'log.npz')['acked'] == pytest.approx(r['acked'])
@@ -0,0 +1,60 @@
+# M2PY -- Tests of recorded jobs and of the Sender streaming them
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import threading
+import time
+import pytest
+from job import Job, Sender
+from simulator import Simulator
+from transport import connect
+
+LINES = [b'G91', b'G1 X1 F6000', b'M3', b'G1 Y1', b'M5']
+
+def test_job_round_trips_through_a_gcode_file(tmp_path):
+    job = Job(line.decode() for line in LINES)
+    assert len(job) == 5 and list(job) == LINES
+    assert job[0] == b'G91' and job[4] == b'M5'
+    assert job.compile() == b'\n'.join(LINES) + b'\n'
+    job.save(str(tmp_path / 'job.gcode'))
+    with open(str(tmp_path / 'job.gcode'), 'ab') as gcode:
+        gcode.write(b'; comment\n\nG1 X2 ; move\n')
+    assert list(Job.load(str(tmp_path / 'job.gcode'))) == LINES + [b'G1 X2']
+
+def test_job_plays_every_line_to_the_printer():
+    printer = Simulator(boot = 0, speedup = 50, record = True)
+    Job(LINES).play(printer, 115200, verbose = False)
+    assert printer.commands[-5:] == [line.decode() for line in LINES]
+    assert printer.position[:2] == pytest.approx([1, 1])
+
+def numbered(count):
+    return ((str.encode('G1 X{}'.format(i)), i + 1) for i in range(count))
+
+def test_paused_sender_waits_for_resume():
+    job = Job()
+    sender = Sender(job, numbered(100), total = 100, verbose = False)
+    sender.pause()
+    sender.start(close = False)
+    time.sleep(0.1)
+    assert sender.sent == 0 and len(job) == 0
+    sender.resume()
+    sender.join(5)
+    assert len(job) == 100 and sender.position == 100
+
+def test_aborted_sender_stops_sending():
+    job = Job()
+    sender = Sender(job, numbered(100), verbose = False)
+    sender.pause()
+    threading.Timer(0.05, sender.abort).start()
+    assert sender.run() is False
+    assert len(job) == 0
+
+def test_emergency_abort_halts_the_printer():
+    printer = Simulator(boot = 0, speedup = 50)
+    transport = connect(printer, 115200)
+    sender = Sender(transport, numbered(100), verbose = False)
+    sender.pause()
+    threading.Timer(0.05, sender.abort, kwargs = {'emergency': True}).start()
+    assert sender.run() is False
+    time.sleep(0.1)
+    assert printer.killed and sender.sent == 0
+    transport.close()
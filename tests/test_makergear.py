@@ -0,0 +1,58 @@
+# M2PY -- Regression tests of the Makergear state tracking, recorded into Jobs with printout = 2
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import numpy as np
+import pytest
+from m2py import Makergear, arc_points
+
+def recorded(printer):
+    return [bytes(line).decode() for line in printer.job]
+
+def test_resumed_relative_state_keeps_every_move():
+    first = Makergear('COM1', 115200, printout = 2, verbose = False)
+    first.coord_sys('rel')
+    first.move(x = 1)
+    second = Makergear('COM1', 115200, printout = 2, verbose = False)
+    second.set_state(first.get_state())
+    for i in range(3):
+        second.move(x = 1)
+    assert recorded(second) == ['G1 X1']*3
+
+def test_channel_status_is_tracked_while_printing():
+    printer = Makergear('COM1', 115200, printout = 2, verbose = False)
+    printer.on(1)
+    printer.on(3)
+    assert printer.get_state()['channels'] == [1, 0, 1]
+    printer.off(3)
+    assert printer.get_state()['channels'] == [1, 0, 0]
+    printer.allon()
+    assert printer.get_state()['channels'] == [1, 1, 1]
+    printer.alloff()
+    assert printer.get_state()['channels'] == [0, 0, 0]
+
+@pytest.mark.parametrize('radius', [0.3, 5, 40])
+def test_looser_arc_tolerance_never_adds_segments(radius):
+    counts = [len(arc_points(2*radius, 0, radius, 0, tolerance = tolerance)) - 1 for tolerance in np.geomspace(1e-4, 100, 40)]
+    assert all(a >= b for a, b in zip(counts, counts[1:]))
+    assert counts[-1] == 1  # A half turn
+
+def test_arc_points_stay_within_tolerance():
+    pts = arc_points(20, 0, 10, 0, direction = 'cw', tolerance = 0.01)
+    assert np.allclose(np.hypot(pts[:, 0] - 10, pts[:, 1]), 10)
+    mid = (pts[:-1] + pts[1:]) / 2
+    assert np.all(10 - np.hypot(mid[:, 0] - 10, mid[:, 1]) <= 0.01)
+    assert np.all(pts[1:-1, 1] > 0)  # Clockwise from (0, 0) around (10, 0) goes through y > 0
+    assert pts[-1].tolist() == [20, 0]
+
+def test_arcs_are_segmented_or_sent_as_g2_g3():
+    printer = Makergear('COM1', 115200, printout = 2, verbose = False)
+    printer.coord_sys('rel')
+    printer.arc(x = 10, y = 10, i = 0, j = 10, direction = 'cw', tolerance = 0.05)
+    lines = recorded(printer)[1:]
+    assert len(lines) > 4
+    words = [dict((word[0], float(word[1:])) for word in line.split()[1:]) for line in lines]
+    assert sum(word.get('X', 0) for word in words) == pytest.approx(10, abs = 1e-3)
+    assert sum(word.get('Y', 0) for word in words) == pytest.approx(10, abs = 1e-3)
+    assert printer.coords.tolist() == [10, 10, 0]
+    printer.arc(x = 10, y = -10, i = 10, j = 0, direction = 'ccw', native = True)
+    assert recorded(printer)[-1] == 'G3 X10 Y-10 I10 J0'
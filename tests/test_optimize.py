@@ -0,0 +1,143 @@
+# M2PY -- Regression tests of the optimization passes: the optimized jobs must end up where the original ones do
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import numpy as np
+import pytest
+from job import Job
+from gcode import parse_gcode
+from m2py import Makergear
+from optimize import merge_moves, merge_toggles, order_travel, path_segments, segments_job, schedule_path, _words, _track, _nearest_neighbour
+
+def end_position(job):
+    position, relative = [0.0, 0.0, 0.0], False
+    for line in job:
+        position, relative = _track(_words(line), position, relative)
+    return position
+
+def test_repeated_words_are_rejected():
+    assert _words(b'G1 X1 X2') is None
+    assert _words(b'G1 X1 x2') is None
+    assert _words(b'G1 X1 Y2 ; X3') == {'G': 1, 'X': 1, 'Y': 2}
+
+def test_dropped_relative_moves_are_carried_over():
+    job = Job()
+    job.send('G91')
+    for i in range(1000):
+        job.send('G1 X0.0009')
+    optimized, stats = merge_moves(job)
+    assert stats['dropped'] > 0
+    assert len(optimized) < len(job)
+    assert end_position(optimized) == pytest.approx(end_position(job), abs = 1e-3)
+    assert end_position(optimized)[0] == pytest.approx(0.9, abs = 1e-3)
+
+def test_dropped_relative_moves_are_carried_across_channel_commands():
+    job = Job()
+    job.send('G91')
+    for i in range(100):
+        job.send('G1 X0.0009')
+        job.send('M3')
+        job.send('G1 Y1')
+        job.send('M4')
+    optimized, _ = merge_moves(job)
+    assert end_position(optimized) == pytest.approx(end_position(job), abs = 1e-3)
+
+def test_homing_axes_without_values_resets_them():
+    assert _words(b'G28 X Y Z') == {'G': 28, 'X': None, 'Y': None, 'Z': None}
+    assert _track(_words(b'G28 X Y Z'), [50.0, 50.0, 5.0], False)[0] == [0.0, 0.0, 0.0]
+    assert _track(_words(b'G28 X'), [50.0, 50.0, 5.0], False)[0] == [0.0, 50.0, 5.0]
+    assert _words(b'G1 X') is None
+
+def test_travel_order_starts_from_the_homed_position():
+    job = Job()
+    for line in ['G90', 'G1 X50 Y50', 'G28 X Y Z', 'G1 X40 Y40', 'M3', 'G1 X41 Y40', 'M4', 'G1 X1 Y1', 'M3', 'G1 X2 Y1', 'M4']:
+        job.send(line)
+    optimized, stats = order_travel(job)
+    lines = [bytes(line).decode() for line in optimized]
+    assert lines[3].startswith('G1 X1 Y1')
+    assert stats['travel_after'] < stats['travel_before']
+    assert end_position(optimized) == pytest.approx(end_position(job))
+
+def test_travel_order_never_prints_a_layer_before_the_one_below():
+    job = Job()
+    for line in ['G90', 'G1 Z0', 'G1 X100', 'M3', 'G1 X101', 'M4', 'G1 X50', 'M3', 'G1 X51', 'M4', 'G1 Z1', 'G1 X0', 'M3', 'G1 X1', 'M4']:
+        job.send(line)
+    optimized, _ = order_travel(job)
+    position, relative, heights = [0.0, 0.0, 0.0], False, []
+    for line in optimized:
+        words = _words(line)
+        position, relative = _track(words, position, relative)
+        if words.get('M') == 3:
+            heights.append(position[2])
+    assert heights == [0, 0, 1]
+    assert end_position(optimized) == pytest.approx(end_position(job))
+
+def test_nearest_neighbour_matches_a_brute_force_search():
+    rng = np.random.default_rng(1)
+    entries = np.c_[rng.random((300, 2))*100, np.zeros(300)]
+    exits = entries + np.c_[rng.normal(size = (300, 2)), np.zeros(300)]
+    reversible = rng.random(300) < 0.5
+    start = np.array([-20.0, 150.0, 0.0])
+    order, flipped = _nearest_neighbour(entries, exits, reversible, start)
+
+    points = np.vstack([entries, exits])
+    done, position, expected = np.zeros(300, dtype = bool), start, []
+    for _ in range(300):
+        d = np.linalg.norm(points - position, axis = 1)
+        d[np.r_[done, done | ~reversible]] = np.inf
+        best = int(np.argmin(d))
+        done[best % 300] = True
+        expected.append((best % 300, best >= 300))
+        position = entries[best % 300] if best >= 300 else exits[best % 300]
+    assert list(zip(order.tolist(), flipped.tolist())) == expected
+
+def extruded(job):
+    # Every extruding move as a (start, end) pair, in either direction
+    gcode = parse_gcode(job)
+    position = np.vstack([np.zeros([1, 4]), gcode.position])[:, :3].round(6)
+    rows = np.flatnonzero((gcode.command == b'G1') & (gcode.channels != 0))
+    return sorted(tuple(sorted([tuple(position[row]), tuple(position[row + 1])])) for row in rows if np.any(position[row] != position[row + 1]))
+
+def test_schedule_path_groups_tools_within_each_layer():
+    mk = Makergear('COM1', 115200, printout = 0, verbose = False)
+    mk.set_tool_coords(tool = 2, x = 50)
+    for z in range(3):
+        for i in range(4):
+            mk.change_tool(1 + i % 2)
+            mk.move(x = 10*i, y = 0, z = z)
+            mk.on(1 + i % 2)
+            mk.move(x = 10*i + 5, y = 5, z = z)
+            mk.off(1 + i % 2)
+    job, stats = schedule_path(mk.path, mk.tool_coords)
+    # One change per layer, the next layer starting with the tool already active
+    assert stats['tool_changes_before'] == 11 and stats['tool_changes_after'] == 3
+    assert stats['travel_after'] < stats['travel_before']
+    assert stats['time_saved'] == pytest.approx(stats['time_before'] - stats['time_after'])
+    assert stats['time_saved'] > 0
+    # The same moves are extruded, and every layer is finished before the next one
+    assert extruded(job) == extruded(segments_job(path_segments(mk.path), mk.tool_coords))
+    gcode = parse_gcode(job)
+    z = gcode.position[(gcode.command == b'G1') & (gcode.channels != 0), 2]
+    assert np.all(np.diff(z) >= 0)
+
+def channels_per_move(job):
+    gcode = parse_gcode(job)
+    moves = gcode.command == b'G1'
+    return gcode.position[moves, :3].tolist(), gcode.channels[moves].tolist()
+
+def test_merge_toggles_keeps_only_the_channel_changes():
+    job = Job(['G90', 'M3', 'G1 X1 F600', 'M4', 'M3', 'G1 X2', 'M4', 'M4', 'G1 X3', 'M3', 'G1 X3', 'M4', 'G1 X4', 'M7', 'M3', 'M8', 'G1 X5'])
+    merged, stats = merge_toggles(job)
+    # Cancelling and repeated toggles go, as does the zero-length extrusion at X3 with its on/off pair, and channels are switched off first
+    assert list(merged) == [b'G90', b'M3', b'G1 X1 F600', b'G1 X2', b'M4', b'G1 X3', b'G1 X4', b'M8', b'M3', b'G1 X5']
+    assert stats['toggles'] == 6 and stats['moves'] == 1
+    positions, channels = channels_per_move(merged)
+    assert positions == [[1, 0, 0], [2, 0, 0], [3, 0, 0], [4, 0, 0], [5, 0, 0]]
+    assert channels == [1, 1, 0, 0, 1]
+    assert stats['drain_after'].syncs == stats['drain_before'].syncs - 6
+    assert stats['drain_after'].total < stats['drain_before'].total
+
+def test_merge_toggles_makes_up_dropped_relative_moves():
+    job = Job(['G91', 'M3', 'G1 X1', 'M4', 'G1 X0.0000004', 'M3', 'G1 X0.0000004', 'M4', 'G1 Y1'])
+    merged, stats = merge_toggles(job)
+    assert list(merged)[3:] == [b'M4', b'G1 X0.000001 Y0 Z0', b'G1 Y1']
+    assert end_position(merged) == pytest.approx(end_position(job))
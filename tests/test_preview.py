@@ -0,0 +1,80 @@
+# M2PY -- Regression tests of the print path previews
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import numpy as np
+import pytest
+from preview import PathRecorder, gcode_path, render_path, simplify_path
+
+def layered_gcode(layers = 40, points = 100, heights = 5):
+    lines = ['G90']
+    for i in range(layers*points):
+        lines.append('G1 X{} Y{} Z{}'.format(i % 50, (i // 50) % 20, (i // points) % heights))
+    return ('\n'.join(lines) + '\n').encode()
+
+def segments(xyz):
+    segments = np.stack([xyz[:-1], xyz[1:]], axis = 1)
+    return segments[np.all(np.isfinite(segments), axis = (1, 2))]
+
+def test_zslice_never_joins_chunks_across_other_heights():
+    xyz, channels = gcode_path(layered_gcode(), zslice = (0.5, 1.5), chunk_size = 4096)
+    assert len(xyz) == len(channels) > 0
+    assert np.all(np.isfinite(xyz[0]))
+    # Every segment drawn is a move ending inside the slice
+    ends = segments(xyz)[:, 1, 2]
+    assert np.all((ends >= 0.5) & (ends <= 1.5))
+
+def test_zslice_outside_the_path_is_empty():
+    xyz, channels = gcode_path(layered_gcode(), zslice = (50, 60), chunk_size = 4096)
+    assert xyz.shape == (0, 3)
+    assert channels.shape == (0,)
+
+def recorded_path():
+    path = PathRecorder()
+    for z in range(3):
+        path.extend([[10, 0, z], [10, 10, z], [0, 10, z]], channels = 1)
+        path.append(0, 0, z + 1)
+    return path
+
+@pytest.mark.parametrize('selection', [{'zslice': (5, 6)}, {'moves': (1000, 2000)}])
+def test_empty_selection_draws_empty_axes(tmp_path, selection):
+    xyz, channels = recorded_path().select(**selection)
+    assert xyz.shape == (0, 3)
+    assert channels.shape == (0,)
+    render_path(xyz, channels, zrange = 'fit', output = str(tmp_path / 'path.png'))
+    assert (tmp_path / 'path.png').exists()
+
+def test_layer_out_of_range_raises_value_error():
+    path = recorded_path()
+    assert len(path.select(layer = 2)[0]) > 0
+    with pytest.raises(ValueError, match = 'out of range'):
+        path.select(layer = 3)
+    with pytest.raises(ValueError, match = 'out of range'):
+        path.select(layer = (1, 7))
+
+def test_sampled_preview_lies_on_the_full_path():
+    xy = np.random.default_rng(0).random([20000, 2]).round(3)*100
+    data = ('G90\nM3\n' + ''.join('G1 X{} Y{} Z{}\n'.format(x, y, i // 1000) for i, (x, y) in enumerate(xy))).encode()
+    fast, fast_channels = gcode_path(data, budget = 2000, chunk_size = 65536)
+    full, full_channels = gcode_path(data, budget = 10**7, chunk_size = 65536, fast = False)
+    assert 500 <= len(fast) < len(full) / 4
+    points = {(tuple(point), channels) for point, channels in zip(full.round(6).tolist(), full_channels)}
+    assert all((tuple(point), channels) in points for point, channels in zip(fast.round(6).tolist(), fast_channels))
+    assert fast[-1].tolist() == full[-1].tolist()
+
+def test_simplify_path_drops_straight_runs_and_keeps_separators():
+    xyz = [[0, 0, 0], [1, 0, 0], [2, 0, 0], [2, 0, 0], [2, 1, 0], [np.nan]*3, [5, 5, 0], [6, 5, 0], [7, 5, 0]]
+    channels = [0, 1, 1, 1, 2, 255, 0, 0, 0]
+    simple, status = simplify_path(xyz, channels)
+    assert np.array_equal(simple, [[0, 0, 0], [2, 0, 0], [2, 1, 0], [np.nan]*3, [5, 5, 0], [7, 5, 0]], equal_nan = True)
+    assert status.tolist() == [0, 1, 2, 255, 0, 0]
+
+def test_simplify_path_meets_the_budget_and_keeps_every_channel_change():
+    rng = np.random.default_rng(0)
+    xyz = rng.random([20000, 3])
+    channels = np.repeat(rng.integers(0, 2, 200), 100).astype(np.uint8)
+    simple, status = simplify_path(xyz, channels, budget = 1000)
+    assert len(simple) <= 2*1000
+    # Every switch between channel states along the path survives
+    switches = lambda status: status[np.r_[True, status[1:] != status[:-1]]].tolist()
+    assert switches(status) == switches(channels)
+    assert simple[-1].tolist() == xyz[-1].tolist()
@@ -0,0 +1,39 @@
+# M2PY -- Tests of uploading a job to the SD card of the simulated printer and printing it from there
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import pytest
+from daemon import PrinterDaemon
+from job import Job
+from m2py import Makergear
+from simulator import Simulator
+
+def lattice():
+    job = Job()
+    for line in ['G91', 'G1 F6000', 'G1 X5', 'G1 Y5', 'G1 X-5', 'G1 Y-5', 'M3', 'G1 X2 Y2', 'M5']:
+        job.send(line)
+    return job
+
+def printed(printer):
+    assert printer.sd['part.gco'] == [bytes(line).decode() + '\r\n' for line in lattice()]
+    assert printer.position[:2] == pytest.approx([2, 2])
+
+def test_job_is_uploaded_verified_and_printed_from_the_card():
+    printer = Simulator(boot = 0, speedup = 50)
+    mk = Makergear(printer, 115200, printout = 1, stream = 'char', verbose = False)
+    sd = mk.sd_print(lattice(), name = 'PART.gco', poll = 0.05)
+    assert sd.done.is_set() and sd.progress == 1.0
+    printed(printer)
+    mk.close()
+
+def test_sd_print_through_the_printer_daemon():
+    printer = Simulator(boot = 0, speedup = 50)
+    daemon = PrinterDaemon(printer, 115200, address = 'm2py://127.0.0.1:0', verbose = False).start()
+    try:
+        mk = Makergear(daemon.address, 115200, printout = 1, verbose = False)
+        sd = mk.sd_print(lattice(), name = 'part.gco', poll = 0.05)
+        assert sd.done.is_set() and sd.size == sum(len(line) + 2 for line in lattice())
+        mk.close()
+        printed(printer)
+    finally:
+        daemon.shutdown()
+        daemon.close()
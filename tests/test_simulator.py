@@ -0,0 +1,49 @@
+# M2PY -- Tests of the simulated printer, answering on the serial level like the M2PCS firmware
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import pytest
+from simulator import Simulator, BANNER, move_time
+from transport import number_line
+
+def booted(**options):
+    printer = Simulator(boot = 0, **options)
+    banner = [printer.readline().decode().strip() for line in BANNER]
+    return printer, banner
+
+def answer(printer, line):
+    """Writes line (str, or bytes with its newline) and returns the lines received up to the next 'ok'"""
+    printer.write(line if isinstance(line, bytes) else str.encode(line + '\n'))
+    lines = []
+    while not lines or lines[-1] != 'ok':
+        read = printer.readline()
+        assert read, 'No answer to {}'.format(line)
+        lines.append(read.decode().strip())
+    return lines
+
+def test_boot_banner_and_firmware_report():
+    printer, banner = booted(speedup = 100)
+    assert banner == BANNER
+    report = answer(printer, 'M115')
+    assert report[0].startswith('FIRMWARE_NAME:Marlin')
+    printer.close()
+
+def test_bad_line_number_and_checksum_ask_for_a_resend():
+    printer, _ = booted(speedup = 100)
+    assert answer(printer, number_line(b'M110', 0)) == ['ok']
+    assert answer(printer, number_line(b'G1 X1', 2))[-2:] == ['Resend: 1', 'ok']
+    assert answer(printer, b'N1 G1 X1*0\n')[-2:] == ['Resend: 1', 'ok']
+    assert answer(printer, number_line(b'G1 X1', 1)) == ['ok']
+    assert printer.resends == 2
+    printer.close()
+
+def test_moves_are_followed_and_timed():
+    printer, _ = booted(speedup = 10)
+    answer(printer, 'G91')
+    answer(printer, 'G1 X10 Y5 F3000')
+    answer(printer, 'G1 Z1')
+    report = answer(printer, 'M114')
+    assert report[0].startswith('X:10.00 Y:5.00 Z:1.00')
+    assert printer.position[:3] == pytest.approx([10, 5, 1])
+    # 50 mm/s reached from the 2 mm/s jerk speed at the 900 mm/s^2 of X, and back
+    assert move_time((10, 0, 0, 0), 3000) == pytest.approx(2*(50 - 2)/900 + (10 - (50**2 - 2**2)/900)/50)
+    printer.close()
@@ -0,0 +1,38 @@
+# M2PY -- Tests of the print time estimate following the firmware's planner
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import numpy as np
+import pytest
+from simulator import move_time
+from timing import estimate_time, drain_report
+
+def test_single_move_follows_the_trapezoidal_profile():
+    # From and back to the jerk speed, as the simulated printer moves (up to the rounding to whole steps)
+    estimate = estimate_time(['G1 X100 F3000'])
+    assert estimate.times[0] == pytest.approx(move_time((100, 0, 0, 0), 3000), rel = 1e-2)
+
+def test_dwells_and_channel_delays_line_up_with_the_commands():
+    estimate = estimate_time(['; comment', 'G4 P500', 'G4 S2', 'M3', 'M50 S200', 'M5', 'G1 X1 F600'])
+    assert estimate.times[:5] == pytest.approx([0.5, 2, 0.05, 0, 0.2])
+    assert estimate.cumulative == pytest.approx(np.cumsum(estimate.times))
+    assert len(estimate.times) == 6
+
+def test_look_ahead_is_lost_where_the_planner_empties():
+    moves = ['G1 X{} F6000'.format(i) for i in range(1, 41)]
+    straight = estimate_time(moves).cumulative[-1]
+    synced = sum([[move, 'M400'] for move in moves], [])
+    drained = estimate_time(synced).cumulative[-1]
+    assert drained > 2*straight
+    assert estimate_time(synced, synchronize = False).cumulative[-1] < drained
+
+def test_drain_report_splits_off_the_synchronization_cost():
+    moves = ['G1 X{} F6000'.format(i) for i in range(1, 21)]
+    toggled = sum([[move, 'M3', 'M4'] for move in moves], []) + ['M50 S200', 'M7']
+    report = drain_report(toggled)
+    # M50 only sets the delay, it does not empty the planner
+    assert report.syncs == 41
+    assert report.delay == pytest.approx(20*0.05 + 0.2)
+    assert report.drain > 0
+    assert report.total == pytest.approx(estimate_time(toggled).cumulative[-1])
+    assert drain_report(moves) == (pytest.approx(estimate_time(moves).cumulative[-1]), 0, 0, 0)
+    assert drain_report([]) == (0, 0, 0, 0)
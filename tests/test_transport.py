@@ -0,0 +1,75 @@
+# M2PY -- Regression tests of the serial transport against the simulated printer
+# Developed in the Architected Materials Laboratory at the University of Pennsylvania
+
+import re
+import time
+import pytest
+import serial
+from simulator import Simulator
+from transport import connect, handshake
+from printers import UnpluggedPrinter, SilentPrinter, RepetierPrinter
+
+def zigzag(transport, moves):
+    transport.send('G91')
+    for i in range(moves):
+        transport.send('G1 X{} Y0.25'.format(0.5 if i % 2 else -0.5))
+    transport.send('G90')
+
+@pytest.mark.parametrize('stream', ['ok', 'char'])
+def test_streaming_never_overruns_the_receive_buffer(stream):
+    # At real motion speed the firmware stops reading while its planner is full; checksums make lost lines recoverable, so the count shows
+    printer = Simulator(boot = 0)
+    transport = connect(printer, 115200, stream = stream, checksum = True)
+    zigzag(transport, 60)
+    transport.close()
+    assert printer.overruns == 0
+    assert printer.resends == 0
+
+def test_send_and_drain_raise_when_the_port_fails():
+    printer = UnpluggedPrinter(boot = 0, speedup = 20)
+    transport = connect(printer, 115200, stream = 'char')
+    transport.send('G1 X1')
+    printer.unplugged = True
+    transport.reader.join(5)
+    assert not transport.reader.is_alive()
+    with pytest.raises(serial.SerialException):
+        for i in range(100): # Stops once the window is full, at the latest
+            transport.send('G1 X{}'.format(i))
+    with pytest.raises(serial.SerialException):
+        transport.drain()
+    with pytest.raises(serial.SerialException):
+        transport.close()
+
+@pytest.mark.parametrize('stream', ['off', 'ok', 'char'])
+def test_checksums_recover_every_corrupted_or_rejected_line(stream):
+    printer = Simulator(boot = 0, speedup = 50, noise = 0.03, resend = 0.03, record = True, seed = 1)
+    transport = connect(printer, 115200, stream = stream, checksum = True)
+    lines = ['G1 X{} Y{}'.format(i % 7, i % 5) for i in range(300)]
+    for line in lines:
+        transport.send(line)
+    transport.close()
+    assert printer.resends > 0
+    # Every line was executed exactly once, in order
+    executed = [re.sub(r'^N-?\d*\s*', '', cmd).split('*')[0].strip() for cmd in printer.commands]
+    assert executed[-len(lines):] == lines
+    assert transport.acked == transport.sent
+
+def test_handshake_probes_as_soon_as_the_firmware_starts():
+    printer = Simulator(boot = 0.2)
+    start = time.time()
+    lines = handshake(printer, reset_wait = 2.5)
+    assert time.time() - start < 1.5
+    assert lines[0] == 'start' and any(line.startswith('FIRMWARE_NAME:Marlin') for line in lines)
+    assert printer.timeout == 1 # Restored
+
+def test_handshake_gives_up_after_the_deadline():
+    printer = SilentPrinter(boot = 0)
+    start = time.time()
+    with pytest.raises(serial.SerialException, match = 'did not answer within 0.5 s'):
+        handshake(printer, deadline = 0.5, reset_wait = 0.1)
+    assert time.time() - start < 1.5
+    assert printer.written == b'M115\n' # Probed once the board did not reset
+
+def test_handshake_rejects_other_firmware():
+    with pytest.raises(serial.SerialException, match = 'Unexpected firmware: FIRMWARE_NAME:Repetier'):
+        connect(RepetierPrinter(boot = 0), 115200)